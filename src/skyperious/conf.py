@@ -10,7 +10,7 @@ Released under the MIT License.
 
 @author      Erki Suurjaak
 @created     26.11.2011
-@modified    02.06.2024
+@modified    18.10.2026
 ------------------------------------------------------------------------------
 """
 try: from ConfigParser import RawConfigParser                 # Py2
@@ -58,13 +58,17 @@ FileDirectives = ["ConsoleHistoryCommands", "DBDoBackup",  "DBFiles", "DBSort",
 ]
 """List of attributes saved if changed from default."""
 OptionalFileDirectives = [
-    "EmoticonsPlotWidth", "ExportFileAutoOpen", "ExportChatTemplate", "ExportContactsTemplate",
-    "ExportDbTemplate", "HistoryFontSize", "HistoryZoom", "LiveSyncAuthRateLimitDelay",
+    "DiffParallelCount", "EmoticonsPlotWidth", "ExportFileAutoOpen", "ExportChatTemplate",
+    "ExportContactsTemplate", "ExportDbTemplate", "HistoryFontSize", "HistoryZoom",
+    "LiveSyncAuthRateLimitDelay",
     "LiveSyncRateLimit", "LiveSyncRateWindow", "LiveSyncRetryLimit", "LiveSyncRetryDelay",
     "LogSQL", "MinWindowSize", "MaxConsoleHistory", "MaxHistoryInitialMessages",
-    "MaxRecentFiles", "MaxSearchHistory", "MaxSearchMessages", "MaxSearchTableRows",
+    "MaxRecentFiles", "MaxSearchHistory", "MaxSearchMessages", "MaxSearchResultSets",
+    "MaxSearchTableRows",
     "PlotDaysColour", "PlotDaysUnitSize", "PlotHoursColour", "PlotHoursUnitSize",
-    "PopupUnexpectedErrors", "SearchResultsChunk", "SharedAudioVideoAutoDownload",
+    "PopupUnexpectedErrors", "SearchParallelCount", "SearchResultsChunk",
+    "SearchResultsInterval", "SearchTableParallelCount", "SearchUseFullTextIndex",
+    "SharedAudioVideoAutoDownload",
     "SharedFileAutoDownload", "SharedImageAutoDownload", "SharedContentUseCache",
     "StatisticsPlotWidth", "StatusFlashLength", "UpdateCheckInterval",
     "WordCloudLengthMin", "WordCloudCountMin", "WordCloudWordsMax",
@@ -237,12 +241,36 @@ Maximum number of messages to show in search results.
 """
 MaxSearchMessages = 500
 
+"""Maximum number of message search result sets to keep in cache."""
+MaxSearchResultSets = 100
+
 """Maximum number of table rows to show in search results."""
 MaxSearchTableRows = 500
 
 """Number of search results to yield in one chunk from search thread."""
 SearchResultsChunk = 50
 
+"""Seconds after which to yield search results gathered so far, if fewer than a chunk."""
+SearchResultsInterval = 0.5
+
+"""
+Number of processes for diffing chats in parallel in merge comparison,
+0 for processor count, 1 for diffing in a single thread.
+"""
+DiffParallelCount = 0
+
+"""Number of databases to search at the same time in command-line search."""
+SearchParallelCount = 4
+
+"""Number of tables to search at the same time in all tables search."""
+SearchTableParallelCount = 4
+
+"""
+Whether message search uses the database full-text index if one exists,
+matching words as word beginnings instead of anywhere in message text.
+"""
+SearchUseFullTextIndex = True
+
 """Name of font used in chat history."""
 HistoryFontName = "Tahoma"
 
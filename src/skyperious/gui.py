@@ -8,7 +8,7 @@ Released under the MIT License.
 
 @author      Erki Suurjaak
 @created     26.11.2011
-@modified    02.06.2024
+@modified    18.10.2026
 ------------------------------------------------------------------------------
 """
 import ast
@@ -4198,6 +4198,37 @@ class DatabasePage(wx.Panel):
         panel.Thaw()
 
 
+    def restore_search(self, last_search):
+        """
+        Re-renders last search results page from saved message result set,
+        if search was in messages and its result set is valid for current
+        database. Returns whether search was restored.
+        """
+        info = last_search.get("info") or {}
+        if "messages" != info.get("table") or not info.get("text"):
+            return False
+        fulltext = conf.SearchUseFullTextIndex and self.db.has_fulltext_index()
+        key = workers.SearchThread.make_store_key(info, fulltext)
+        version = self.db.get_data_version()
+        if not workers.SearchResultStore().get(self.db.filename, key, version):
+            return False
+
+        html = self.html_searchall
+        text, fromtext = info["text"], "messages"
+        data = {"id": self.counter(), "db": self.db, "text": text, "map": {},
+                "width": html.Size.width * 5 // 9, "table": info["table"],
+                "partial_html": ""}
+        template = step.Template(templates.SEARCH_HEADER_HTML, escape=True)
+        data["partial_html"] = template.expand(locals())
+        worker = workers.SearchThread(self.on_searchall_callback)
+        self.workers_search[data["id"]] = worker
+        worker.work(data)
+        title = last_search.get("title") or text
+        html.InsertTab(0, title, data["id"],
+                       data["partial_html"] + "</table></font>", data)
+        return True
+
+
     def save_page_conf(self):
         """Saves page last configuration like search text and results."""
 
@@ -4214,6 +4245,7 @@ class DatabasePage(wx.Panel):
             if search_data.get("info"):
                 info["map"] = search_data["info"].get("map")
                 info["text"] = search_data["info"].get("text")
+                info["table"] = search_data["info"].get("table")
             data = {"content": search_data["content"],
                     "id": search_data["id"], "info": info,
                     "title": search_data["title"], }
@@ -5396,14 +5428,14 @@ class DatabasePage(wx.Panel):
         if tab_data and tab_data["id"] in self.workers_search:
             self.tb_search_settings.SetToolNormalBitmap(
                 wx.ID_STOP, images.ToolbarStopped.Bitmap)
-            self.workers_search[tab_data["id"]].stop()
-            del self.workers_search[tab_data["id"]]
+            self.workers_search[tab_data["id"]].stop_work(drop_results=True)
 
 
     def on_change_searchall_tab(self, event):
         """Handler for changing a tab in search window, updates stop button."""
         tab_data = self.html_searchall.GetActiveTabData()
-        if tab_data and tab_data["id"] in self.workers_search:
+        if tab_data and tab_data["id"] in self.workers_search \
+        and self.workers_search[tab_data["id"]].is_working():
             self.tb_search_settings.SetToolNormalBitmap(
                 wx.ID_STOP, images.ToolbarStop.Bitmap)
         else:
@@ -5443,14 +5475,11 @@ class DatabasePage(wx.Panel):
             title += " (%s)" % result.get("count", 0)
             self.html_searchall.SetTabDataByID(search_id, title, html,
                                                tab_data["info"])
-        if search_done:
+        if search_done and tab_data: # Superseded searches have no tab
             guibase.status("Finished searching for \"%s\" in %s.",
                            result["search"]["text"], self.db.filename)
             self.tb_search_settings.SetToolNormalBitmap(
                 wx.ID_STOP, images.ToolbarStopped.Bitmap)
-            if search_id in self.workers_search:
-                self.workers_search[search_id].stop()
-                del self.workers_search[search_id]
         if "error" in result:
             logger.error("Error searching %s:\n\n%s", self.db, result["error"])
             errormsg = "Error searching %s:\n\n%s" % \
@@ -5491,7 +5520,15 @@ class DatabasePage(wx.Panel):
             template = step.Template(templates.SEARCH_HEADER_HTML, escape=True)
             data["partial_html"] = template.expand(locals())
 
-            worker = workers.SearchThread(self.on_searchall_callback)
+            worker = None
+            reuse_tab = html.GetTabCount() and not conf.SearchUseNewTab
+            if reuse_tab:
+                # Cancel search in reused tab, its worker can refine results
+                worker = self.workers_search.pop(
+                    html.GetActiveTabData()["id"], None)
+                if worker: worker.stop_work(drop_results=True)
+            if not worker:
+                worker = workers.SearchThread(self.on_searchall_callback)
             self.workers_search[data["id"]] = worker
             worker.work(data)
             bmp = images.ToolbarStop.Bitmap
@@ -5499,7 +5536,7 @@ class DatabasePage(wx.Panel):
 
             title = text[:50] + ".." if len(text) > 50 else text
             content = data["partial_html"] + "</table></font>"
-            if conf.SearchUseNewTab or not html.GetTabCount():
+            if not reuse_tab:
                 html.InsertTab(0, title, data["id"], content, data)
             else:
                 # Set new ID for the existing reused tab
@@ -6524,7 +6561,8 @@ class DatabasePage(wx.Panel):
         """Asks for confirmation and deletes specified chats from database."""
         if not chats: return
         ongoings = list(filter(bool, [self.worker_live.is_working() and "live sync",
-                                     self.workers_search and "search"]))
+                                     any(x.is_working() for x in self.workers_search.values())
+                                     and "search"]))
         if ongoings: return wx.MessageBox("%s is currently ongoing, cannot delete." %
                                           " and ".join(ongoings).capitalize(),
                                           conf.Title, wx.ICON_INFORMATION | wx.OK)
@@ -6813,9 +6851,10 @@ class DatabasePage(wx.Panel):
                 conf.SearchHistory = conf.SearchHistory[:-1]
             self.edit_searchall.SetChoices(conf.SearchHistory)
 
-            # Restore last cached search results page
+            # Restore last search results page, re-rendering messages from
+            # saved result set if still valid, else from last cached HTML
             last_search = conf.LastSearchResults.get(self.db.filename)
-            if last_search:
+            if last_search and not self.restore_search(last_search):
                 title = last_search.get("title", "")
                 html = last_search.get("content", "")
                 info = last_search.get("info")
@@ -7356,6 +7395,8 @@ class MergerPage(wx.Panel):
             self.on_merge_all_result(event)
         elif "diff_left" == event.result.get("type"):
             self.on_scan_all_result(event)
+        elif "diff_contacts" == event.result.get("type"):
+            self.on_diff_contacts_result(event)
 
 
     def on_worker_merge_callback(self, result):
@@ -8062,132 +8103,105 @@ class MergerPage(wx.Panel):
     def load_later_data(self):
         """
         Loads later data from the databases, like message counts and compared
-        contacts, used as a background callback to speed up page opening.
+        contacts, in background worker, used as a callback to speed up page
+        opening. Results are shown in on_diff_contacts_result().
         """
+        if self.compared is None:
+            c1map = dict((c["identity"], c) for c in self.chats1)
+            c2map = dict((c["identity"], c) for c in self.chats2)
+            compared = []
+            for c1 in self.chats1:
+                c1["c1"], c1["c2"] = c1.copy(), c2map.get(c1["identity"])
+                compared.append(c1)
+            for c2 in self.chats2:
+                if c2["identity"] not in c1map:
+                    c2["c1"], c2["c2"] = None, c2.copy()
+                    compared.append(c2)
+            for c in compared:
+                c["last_message_datetime1"] = None
+                c["last_message_datetime2"] = None
+                c["messages1"] = c["messages2"] = c["people"] = None
+            self.compared = compared
+        self.con1diff, self.con2diff = [], []
+        self.con1difflist, self.con2difflist = [], []
+        self.congroup1diff, self.congroup2diff = [], []
+        self.list_contacts.DeleteAllItems()
+        self.button_swap.Enabled = False
+        guibase.status("Comparing contacts in %s and %s.", self.db1, self.db2)
+        self.worker_merge.work({"type": "diff_contacts", "db1": self.db1,
+                                "db2": self.db2, "chats1": self.chats1,
+                                "chats2": self.chats2, "compared": self.compared})
 
-        try:
-            chats1, chats2 = self.chats1, self.chats2
-            self.db1.get_conversations_stats(chats1)
-            self.db2.get_conversations_stats(chats2)
-            c1map = dict((c["identity"], c) for c in chats1)
-            c2map = dict((c["identity"], c) for c in chats2)
-
-            if self.compared is None:
-                compared = []
-                for c1 in chats1:
-                    c1["c1"], c1["c2"] = c1.copy(), c2map.get(c1["identity"])
-                    compared.append(c1)
-                for c2 in chats2:
-                    if c2["identity"] not in c1map:
-                        c2["c1"], c2["c2"] = None, c2.copy()
-                        compared.append(c2)
-                for c in compared:
-                    c["last_message_datetime1"] = None
-                    c["last_message_datetime2"] = None
-                    c["messages1"] = c["messages2"] = c["people"] = None
-                self.compared = compared
-            for c in self.compared:
-                for i in range(2):
-                    cmap = c2map if i else c1map
-                    if c["c%s" % (i + 1)] and c["identity"] in cmap:
-                        c["messages%s" % (i + 1)] = \
-                        c["c%s" % (i + 1)]["message_count"] = \
-                            cmap[c["identity"]]["message_count"]
-                        c["last_message_datetime%s" % (i + 1)] = \
-                        c["c%s" % (i + 1)]["last_message_datetime%s" % (i + 1)] = \
-                            cmap[c["identity"]]["last_message_datetime"]
-                people = sorted([p["identity"] for p in c["participants"]])
-                if skypedata.CHATS_TYPE_SINGLE != c["type"]:
-                    c["people"] = "%s (%s)" % (len(people), ", ".join(people))
-                else:
-                    people = [p for p in people if p != self.db1.id]
-                    c["people"] = ", ".join(people)
 
+    def on_diff_contacts_result(self, event):
+        """
+        Handler for contacts comparison result from worker, populates chat
+        and contact lists progressively, and database statistics when done.
+        """
+        if not self: return
+        result = event.result
+        if "chats" in result:
+            for c, data in zip(self.compared, result["chats"]):
+                c.update(data)
+                for i in range(1, 3):
+                    if "messages%s" % i in data:
+                        c["c%s" % i]["message_count"] = data["messages%s" % i]
+                        c["c%s" % i]["last_message_datetime%s" % i] = \
+                            data["last_message_datetime%s" % i]
             self.list_chats.Enabled = True
             self.list_chats.Populate(self.compared)
 
-            # Populate the contact comparison list
-            contacts1 = self.db1.get_contacts()
-            contacts2 = self.db2.get_contacts()
-            contactgroups1 = self.db1.get_contactgroups()
-            contactgroups2 = self.db2.get_contactgroups()
-            con1map = dict((c["identity"], c) for c in contacts1)
-            con2map = dict((c["identity"], c) for c in contacts2)
-            con1diff, con2diff = [], []
-            con1new, con2new = {}, {} # New contacts for dbs {skypename:row, }
-            cg1diff, cg2diff = [], []
-            cg1map = dict((g["name"], g) for g in contactgroups1)
-            cg2map = dict((g["name"], g) for g in contactgroups2)
-            for c1 in contacts1:
-                c2 = con2map.get(c1["identity"])
-                if not c2 and c1["identity"] not in con1new:
-                    c = c1.copy()
-                    c["c1"], c["c2"] = c1, c2
-                    con1diff.append(c)
-                    con1new[c1["identity"]] = True
-            for c2 in contacts2:
-                c1 = con1map.get(c2["identity"])
-                if not c1 and c2["identity"] not in con2new:
-                    c = c2.copy()
-                    c["c1"], c["c2"] = c1, c2
-                    con2diff.append(c)
-                    con2new[c2["identity"]] = True
-            for g1 in contactgroups1:
-                g2 = cg2map.get(g1["name"])
-                if not g2 or g2["members"] != g1["members"]:
-                    g = g1.copy()
-                    g["g1"] = g1
-                    g["g2"] = g2
-                    cg1diff.append(g)
-            for g2 in contactgroups2:
-                g1 = cg1map.get(g2["name"])
-                if not g1 or g1["members"] != g2["members"]:
-                    g = g2.copy()
-                    g["g1"] = g1
-                    g["g2"] = g2
-                    cg2diff.append(g)
+        if result.get("contacts1"):
+            self.list_contacts.Freeze()
+            for c in result["contacts1"]:
+                item = dict(c, __type="Contact", __data=c)
+                self.con1diff.append(c)
+                self.con1difflist.append(item)
+                self.list_contacts.AppendRow(item)
+            self.list_contacts.Thaw()
+            self.button_merge_allcontacts.Enabled = self.list_contacts.ItemCount
+        if result.get("contacts2"):
+            for c in result["contacts2"]:
+                self.con2diff.append(c)
+                self.con2difflist.append(dict(c, __type="Contact", __data=c))
+
+        if "done" not in result:
+            return
+
+        if "error" in result:
+            logger.error("Error loading additional data from %s or %s.\n\n%s",
+                         self.db1, self.db2, result["error"])
+            wx.MessageBox("Error loading additional data from %s or %s."
+                          "\n\nError: %s." % (self.db1, self.db2,
+                          result.get("error_short", result["error"])),
+                          conf.Title, wx.OK | wx.ICON_WARNING)
+        else:
             dummy = {"__type": "Group", "phone_mobile_normalized": "",
                 "country": "", "city": "", "about": "About"}
-            con1difflist = [c.copy() for c in con1diff]
-            [c.update({"__type": "Contact", "__data": c}) for c in con1difflist]
-            for g in cg1diff:
-                c = g.copy()
-                c.update(dummy)
-                c["identity"], c["__data"] = c["members"], g
-                con1difflist.append(c)
-            con2difflist = [c.copy() for c in con2diff]
-            [c.update({"__type":"Contact", "__data": c}) for c in con2difflist]
-            for g in cg2diff:
-                c = g.copy()
-                c.update(dummy)
-                c["identity"], c["__data"] = c["members"], g
-                con2difflist.append(c)
-            self.list_contacts.Populate(con1difflist)
+            self.list_contacts.Freeze()
+            for i in range(2):
+                cgdiff = result["contactgroups%s" % (i + 1)]
+                difflist = self.con2difflist if i else self.con1difflist
+                for g in cgdiff:
+                    c = g.copy()
+                    c.update(dummy)
+                    c["identity"], c["__data"] = c["members"], g
+                    difflist.append(c)
+                    if not i: self.list_contacts.AppendRow(c)
+                (self.congroup2diff if i else self.congroup1diff).extend(cgdiff)
+            self.list_contacts.Thaw()
             self.button_merge_allcontacts.Enabled = self.list_contacts.ItemCount
-            self.con1diff = con1diff
-            self.con2diff = con2diff
-            self.con1difflist = con1difflist
-            self.con2difflist = con2difflist
-            self.congroup1diff = cg1diff
-            self.congroup2diff = cg2diff
 
-            for i in range(2):
-                db = self.db2 if i else self.db1
-                db.update_fileinfo()
-                label = self.label_all2 if i else self.label_all1
-                label.Label = "%s.\n\nSize %s.\nLast modified %s.\n" % (
-                              db, util.format_bytes(db.filesize),
-                              db.last_modified.strftime("%Y-%m-%d %H:%M:%S"))
             for i in range(2):
                 db = self.db2 if i else self.db1
                 condiff = self.con2diff if i else self.con1diff
-                contacts = contacts2 if i else contacts1
+                contacts = db.get_contacts()
                 db.update_fileinfo()
                 label = self.label_all2 if i else self.label_all1
                 label.Label = "%s.\n\nSize %s.\nLast modified %s.\n" % (
                               db, util.format_bytes(db.filesize),
                               db.last_modified.strftime("%Y-%m-%d %H:%M:%S"))
-                chats = chats2 if i else chats1
+                chats = self.chats2 if i else self.chats1
                 if chats:
                     t1 = list(filter(bool, [c["message_count"] for c in chats]))
                     count_messages = sum(t1) if t1 else 0
@@ -8208,27 +8222,16 @@ class MergerPage(wx.Panel):
                                    util.plural("conversation", chats, sep=","),
                                    util.plural("message", count_messages, sep=","),
                                    contacttext, datetext_first, datetext_last)
-        except Exception as e:
-            # Database access can easily fail if the user closes the tab before
-            # the later data has been loaded.
-            if self:
-                logger.exception("Error loading additional data from %s or %s.",
-                                 self.db1, self.db2)
-                wx.MessageBox("Error loading additional data from %s or %s."
-                              "\n\nError: %s." % (self.db1, self.db2, util.format_exc(e)),
-                              conf.Title, wx.OK | wx.ICON_WARNING)
-
-        if self:
-            self.button_swap.Enabled = True
-            self.button_merge_chats.Enabled = True
-            if not self.is_scanned:
-                self.button_scan_all.Enabled = True
-                self.button_merge_all.Enabled = True
-            guibase.status("Opened %s and %s.", self.db1, self.db2)
-            self.page_merge_all.Layout()
-            self.Refresh()
-            wx.CallAfter(self.update_tabheader)
 
+        self.button_swap.Enabled = True
+        self.button_merge_chats.Enabled = True
+        if not self.is_scanned:
+            self.button_scan_all.Enabled = True
+            self.button_merge_all.Enabled = True
+        guibase.status("Opened %s and %s.", self.db1, self.db2)
+        self.page_merge_all.Layout()
+        self.Refresh()
+        wx.CallAfter(self.update_tabheader)
 
 
 class ChatContentSTC(controls.SearchableStyledTextCtrl):
@@ -8688,7 +8691,8 @@ class ChatContentSTC(controls.SearchableStyledTextCtrl):
         """
         self.SetReadOnly(False) # Can't modify while read-only
         self.ClearAll()
-        self._parser = skypedata.MessageParser(self._db, self._chat, stats=True)
+        if not self._parser:
+            self._parser = skypedata.MessageParser(self._db, self._chat, stats=True)
         if self._messages:
             if self._auto_retrieve:
                 self.RetrieveMessagesIfNeeded()
@@ -8706,6 +8710,12 @@ class ChatContentSTC(controls.SearchableStyledTextCtrl):
                         break
                     index += 1
 
+            # Statistics accumulate per day, parser can be kept for
+            # new date and participant filters, but not for partial days
+            if self._filter.get("text") or self._center_message_index is not None:
+                self._parser = skypedata.MessageParser(self._db, self._chat,
+                                                       stats=True)
+
             colourmap = collections.defaultdict(lambda: "remote")
             colourmap[self._db.id] = "local"
             self._message_positions.clear()
@@ -8997,6 +9007,7 @@ class ChatContentSTC(controls.SearchableStyledTextCtrl):
 
         self._chat = chat
         self._db = db
+        self._parser = None
         self._messages_current = messages_current
         self._messages = message_range
         self._filter["daterange"] = [
@@ -9258,14 +9269,30 @@ class ChatContentSTC(controls.SearchableStyledTextCtrl):
         """
         Returns the statistics collected during last Populate(), or {}.
         """
-        return self._parser.get_collected_stats() if self._parser else {}
+        if not self._parser: return {}
+        return self._parser.get_collected_stats(*self._get_statistics_filter())
 
 
     def GetTimelineData(self):
         """
         Returns the timeline collected during last Populate(), or {}.
         """
-        return self._parser.get_timeline_stats() if self._parser else {}
+        if not self._parser: return {}
+        return self._parser.get_timeline_stats(*self._get_statistics_filter())
+
+
+    def _get_statistics_filter(self):
+        """
+        Returns current filter as (daterange, authors) for parser statistics,
+        with None for inactive filter values.
+        """
+        daterange = self._filter.get("daterange")
+        authors = self._filter.get("participants")
+        if not all(daterange or [0]): daterange = None
+        if authors and set(authors) == \
+        set(p["identity"] for p in self._chat["participants"]):
+            authors = None
+        return daterange, authors or None
 
 
     def ClearAll(self):
@@ -9,10 +9,12 @@ Released under the MIT License.
 
 @author      Erki Suurjaak
 @created     17.01.2012
-@modified    18.03.2022
+@modified    18.10.2026
 ------------------------------------------------------------------------------
 """
+import array
 import collections
+import heapq
 import re
 
 """Default language for common words."""
@@ -33,6 +35,9 @@ FONTSIZE_MAX = 7
 OPTIONS = {"COUNT_MIN": COUNT_MIN, "WORDS_MAX": WORDS_MAX,
            "FONTSIZE_MIN": FONTSIZE_MIN, "FONTSIZE_MAX": FONTSIZE_MAX}
 
+"""A map of languages and parsed common word sets, filled on first use."""
+COMMON_SETS = {}
+
 """A map of languages and common words."""
 COMMON_WORDS = {
     "en": u"""
@@ -150,27 +155,54 @@ COMMON_WORDS = {
 
 
 class GroupCounter(object):
-    """Counts words for word cloud, supports grouped subcounts."""
+    """
+    Counts words for word cloud, supports grouped subcounts.
+
+    Words are interned to integer IDs, counts are kept in compact arrays
+    per group, indexed by word ID. Counters from parallel workers can be
+    combined with merge().
+    """
 
     def __init__(self, minlen=2):
         self.minlen = minlen # Minimum length of word to count
         self.commons = None  # List of common words by auto-detected language
-        self.data = collections.defaultdict(lambda: collections.defaultdict(int))
+        self.ids = {}        # {word: word ID}
+        self.words = []      # [word, ] indexed by word ID
+        self.groups = {}     # {group: array of counts indexed by word ID}
+        # Words of minimum length, not wholly numeric
+        self.rgx = re.compile(r"(?=\w*[^\W\d])\w{%s,}" % minlen, re.U)
 
 
     def add_words(self, words, group=None):
         """Adds to group words counts."""
-        for w in words: # Drop short or wholly numeric words
-            if len(w) >= self.minlen and re.search(r"\D", w):
-                self.data[w][group] += 1
+        words = [w for w in words # Drop short or wholly numeric words
+                 if len(w) >= self.minlen and re.search(r"\D", w)]
+        self._increment(collections.Counter(words).items(), group)
 
 
     def add_text(self, text, group=None):
         """Splits the text into words and adds to group word counts."""
-        words = []
-        words = re.findall(r"\w{%s,}" % self.minlen, text.lower(), re.U)
-        words = [x for x in words if re.search(r"\D", x)] # Drop numerics
-        for w in words: self.data[w][group] += 1
+        self._increment(collections.Counter(self.split_text(text)).items(), group)
+
+
+    def add_counts(self, counts, group=None):
+        """Adds to group word counts from a {word: count} dictionary."""
+        self._increment(((w, c) for w, c in counts.items() if c), group)
+
+
+    def split_text(self, text):
+        """Returns a list of countable lowercase words in text."""
+        return self.rgx.findall(text.lower())
+
+
+    def merge(self, *others):
+        """Adds word counts from other GroupCounter instances, returns self."""
+        for other in others:
+            for group, counts in other.groups.items():
+                self._increment(((other.words[i], c) for i, c in
+                                 enumerate(counts) if c), group)
+        if others: self.commons = None
+        return self
 
 
     def counts(self, group=None, select=None):
@@ -179,11 +211,11 @@ class GroupCounter(object):
         is a list of words to choose.
         """
         result = {} # {word: count}
-        for w in self.data if select is None else select:
-            if w not in self.data or not (group and group in self.data[w]):
-                continue # for w
-            vv = self.data[w]
-            result[w] = sum(vv.values()) if group is None else vv.get(group)
+        counts = self._get_counts(group)
+        for w in self.words if select is None else select:
+            i = self.ids.get(w)
+            if i is not None and i < len(counts) and counts[i]:
+                result[w] = counts[i]
         return result
 
 
@@ -199,34 +231,61 @@ class GroupCounter(object):
         global OPTIONS
         options = dict(OPTIONS,  **(options or {}))
         if self.commons is None:
-            self.commons = find_commons(self.data)
+            self.commons = find_commons(self.ids)
+        commons = set(self.ids[w] for w in self.commons if w in self.ids)
+        limit = options["WORDS_MAX"]
 
         # Build a flattened counts dictionary
-        counts, top_counts = {}, [1]
-        for w, vv in (x for x in self.data.items() if x[0] not in self.commons):
-            count = sum(vv.values()) if group is None else vv.get(group)
-            if not count: continue # for w, vv
-            counts[w] = count
-            # Keep a tally of biggest counts for later filtering and sizing
-            top_counts.append(count); top_counts.sort(reverse=True)
-            top_counts[:] = top_counts[:options["WORDS_MAX"]]
+        counts = dict((i, c) for i, c in enumerate(self._get_counts(group))
+                      if c and i not in commons)
+        # Find biggest counts for later filtering and sizing
+        top_counts = [1] + list(counts.values())
+        if limit > 0: top_counts = heapq.nlargest(limit, top_counts)
+        else: top_counts.sort(reverse=True)
 
         # Build result list, dropping words under minimum count
         count_min = max(options["COUNT_MIN"], top_counts[-1])
         count_max = options.get("SCALE") or top_counts[0]
         result, sizes = [], {} # sizes: {count: calculated font size}
-        for word, count in counts.items():
-            if count < count_min: continue # for word, count
+        for i, count in counts.items():
+            if count < count_min: continue # for i, count
             if count not in sizes:
                 sizes[count] = get_size(count, count_min, count_max, options)
-            result.append((word, count, sizes[count]))
+            result.append((self.words[i], count, sizes[count]))
 
         # Sort final result by (count, name) and trim to given limit
-        result.sort(key=lambda x: (-x[1], x[0]))
-        if options["WORDS_MAX"] > 0: result = result[:options["WORDS_MAX"]]
+        sortkey = lambda x: (-x[1], x[0])
+        if limit > 0: result = heapq.nsmallest(limit, result, key=sortkey)
+        else: result.sort(key=sortkey)
         return result
 
 
+    def _get_counts(self, group=None):
+        """Returns counts array of group, or summed array if group not given."""
+        if group is not None:
+            return self.groups.get(group, ())
+        result = array.array("l", [0]) * len(self.words)
+        for counts in self.groups.values():
+            for i, c in enumerate(counts):
+                if c: result[i] += c
+        return result
+
+
+    def _increment(self, items, group=None):
+        """Adds (word, count) items to group counts."""
+        ids, words = self.ids, self.words
+        counts = self.groups.get(group)
+        if counts is None: counts = self.groups[group] = array.array("l")
+        for w, c in items:
+            i = ids.get(w)
+            if i is None:
+                i = ids[w] = len(words)
+                words.append(w)
+            if i >= len(counts):
+                counts.extend([0] * (len(words) - len(counts)))
+            counts[i] += c
+
+
 
 def get_size(count, count_min, count_max, options):
     """
@@ -255,11 +314,100 @@ def find_commons(words):
     """
     global COMMON_WORDS
     result = []
-    words = set(words)
-    for commontext in COMMON_WORDS.values():
-        allcommons = set(re.findall(r"\w+", commontext, re.UNICODE))
-        matches = allcommons & words
+    if not isinstance(words, (set, dict)): words = set(words)
+    for lang, commontext in COMMON_WORDS.items():
+        if lang not in COMMON_SETS:
+            COMMON_SETS[lang] = set(re.findall(r"\w+", commontext, re.UNICODE))
+        matches = set(w for w in COMMON_SETS[lang] if w in words)
         if len(matches) > len(result):
             result = matches
 
     return result
+
+
+
+if "__main__" == __name__:
+    import bisect
+    import random
+    import sys
+    import time
+    try: import tracemalloc
+    except ImportError: tracemalloc = None # Py2
+
+    class DictCounter(object):
+        """Previous dict-based word counter, for comparison."""
+
+        def __init__(self, minlen=2):
+            self.minlen, self.commons = minlen, None
+            self.data = collections.defaultdict(lambda: collections.defaultdict(int))
+
+        def add_text(self, text, group=None):
+            words = re.findall(r"\w{%s,}" % self.minlen, text.lower(), re.U)
+            words = [x for x in words if re.search(r"\D", x)] # Drop numerics
+            for w in words: self.data[w][group] += 1
+
+        def cloud(self, group=None, options=None):
+            options = dict(OPTIONS,  **(options or {}))
+            if self.commons is None:
+                self.commons = find_commons(self.data)
+            counts, top_counts = {}, [1]
+            for w, vv in (x for x in self.data.items() if x[0] not in self.commons):
+                count = sum(vv.values()) if group is None else vv.get(group)
+                if not count: continue # for w, vv
+                counts[w] = count
+                top_counts.append(count); top_counts.sort(reverse=True)
+                top_counts[:] = top_counts[:options["WORDS_MAX"]]
+            count_min = max(options["COUNT_MIN"], top_counts[-1])
+            count_max = options.get("SCALE") or top_counts[0]
+            result, sizes = [], {}
+            for word, count in counts.items():
+                if count < count_min: continue # for word, count
+                if count not in sizes:
+                    sizes[count] = get_size(count, count_min, count_max, options)
+                result.append((word, count, sizes[count]))
+            result.sort(key=lambda x: (-x[1], x[0]))
+            return result[:options["WORDS_MAX"]]
+
+    MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    GROUPS, VOCABULARY = 8, 50000
+    random.seed(1)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = COMMON_WORDS["en"].split() + [
+        "".join(random.choice(letters) for _ in range(random.randint(2, 12)))
+        for _ in range(VOCABULARY)
+    ]
+    weights = [1. / (i + 1) for i in range(len(vocabulary))] # Zipf-like
+    cumulative = [sum(weights[:1])]
+    for w in weights[1:]: cumulative.append(cumulative[-1] + w)
+    pick = lambda: vocabulary[min(len(vocabulary) - 1, bisect.bisect(
+                              cumulative, random.random() * cumulative[-1]))]
+    texts = [" ".join(pick() for _ in range(random.randint(3, 30))) + " %s" % i
+             for i in range(MESSAGES)]
+    groups = [random.randint(1, GROUPS) for _ in texts]
+
+    print("Counting words in %s messages for %s groups." % (MESSAGES, GROUPS))
+    results = {}
+    for cls in (DictCounter, GroupCounter):
+        tracemalloc and tracemalloc.start()
+        t1 = time.time()
+        counter = cls()
+        for text, group in zip(texts, groups): counter.add_text(text, group)
+        t2 = time.time()
+        clouds = [counter.cloud()] + [counter.cloud(g) for g in range(1, GROUPS + 1)]
+        t3 = time.time()
+        memory = tracemalloc.get_traced_memory()[0] if tracemalloc else None
+        tracemalloc and tracemalloc.stop()
+        results[cls] = clouds
+        print("%-12s  counting %.3fs  clouds %.3fs  memory %s" % (cls.__name__,
+              t2 - t1, t3 - t2, "%.1f MB" % (memory / 2.**20) if memory else "n/a"))
+    print("Results identical: %s" % (results[DictCounter] == results[GroupCounter]))
+
+    t1 = time.time()
+    parts = [GroupCounter() for _ in range(4)]
+    for i, (text, group) in enumerate(zip(texts, groups)):
+        parts[i % len(parts)].add_text(text, group)
+    merged = parts[0].merge(*parts[1:])
+    t2 = time.time()
+    clouds = [merged.cloud()] + [merged.cloud(g) for g in range(1, GROUPS + 1)]
+    print("Merged from %s partial counters in %.3fs, identical: %s" %
+          (len(parts), t2 - t1, clouds == results[GroupCounter]))
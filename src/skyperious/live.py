@@ -8,7 +8,7 @@ Released under the MIT License.
 
 @author      Erki Suurjaak
 @created     08.07.2020
-@modified    02.06.2024
+@modified    18.10.2026
 ------------------------------------------------------------------------------
 """
 import collections
@@ -847,6 +847,7 @@ class SkypeLogin(object):
                 if not chats: break # while run
             elif not mychats: break # while run
 
+        if messages: self.db.update_fulltext_index()
         pargs = dict(
             message_count_new=self.sync_counts["messages_new"],
             message_count_updated=self.sync_counts["messages_updated"],
@@ -9,7 +9,7 @@ Released under the MIT License.
 
 @author      Erki Suurjaak
 @created     26.11.2011
-@modified    02.06.2024
+@modified    18.10.2026
 ------------------------------------------------------------------------------
 """
 from __future__ import print_function
@@ -17,14 +17,19 @@ import argparse
 import atexit
 import codecs
 import collections
+import csv
 import datetime
 import errno
+import functools
 import getpass
 import glob
+import heapq
 import locale
 import logging
 import io
 import itertools
+import json
+import multiprocessing
 import os
 import re
 import shutil
@@ -158,6 +163,18 @@ ARGUMENTS = {
               "help": "number of matches to skip from the beginning"},
              {"args": ["--reverse"], "action": "store_true",
               "help": "find matches in reverse order"},
+             {"args": ["--order"], "choices": ["database", "time"],
+              "default": "database",
+              "help": "order of matches from several databases: "
+                      "database by database (default), "
+                      "or messages combined by time"},
+             {"args": ["--parallel"], "type": int, "metavar": "COUNT",
+              "default": conf.SearchParallelCount,
+              "help": "number of databases to search at the same time "
+                      "(default %s)" % conf.SearchParallelCount},
+             {"args": ["--index"], "action": "store_true",
+              "help": "create or update full-text index of messages before "
+                      "searching, for fast repeated message searches"},
              {"args": ["--verbose"], "action": "store_true",
               "help": "print detailed progress messages to stderr"},
              {"args": ["--config-file"], "dest": "config_file", "nargs": 1,
@@ -287,6 +304,21 @@ ARGUMENTS = {
                       "(supports * wildcards)"},
              {"args": ["-o", "--output"], "dest": "output", "required": False,
               "help": "Final database filename, auto-generated by default"},
+             {"args": ["--resume"], "action": "store_true",
+              "help": "merge into existing --output database instead of\n"
+                      "a new copy of base: continues an interrupted merge,\n"
+                      "or merges incrementally into an earlier output,\n"
+                      "skipping chats merged before and comparing only\n"
+                      "messages newer than last merge, base database\n"
+                      "included as a source for its own new messages"},
+             {"args": ["--full"], "action": "store_true",
+              "help": "with --resume, compare all messages in chats merged\n"
+                      "before, instead of only messages newer than last merge"},
+             {"args": ["--estimate", "--dry-run"], "dest": "estimate",
+              "action": "store_true",
+              "help": "sample chats and print estimated merge duration,\n"
+                      "messages to merge and output size growth,\n"
+                      "without writing anything"},
              {"args": ["--verbose"], "action": "store_true",
               "help": "print detailed progress messages to stderr"},
              {"args": ["--no-terminal"], "action": "store_true", "dest": "no_terminal",
@@ -301,6 +333,16 @@ ARGUMENTS = {
          "arguments": [
              {"args": ["FILE1"], "help": "first Skype database", "nargs": 1},
              {"args": ["FILE2"], "help": "second Skype databases", "nargs": 1},
+             {"args": ["--report"], "dest": "report", "choices": ["jsonl", "csv"],
+              "type": str.lower, "help": "write machine-readable report of "
+              "differences as they are found, in JSON lines or CSV format,\n"
+              "one row per new message or participant"},
+             {"args": ["-o", "--output"], "dest": "output", "metavar": "FILE",
+              "help": "file to write report to, defaults to standard output"},
+             {"args": ["--estimate", "--dry-run"], "dest": "estimate",
+              "action": "store_true",
+              "help": "sample chats and print estimated comparison duration\n"
+                      "and number of differing messages"},
              {"args": ["--verbose"], "action": "store_true",
               "help": "print detailed progress messages to stderr"},
              {"args": ["--no-terminal"], "action": "store_true", "dest": "no_terminal",
@@ -400,82 +442,96 @@ def install_thread_excepthook():
 
 def run_merge(filenames, args):
     """
-    Merges all Skype databases to a new database.
+    Merges all Skype databases to a new database, using the last as base
+    and merging the union of all others in one pass.
 
     @param   args       argparse.Namespace
                output   name of output database, auto-generated if not given
+               resume   whether to merge into existing output database,
+                        skipping chats merged before, with base database
+                        as one more source for changes since
+               full     whether to compare all messages in chats merged
+                        before, instead of only messages after last merge
+               estimate whether to only print estimate of merge, writing nothing
     """
+    if args.resume and not args.output:
+        output("Cannot resume merge without --output database.")
+        return
     dbs = [skypedata.SkypeDatabase(f) for f in filenames]
     db_base = dbs.pop()
-    counts = collections.defaultdict(lambda: collections.defaultdict(int))
+    if args.resume and os.path.exists(args.output) \
+    and os.path.realpath(args.output) != os.path.realpath(db_base.filename):
+        dbs.append(db_base) # Merge base changes since last merge as well
+    if args.estimate:
+        resume = args.resume and os.path.exists(args.output)
+        db2 = skypedata.SkypeDatabase(args.output) if resume else db_base
+        run_estimate(dbs, db2, {"resume": resume, "incremental": not args.full})
+        return
+    counts, skipped = [], 0 # [{"chats": .., "messages": .., "participants": ..}, ]
     postbacks = queue.Queue()
 
     name, ext = os.path.splitext(os.path.basename(db_base.filename))
     now = datetime.datetime.now().strftime("%Y%m%d")
     output_filename = args.output or util.unique_path("%s.merged.%s%s" %  (name, now, ext))
-    output("Creating %s, using %s as base." % (output_filename, db_base))
+    resume = args.resume and os.path.exists(output_filename)
+    if resume:
+        output("Resuming merge into %s." % output_filename)
+    else:
+        output("Creating %s, using %s as base." % (output_filename, db_base))
     bar = ProgressBar(static=conf.IsCLINonTerminal)
     bar.start()
-    shutil.copyfile(db_base.filename, output_filename)
+    if not resume: shutil.copyfile(db_base.filename, output_filename)
     db2 = skypedata.SkypeDatabase(output_filename)
 
-    args = {"db2": db2, "type": "diff_merge_left"}
     worker = workers.MergeThread(postbacks.put)
     bar.stop()
     try:
-        for db1 in dbs:
-            AFTER_MAX = sys.maxsize if conf.IsCLINonTerminal else 30
-            bar = ProgressBar(static=conf.IsCLINonTerminal,
-                              afterword=" Processing %s%s.." % (
-                              "..." if len(db1.filename) > AFTER_MAX else "",
-                              db1.filename[-AFTER_MAX:]))
-            bar.start()
-            chats = db1.get_conversations()
-            db1.get_conversations_stats(chats)
-            db2.get_conversations_stats(db2.get_conversations(reload=True))
-            worker.work(dict(args, db1=db1, chats=chats))
-            while True:
-                result = postbacks.get()
-                if "error" in result:
-                    output("Error merging %s:\n\n%s" % (db1, result["error"]))
-                    db1 = None # Signal for global break
-                    break # while True
-                if "done" in result:
-                    bar.value, bar.max = 100, 100
-                    break # while True
-                if "diff" in result:
-                    counts[db1]["chats"] += 1
-                    counts[db1]["msgs"] += len(result["diff"]["messages"])
-                if "index" in result:
-                    bar.max = result["count"]
-                    if not conf.IsCLINonTerminal: bar.update(result["index"])
-                if result.get("output"):
-                    logger.info(result["output"])
-            bar.stop()
-            if not db1:
-                break # for db1
-            bar.afterword = " Processed %s." % db1
-            bar.update() # Lay out full filename, probably wraps to next line
-            output() # Force linefeed for next progress bar
+        bar = ProgressBar(static=conf.IsCLINonTerminal, afterword=" Processing %s.."
+                          % util.plural("database", dbs))
+        bar.start()
+        worker.work({"type": "diff_merge_multi", "dbs": dbs, "db2": db2,
+                     "resume": resume, "incremental": not args.full})
+        while True:
+            result = postbacks.get()
+            if "error" in result:
+                output("Error merging to %s:\n\n%s" % (db2, result["error"]))
+            if "done" in result:
+                counts, skipped = result["counts"], result["skipped"]
+                bar.value, bar.max = 100, 100
+                break # while True
+            if "index" in result:
+                bar.max = result["count"]
+                if not conf.IsCLINonTerminal: bar.update(result["index"])
+            if result.get("output"):
+                logger.info(result["output"])
+        bar.stop()
+        bar.afterword = " Processed %s." % util.plural("database", dbs)
+        bar.update()
+        output() # Force linefeed after progress bar
     finally:
         worker and (worker.stop(), worker.join())
 
-    if not counts:
+    if skipped:
+        output("Skipped %s merged before." % util.plural("chat", skipped))
+    if not any(x.get("chats") for x in counts):
         output("Nothing new to merge.")
         db2.close()
-        os.unlink(output_filename)
+        if not resume: os.unlink(output_filename)
     else:
-        for db1 in dbs:
+        for db1, dbcounts in zip(dbs, counts):
             output("Merged %s in %s from %s." %
-                  (util.plural("message", counts[db1]["msgs"]),
-                   util.plural("chat", counts[db1]["chats"]), db1))
+                  (util.plural("message", dbcounts.get("messages", 0)),
+                   util.plural("chat", dbcounts.get("chats", 0)), db1))
         output("Merge into %s complete." % db2)
         db2.close()
 
 
 def run_search(filenames, args):
     """
-    Searches the specified databases for specified query.
+    Searches the specified databases for specified query, several databases
+    in parallel, printing matches in database order or in combined time order.
+    Offset and limit apply to the combined matches from all databases.
+    Matches from a single database are printed as soon as found.
 
     @param   args         argparse.Namespace
                query      search query text
@@ -483,35 +539,100 @@ def run_search(filenames, args):
                reverse    find matches in reverse order
                offset     number of matches to skip from the beginning
                limit      maximum number of matches to find
+               order      "database" or "time", the latter for messages only
+               parallel   number of databases to search at the same time
+               index      whether to create or update message full-text index
     """
     TABLES = {"message": "messages", "contact": "contacts", "chat": "conversations",
               "table": "all tables"}
     dbs = [skypedata.SkypeDatabase(f) for f in filenames]
-    postbacks = queue.Queue()
-    wargs = {"text": args.query, "reverse": args.reverse, "offset": args.offset,
-             "limit": args.limit, "table": TABLES.get(args.category, args.category),
+    offset, limit = args.offset or 0, args.limit or 0
+    wargs = {"text": args.query, "reverse": args.reverse,
+             "limit": offset + limit if limit else None,
+             "table": TABLES.get(args.category, args.category),
              "output": "text"}
-    worker = workers.SearchThread(postbacks.put)
+    if 1 == len(dbs) and "message" == args.category:
+        # Print results directly from search thread, paging in thread
+        # to serve pages from saved result sets
+        wargs.update(offset=offset, limit=limit or None,
+                     stream=SearchResultWriter())
+        offset = limit = 0
+    elif 1 == len(dbs): # Print results directly from search thread
+        wargs["stream"] = SearchResultWriter(offset, limit)
+    resultqueues = [queue.Queue() for _ in dbs] # Postbacks per database
+    pending = collections.deque(range(len(dbs))) # Indexes of dbs not started
+    assigneds = {} # {worker index: database index}
+    lock = threading.Lock()
+
+    def start_next(n):
+        """Gives worker #n the next pending database, if any."""
+        with lock:
+            if not pending: return
+            i = assigneds[n] = pending.popleft()
+        db = dbs[i]
+        if args.index and "message" == args.category:
+            logger.info("Updating full-text index of %s.", db)
+            db.create_fulltext_index()
+        logger.info('Searching "%s" in %s %s.', args.query, db, wargs["table"])
+        workerlist[n].work(dict(wargs, db=db))
+
+    def on_result(n, result):
+        """Routes result from worker #n to database queue, starts next on done."""
+        resultqueues[assigneds[n]].put(result)
+        if "done" in result: start_next(n)
+
+    def iter_results(i):
+        """Yields (database index, result) from database #i until done."""
+        while True:
+            result = resultqueues[i].get()
+            if "error" in result:
+                output("Error searching %s:\n\n%s" %
+                      (dbs[i], result.get("error_short", result["error"])))
+                break # while True
+            if "done" in result:
+                logger.info("Finished searching for \"%s\" in %s %s.",
+                            args.query, dbs[i], wargs["table"])
+                break # while True
+            yield i, result
+
+    def iter_by_time():
+        """Yields (database index, result) from all databases, merged by time."""
+        heap, iterators = [], [iter_results(i) for i in range(len(dbs))]
+        def push(i):
+            item = next(iterators[i], None)
+            if not item: return
+            data = next(iter(item[1]["map"].values()), {})
+            stamp = data.get("timestamp") or 0
+            heapq.heappush(heap, (stamp if args.reverse else -stamp, i, item))
+        for i in range(len(dbs)): push(i)
+        while heap:
+            _, i, item = heapq.heappop(heap)
+            yield item
+            push(i)
+
+    count = min(max(1, args.parallel or 1), len(dbs))
+    workerlist = [workers.SearchThread(functools.partial(on_result, n))
+                  for n in range(count)]
     try:
-        for db in dbs:
-            logger.info('Searching "%s" in %s %s.', args.query, db, wargs["table"])
-            worker.work(dict(wargs, db=db))
-            while True:
-                result = postbacks.get()
-                if "error" in result:
-                    output("Error searching %s:\n\n%s" %
-                          (db, result.get("error_short", result["error"])))
-                    break # while True
-                if "done" in result:
-                    logger.info("Finished searching for \"%s\" in %s %s.",
-                                args.query, db, wargs["table"])
-                    break # while True
-                if result.get("count", 0) or conf.IsCLIVerbose:
-                    if len(dbs) > 1:
-                        output("%s:" % db, end=" ")
-                    output(result["output"])
+        for n in range(count): start_next(n)
+        if "time" == args.order and "message" == args.category:
+            results = iter_by_time()
+        else:
+            results = itertools.chain.from_iterable(map(iter_results, range(len(dbs))))
+        index = 0
+        for i, result in results:
+            if not result.get("count", 0) and not conf.IsCLIVerbose:
+                continue # for i, result
+            index += 1
+            if index <= offset:
+                continue # for i, result
+            if len(dbs) > 1:
+                output("%s:" % dbs[i], end=" ")
+            output(result["output"])
+            if limit and index >= offset + limit:
+                break # for i, result
     finally:
-        worker and (worker.stop(), worker.join())
+        for worker in workerlist: worker.stop(), worker.join()
 
 
 def run_sync(filenames, args):
@@ -978,12 +1099,24 @@ def run_contacts(filenames, args):
                   (e, traceback.format_exc()))
 
 
-def run_diff(filename1, filename2):
-    """Compares the first database for changes with the second."""
+def run_diff(filenames, args):
+    """
+    Compares the first database for changes with the second.
+
+    @param   args  argparse.Namespace, with report format and output filename
+                   if writing a report of differences, standard output if none,
+                   and estimate flag to only print estimate of comparison
+    """
+    filename1, filename2 = filenames[:2]
     if os.path.realpath(filename1) == os.path.realpath(filename2):
         output("Error: cannot compare %s with itself." % filename1)
         return
     db1, db2 = map(skypedata.SkypeDatabase, [filename1, filename2])
+    if args.estimate:
+        run_estimate([db1], db2, {"parallel": True}, merge=False)
+        return
+    report = DiffReportWriter(db1, args.report, args.output) if args.report else None
+    quiet = report and not args.output # Report in standard output: no progress
     counts = collections.defaultdict(lambda: collections.defaultdict(int))
     postbacks = queue.Queue()
 
@@ -993,15 +1126,15 @@ def run_diff(filename1, filename2):
                                              "..." if len(db2.filename) > AFTER_MAX else "",
                                              db2.filename[-AFTER_MAX:])
     bar = ProgressBar(afterword=bar_text, static=conf.IsCLINonTerminal)
-    bar.start()
+    if not quiet: bar.start()
     chats1, chats2 = db1.get_conversations(), db2.get_conversations()
     db1.get_conversations_stats(chats1), db2.get_conversations_stats(chats2)
 
-    args = {"db1": db1, "db2": db2, "chats": chats1, "type": "diff_left"}
+    wargs = {"db1": db1, "db2": db2, "chats": chats1, "type": "diff_left"}
     worker = workers.MergeThread(postbacks.put)
-    if conf.IsCLINonTerminal: output()
+    if conf.IsCLINonTerminal and not quiet: output()
     try:
-        worker.work(args)
+        worker.work(wargs)
         TITLE_MAX = sys.maxsize if conf.IsCLINonTerminal else 25
         while True:
             result = postbacks.get()
@@ -1026,17 +1159,21 @@ def run_diff(filename1, filename2):
                 if new_chat: title += " - new chat"
                 bar.afterword = " %s." % ", ".join(filter(bool, [title, text]))
                 counts[db1]["msgs"] += msgs
+                if report: report.write_chat(**result["chats"][0])
             if "index" in result:
                 bar.max = result["count"]
-                if not conf.IsCLINonTerminal: bar.update(result["index"])
+                if not conf.IsCLINonTerminal and not quiet: bar.update(result["index"])
             if result.get("output"):
-                if not conf.IsCLINonTerminal: output() # Push bar to next line
+                if quiet: pass
+                elif not conf.IsCLINonTerminal: output() # Push bar to next line
                 elif result.get("chats"): bar.update()
                 logger.info(result["output"])
                 bar.afterword = ""
     finally:
         worker and (worker.stop(), worker.join())
+        report and report.close()
 
+    if quiet: return
     bar.stop()
     if conf.IsCLINonTerminal: output()
     bar.afterword = " Scanned %s and %s." % (db1, db2)
@@ -1044,6 +1181,75 @@ def run_diff(filename1, filename2):
     output()
 
 
+def run_estimate(dbs, db2, params, merge=True):
+    """
+    Samples chats in databases on the left against the database on the right,
+    and prints estimated duration, messages to merge and output size growth,
+    extrapolated from parse and diff throughput measured on this machine.
+    Writes nothing.
+
+    @param   params  additional parameters for estimate worker,
+                     like {"incremental": True}
+    @param   merge   whether estimating merge or only comparison
+    """
+    estimates, postbacks = [], queue.Queue()
+    bar = ProgressBar(static=conf.IsCLINonTerminal, afterword=" Sampling %s.."
+                      % util.plural("database", dbs + [db2]))
+    bar.start()
+    worker = workers.MergeThread(postbacks.put)
+    try:
+        worker.work(dict(params, type="estimate", dbs=dbs, db2=db2))
+        while True:
+            result = postbacks.get()
+            if "error" in result:
+                output("Error estimating %s:\n\n%s" % (db2, result["error"]))
+            if "done" in result:
+                estimates = result["estimates"]
+                break # while True
+            if "index" in result:
+                bar.max = result["count"]
+                if not conf.IsCLINonTerminal: bar.update(result["index"])
+            if result.get("output"):
+                logger.info(result["output"])
+        bar.stop()
+        bar.afterword = " Sampled %s." % util.plural("database", dbs + [db2])
+        bar.update(bar.max)
+        output() # Force linefeed after progress bar
+    finally:
+        worker and (worker.stop(), worker.join())
+
+    for db1, estimate in zip(dbs, estimates):
+        output("%s vs %s:" % (db1, db2))
+        text = "  %s to %s" % (util.plural("chat", estimate["chats"]),
+                               "merge" if merge else "compare")
+        if estimate["new_chats"]:
+            text += ", %s new" % estimate["new_chats"]
+        if estimate["skipped"]:
+            text += ", %s merged before" % util.plural("chat", estimate["skipped"])
+        output("%s, sampled %s." % (text, estimate["sampled"]))
+        output("  %s to scan, %s to parse, ~%s %s." % (
+               util.plural("message", estimate["messages"]),
+               util.plural("message", estimate["parsed"]),
+               util.plural("message", estimate["inserts"]),
+               "to merge" if merge else "differing"))
+        duration = util.format_seconds(estimate["seconds"]) \
+                   if estimate["seconds"] >= 1 else "under a second"
+        text = "  Estimated duration %s" % duration
+        if merge:
+            text += ", output growing by ~%s" % util.format_bytes(estimate["bytes"])
+        output(text + ".")
+    if merge and len(estimates) > 1:
+        seconds = sum(x["seconds"] for x in estimates)
+        output("Total: ~%s to merge, estimated duration %s, output growing by ~%s. "
+               "Messages common to several sources are merged once, "
+               "making totals an upper bound." % (
+               util.plural("message", sum(x["inserts"] for x in estimates)),
+               util.format_seconds(seconds) if seconds >= 1 else "under a second",
+               util.format_bytes(sum(x["bytes"] for x in estimates))))
+    if merge:
+        output("Duration excludes writing to disk. Nothing was written.")
+
+
 def run_gui(filenames):
     """Main GUI program entrance."""
     global logger, window
@@ -1081,6 +1287,7 @@ def run(nogui=False):
     global is_gui_possible, logger
 
     warnings.simplefilter("ignore", UnicodeWarning)
+    if conf.Frozen: multiprocessing.freeze_support() # For diff process pool
 
     if (conf.Frozen # Binary application
     or sys.executable.lower().endswith("pythonw.exe")):
@@ -1157,7 +1364,7 @@ def run(nogui=False):
     if "create" == arguments.command:
         run_create(arguments.FILE, arguments)
     elif "diff" == arguments.command:
-        run_diff(*arguments.FILE)
+        run_diff(arguments.FILE1 + arguments.FILE2, arguments)
     elif "merge" == arguments.command:
         if len(arguments.FILE) < 2:
             output("%s%s merge: error: too few FILE arguments" % (
@@ -1391,6 +1598,108 @@ class ProgressBar(threading.Thread):
         self.is_running = False
 
 
+
+class SearchResultWriter(object):
+    """
+    Output stream for search thread, printing each written search result
+    directly to standard output, skipping results outside offset and limit.
+    """
+
+    def __init__(self, offset=0, limit=0):
+        """
+        @param   offset  number of results to skip from the beginning
+        @param   limit   maximum number of results to print, 0 for unlimited
+        """
+        self.offset, self.limit = offset, limit
+        self.count = 0 # Number of results written so far
+
+
+    def write(self, text):
+        """Prints text as the next search result, if within offset and limit."""
+        self.count += 1
+        if self.count <= self.offset \
+        or self.limit and self.count > self.offset + self.limit:
+            return
+        try: output(text)
+        except SystemExit: # Raised on closed output, signal search thread
+            raise IOError(errno.EPIPE, "Output closed")
+
+
+class DiffReportWriter(object):
+    """
+    Writes chat differences as a machine-readable report, in JSON lines or CSV,
+    one row per new message or participant, as each chat diff arrives.
+    """
+
+    """Report columns, in order."""
+    FIELDS = ["chat", "title", "new_chat", "type", "id", "timestamp",
+              "datetime", "author", "identity"]
+
+
+    def __init__(self, db, format, filename=None):
+        """
+        @param   db        SkypeDatabase the new messages are in
+        @param   format    "jsonl" or "csv"
+        @param   filename  report file to write, standard output if None
+        """
+        self._db, self._format, self._file = db, format, None
+        if filename:
+            self._file = open(filename, "wb") if six.PY2 else \
+                         io.open(filename, "w", encoding="utf-8", newline="")
+        if "csv" == format:
+            self._buffer = io.BytesIO() if six.PY2 else io.StringIO()
+            self._csv = csv.writer(self._buffer, lineterminator="\n")
+            self.write_row(dict(zip(self.FIELDS, self.FIELDS)))
+
+
+    def write_chat(self, chat, diff):
+        """
+        Writes rows for chat differences, querying new messages in chunks.
+
+        @param   chat  chat data as posted by MergeThread, with "c2" None if new
+        @param   diff  {"messages": [message IDs], "participants": [participants]}
+        """
+        base = {"chat": chat["identity"], "title": chat["title"],
+                "new_chat": not chat["c2"]}
+        for p in diff["participants"]:
+            contact = p.get("contact") or {}
+            self.write_row(dict(base, type="participant", identity=p["identity"],
+                                author=contact.get("name") or p["identity"]))
+        for m in self._db.message_iterator(diff["messages"]):
+            dt = self._db.stamp_to_date(m["timestamp"]) if m["timestamp"] else None
+            self.write_row(dict(base, type="message", id=m["id"],
+                                timestamp=m["timestamp"], identity=m["author"],
+                                datetime=dt.strftime("%Y-%m-%d %H:%M:%S") if dt else None,
+                                author=m["from_dispname"] or m["author"]))
+
+
+    def write_row(self, row):
+        """Writes a single report row, as {field: value}."""
+        values = [row.get(k) for k in self.FIELDS]
+        if "csv" == self._format:
+            if six.PY2:
+                values = [v.encode("utf-8") if isinstance(v, six.text_type) else v
+                          for v in values]
+            self._csv.writerow(["" if v is None else v for v in values])
+            text = self._buffer.getvalue()
+            self._buffer.seek(0), self._buffer.truncate()
+        else:
+            text = json.dumps(collections.OrderedDict(zip(self.FIELDS, values))) + "\n"
+        if self._file: self._file.write(text)
+        else:
+            try: output(text, end="")
+            except IOError as e:
+                if e.errno != errno.EPIPE: raise
+                sys.exit() # Stop scanning if output pipe closed
+
+
+    def close(self):
+        """Closes report file, if any."""
+        self._file and self._file.close()
+        self._file = None
+
+
+
 def win32_unicode_argv(argv):
     # @from http://stackoverflow.com/a/846931/145400
     result = argv
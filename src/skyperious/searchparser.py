@@ -12,8 +12,20 @@ Parses a simple search grammar into SQL for querying a Skype database.
   date:year[-month[-day]][..year[-month[-day]]],
   value can be in quotes, e.g. chat:"link chat". Keywords are global, ignoring
   all groups and OR-expressions.
+- keyword regex:pattern matches message body (or table fields) against
+  a case-insensitive regular expression, e.g. regex:"\\d{3}-\\d{4}"
+- keyword fuzzy:word matches words within a small edit distance,
+  one edit for words up to 7 characters, two for longer words
+- regex and fuzzy matching is done in SQLite, via functions REGEXP and
+  FUZZY_MATCH registered on database connection
 - "-" immediately before: exclude words, phrases, grouped words and keywords
 - can also provide queries to search all fields in any table
+- grammar is built once per process, parsed queries are cached by query text,
+  so the same query can be turned into SQL for many tables with one parse
+- message text can be matched against an FTS5 full-text index instead of LIKE,
+  where the query is expressible in FTS5: words match as token prefixes
+- can check whether a query is a strict refinement of a previous one,
+  matching only a subset of its results, like "meet" and "meeting"
 
 If pyparsing is unavailable, falls back to naive split into words and keywords.
 
@@ -23,13 +35,14 @@ Released under the MIT License.
 
 @author      Erki Suurjaak
 @created     13.07.2013
-@modified    02.10.2022
+@modified    18.10.2026
 """
 import calendar
 import collections
 import datetime
 import re
 import string
+import threading
 import warnings
 
 try:
@@ -55,11 +68,48 @@ ESCAPE_CHAR = "\\" # Character used to escape SQLite special characters like _%
 class SearchQueryParser(object):
 
     # For naive identification of "chat:xyz", "from:xyz" etc keywords
-    PATTERN_KEYWORD = re.compile("^(-?)(chat|from|date|table)\\:([^\\s]+)$", re.I)
+    PATTERN_KEYWORD = re.compile("^(-?)(chat|date|from|fuzzy|regex|table)\\:([^\\s]+)$", re.I)
+
+    # Recognized keywords, also usable negated with "-" in front
+    KEYWORDS = ["chat", "date", "from", "fuzzy", "regex", "table"]
+
+    # Keywords matching message body, or any field in table search
+    MATCH_KEYWORDS = ["fuzzy", "regex"]
+
+    # Words up to this length match with one edit in fuzzy:, longer with two
+    FUZZY_SHORT_LENGTH = 7
+
+    # For checking whether text contains anything for FTS to tokenize
+    PATTERN_FTS_TOKEN = re.compile("\\w", re.U)
+
+    # For checking whether text is a single FTS token
+    PATTERN_FTS_WORD = re.compile("^\\w+$", re.U)
+
+    # For lowercasing ASCII letters only, like SQLite LIKE is case-insensitive
+    PATTERN_ASCII_UPPER = re.compile("[A-Z]+")
+
+    # Maximum number of parsed queries to keep in cache
+    CACHE_SIZE = 100
+
+    # Query grammar, shared by all parser instances
+    _grammar = None
+
+    # Parsed queries, as {query: (parse results, {keyword: [value, ]})}
+    _cache = collections.OrderedDict()
+
+    # Guards building grammar and accessing cache
+    _lock = threading.RLock()
 
 
     def __init__(self):
         if not ParserElement: return
+        with self._lock:
+            if SearchQueryParser._grammar is None:
+                SearchQueryParser._grammar = self._makeGrammar()
+
+
+    def _makeGrammar(self):
+        """Returns the query grammar as pyparsing element."""
         with warnings.catch_warnings():
             # In Python 2.6, pyparsing throws warnings on its own code.
             warnings.simplefilter("ignore")
@@ -101,42 +151,37 @@ class SearchQueryParser(object):
                 + Suppress(")")).setResultsName("PARENTHESIS")
             grammar <<= ((oneExpr + grammar) | oneExpr
                         ).setResultsName("GRAMMAR")
-            self._grammar = grammar
+        return grammar
 
 
-    def Parse(self, query, table=None):
+    def Parse(self, query, table=None, fulltext=None):
         """
         Parses the query string and returns (sql, sql params, words).
 
-        @param   table  if set, search is performed on all the fields of this
-                        specific table, ignoring all Skype-specific keywords,
-                        only taking into account the table: keyword
-                        {"name": "Table name": "columns[{"name", "pk_id", }, ]}
-        @return         (SQL string, SQL parameter dict, word and phrase list)
+        @param   table     if set, search is performed on all the fields of this
+                           specific table, ignoring all Skype-specific keywords,
+                           only taking into account the table: keyword
+                           {"name": "Table name": "columns[{"name", "pk_id", }, ]}
+        @param   fulltext  name of FTS5 table indexing message text by message ID,
+                           if any, to match query text against instead of LIKE;
+                           ignored if query is not expressible in FTS5
+        @return            (SQL string, SQL parameter dict, word and phrase list)
         """
         words = [] # All encountered text words and quoted phrases
         keywords = collections.defaultdict(list) # {"from": [], "chat": [], ..}
         sql_params = {} # Parameters for SQL query {"body_like0": "%word%", ..}
 
-        try:
-            parse_results = self._grammar.parseString(query, parseAll=True)
-        except Exception:
-            # Grammar parsing failed: do a naive parsing into keywords and words
-            split_words = query.split()
-
-            for word in split_words[:]:
-                if self.PATTERN_KEYWORD.match(word):
-                    _, negation, key, value, _ = self.PATTERN_KEYWORD.split(word)
-                    key = negation + key
-                    keywords[key.lower()].append(value)
-                    split_words.remove(word)
-            try:
-                parse_results = ParseResults(split_words)
-            except NameError: # pyparsing.ParseResults not available
-                parse_results = split_words
+        parse_results, parse_keywords = self._parseQuery(query)
+        for key, values in parse_keywords.items(): keywords[key].extend(values)
 
         result = self._makeSQL(parse_results, words, keywords, sql_params,
                               table=table)
+        fts = fulltext and not table and self._makeFTS(parse_results)
+        if fts and fts[0]:
+            sql_params.clear() # Drop LIKE parameters, keywords not made yet
+            sql_params["fts_match"] = fts[0]
+            result = "m.id %sIN (SELECT rowid FROM %s WHERE %s MATCH :fts_match)" % \
+                     ("NOT " if fts[1] else "", fulltext, fulltext.split(".")[-1])
         if table:
             skip_table = False
             for kw, values in keywords.items():
@@ -144,7 +189,12 @@ class SearchQueryParser(object):
                 or ("-table" == kw and table["name"].lower() in values):
                     skip_table = True
                     break # break for kw, value in keywords.items()
-            if skip_table:
+            if not skip_table:
+                columns = ["%s.%s" % (table["name"], c["name"])
+                           for c in table["columns"]]
+                kw_sql = self._makeKeywordsSQL(keywords, sql_params, columns)
+                result = self._join_strings([result, kw_sql])[0]
+            if skip_table or not result:
                 result = ""
             else:
                 result = "SELECT * FROM %s WHERE %s" % (table["name"], result)
@@ -156,12 +206,130 @@ class SearchQueryParser(object):
             if "table" in keywords: del keywords["table"]
             if "-table" in keywords: del keywords["-table"]
             kw_sql = self._makeKeywordsSQL(keywords, sql_params)
-        if not table and kw_sql:
-            result = "%s%s" % ("%s AND " % result if result else "", kw_sql)
+            result = self._join_strings([result, kw_sql])[0]
 
         return result, sql_params, words
 
 
+    def _parseQuery(self, query):
+        """
+        Returns the query parsed with grammar, from cache if available,
+        as (ParseResults or word list, {keyword: [value, ]}), the latter
+        populated only if grammar parsing failed.
+        """
+        with self._lock:
+            if query in self._cache: # Re-insert as most recently used
+                self._cache[query] = self._cache.pop(query)
+                return self._cache[query]
+
+        keywords = {}
+        try:
+            parse_results = self._grammar.parseString(query, parseAll=True)
+        except Exception:
+            # Grammar parsing failed: do a naive parsing into keywords and words
+            split_words = query.split()
+
+            for word in split_words[:]:
+                if self.PATTERN_KEYWORD.match(word):
+                    _, negation, key, value, _ = self.PATTERN_KEYWORD.split(word)
+                    key = negation + key
+                    keywords.setdefault(key.lower(), []).append(value)
+                    split_words.remove(word)
+            try:
+                parse_results = ParseResults(split_words)
+            except NameError: # pyparsing.ParseResults not available
+                parse_results = split_words
+
+        with self._lock:
+            self._cache[query] = (parse_results, keywords)
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return parse_results, keywords
+
+
+    def IsRefinement(self, query, previous, fulltext=False):
+        """
+        Returns whether query is a strict refinement of previous query,
+        i.e. can only match a subset of what previous query matched:
+        both are plain conjunctions of words and phrases without wildcards,
+        query has the same keywords as previous plus any new ones,
+        and every word or phrase of previous is contained in some word
+        or phrase of query, like "meet" in "meeting".
+
+        @param   fulltext  whether queries are matched against a full-text
+                           index, where words match as token prefixes
+        """
+        terms1, keywords1 = self._getConjunction(previous) or (None, None)
+        terms2, keywords2 = self._getConjunction(query) or (None, None)
+        if terms1 is None or terms2 is None:
+            return False
+        if any(keywords2.get(k) != v for k, v in keywords1.items()):
+            return False
+
+        if fulltext:
+            # Words match as prefixes only if whole queries are in FTS
+            fts = all(self._makeFTS(self._parseQuery(x)[0])
+                      for x in (query, previous))
+            contains = lambda a, b: a.lower() == b.lower() or fts and \
+                       self.PATTERN_FTS_WORD.match(a) and \
+                       self.PATTERN_FTS_WORD.match(b) and \
+                       a.lower().startswith(b.lower())
+        else:
+            fold = lambda x: self.PATTERN_ASCII_UPPER.sub(
+                             lambda m: m.group(0).lower(), x)
+            contains = lambda a, b: fold(b) in fold(a)
+        return all(any(contains(t2, t1) for t2 in terms2) for t1 in terms1)
+
+
+    def GetKeywords(self, query):
+        """
+        Returns the keywords in query, as {keyword: [value, ]},
+        keywords in lowercase like "from" or "-table".
+        """
+        parse_results, parse_keywords = self._parseQuery(query)
+        keywords = collections.defaultdict(list)
+        for key, values in parse_keywords.items(): keywords[key].extend(values)
+        self._makeSQL(parse_results, [], keywords, {})
+        return dict(keywords)
+
+
+    def _getConjunction(self, query):
+        """
+        Returns the query as ([word or phrase, ], {keyword: set(values)})
+        if query contains only words, phrases, keywords and non-negated
+        groups of the same, without wildcards, else None.
+        """
+        parse_results, parse_keywords = self._parseQuery(query)
+        terms, keywords = [], collections.defaultdict(set)
+        for key, values in parse_keywords.items(): keywords[key].update(values)
+
+        def collect(item, parent_name=None):
+            if isinstance(item, six.string_types):
+                if "*" in item and "QUOTES" != parent_name:
+                    return False
+                terms.append(item)
+                return True
+            elements = item
+            name = hasattr(item, "getName") and item.getName()
+            if name in ["NOT", "OR_OPERAND", "OR_EXPRESSION"]:
+                return False
+            if "KEYWORD" == name:
+                key, word = elements[0].split(":", 1)
+                if re.sub("^-", "", key.lower()) in self.KEYWORDS:
+                    keywords[key.lower()].add(word)
+                    return True
+            elif "PARENTHESIS" == name:
+                name_elem0 = getattr(elements[0], "getName", lambda: "")()
+                if len(elements) and "NOT_PARENTHESIS" == name_elem0:
+                    if elements[0]: return False
+                    elements = elements[1:] # Drop the optional "-" in front
+            elif "QUOTES" == name:
+                elements = self._flatten(elements)
+            return all(collect(x, name) for x in elements)
+
+        return (terms, dict(keywords)) if collect(parse_results) else None
+
+
     def _makeSQL(self, item, words, keywords, sql_params,
                 table=None, parent_name=None):
         """
@@ -192,8 +360,7 @@ class SearchQueryParser(object):
             negation = ("NOT" == name)
             if "KEYWORD" == name:
                 key, word = elements[0].split(":", 1)
-                if key.lower() in ["from", "-from", "chat", "-chat", "date", "-date",
-                                   "table", "-table"]:
+                if re.sub("^-", "", key.lower()) in self.KEYWORDS:
                     keywords[key.lower()].append(word)
                     do_recurse = False
             elif "PARENTHESIS" == name:
@@ -217,20 +384,92 @@ class SearchQueryParser(object):
         return result
 
 
-    def _makeKeywordsSQL(self, keywords, sql_params):
+    def _makeFTS(self, item, parent_name=None):
+        """
+        Returns the ParseResults item as an FTS5 MATCH expression, as
+        (expression, whether expression is to be excluded), or None if item
+        is not expressible in FTS5, like words with inner wildcards
+        or OR-expressions with negations. Keywords yield empty expressions.
+        """
+        result = ("", False)
+        if isinstance(item, six.string_types):
+            text = item if "QUOTES" == parent_name else item.rstrip("*")
+            if "*" in text or not self.PATTERN_FTS_TOKEN.search(text):
+                return None
+            # Match tokens as prefixes, like LIKE matches words within words
+            result = ('"%s"*' % text.replace('"', '""'), False)
+        else:
+            elements = item
+            name = hasattr(item, "getName") and item.getName()
+            negation = ("NOT" == name)
+            if "KEYWORD" == name:
+                key, word = elements[0].split(":", 1)
+                if re.sub("^-", "", key.lower()) in self.KEYWORDS:
+                    return result
+            elif "PARENTHESIS" == name:
+                name_elem0 = getattr(elements[0], "getName", lambda: "")()
+                if len(elements) and "NOT_PARENTHESIS" == name_elem0:
+                    negation = bool(elements[0])
+                    elements = elements[1:] # Drop the optional "-" in front
+            elif "QUOTES" == name:
+                elements = self._flatten(elements)
+            parsed_elements = []
+            for i in elements:
+                parsed = self._makeFTS(i, name)
+                if parsed is None: return None
+                if parsed[0]: parsed_elements.append(parsed)
+            if name in ["OR_OPERAND", "OR_EXPRESSION"]:
+                if any(x for _, x in parsed_elements): return None
+                exprs = [x for x, _ in parsed_elements]
+                result = (self._join_strings(exprs, " OR ")[0], False)
+            else:
+                includes = [x for x, n in parsed_elements if not n]
+                excludes = [x for x, n in parsed_elements if n]
+                if includes: # FTS5 NOT is binary: a AND b NOT c NOT d
+                    expr = self._join_strings(includes)[0]
+                    result = (" NOT ".join([expr] + excludes), False)
+                elif excludes: # -a -b as -(a OR b)
+                    result = (self._join_strings(excludes, " OR ")[0], True)
+            if len(parsed_elements) > 1:
+                result = ("(%s)" % result[0], result[1])
+            if negation and result[0]:
+                result = (result[0], not result[1])
+        return result
+
+
+    def _makeKeywordsSQL(self, keywords, sql_params, columns=None):
         """
         Returns the keywords as an SQL string, appending SQL parameter values
         to argument dictionary.
+
+        @param   columns  if set, only regex: and fuzzy: keywords are used,
+                          matching any of these columns instead of message body
         """
         result = ""
         for keyword, words in keywords.items():
+            if columns and keyword.lstrip("-") not in self.MATCH_KEYWORDS:
+                continue # for keyword, words
             kw_sql = ""
             for word in words:
                 param = add_escape = ""
                 escaped = self._escape(word)
                 if len(escaped) > len(word):
                     add_escape = " ESCAPE '%s'" % ESCAPE_CHAR
-                if keyword.endswith("from") or keyword.endswith("chat"):
+                if keyword.endswith("regex") or keyword.endswith("fuzzy"):
+                    fields = columns or ["m.body_xml"]
+                    if keyword.endswith("regex"):
+                        try: re.compile(word)
+                        except re.error: word = re.escape(word) # Match as text
+                        param = "regex%s" % len(sql_params)
+                        items = ["%s REGEXP :%s" % (f, param) for f in fields]
+                    else:
+                        distance = 1 if len(word) <= self.FUZZY_SHORT_LENGTH else 2
+                        param = "fuzzy%s" % len(sql_params)
+                        items = ["FUZZY_MATCH(:%s, %s, %s)" % (param, f, distance)
+                                 for f in fields]
+                    sql = " OR ".join(items)
+                    sql_params[param] = word
+                elif keyword.endswith("from") or keyword.endswith("chat"):
                     if keyword.endswith("from"):
                         fields = ["m.author", "m.from_dispname", "cn.given_displayname",
                                   "cn.fullname", "cn.displayname", "cn.skypename",
@@ -248,12 +487,18 @@ class SearchQueryParser(object):
                     UNIX_EPOCH = datetime.date(1970, 1, 1)
                     sql = ""
                     date_words, dates = [None] * 2, [None] * 2
-                    if ".." not in word:
-                        # Single date value given: use strftime matching
-                        ymd = list(map(util.to_int, word.split("-")[:3]))
-                        while len(ymd) < 3: ymd.append(None) # Ensure 3 values
-                        if not any(ymd): # No valid values given: skip
-                            continue # continue for word in words
+                    ymd = list(map(util.to_int, word.split("-")[:3]))
+                    while len(ymd) < 3: ymd.append(None) # Ensure 3 values
+                    if ".." in word:
+                        # Date range given: use timestamp matching
+                        date_words = word.split("..", 1)
+                    elif not any(ymd): # No valid values given: skip
+                        continue # continue for word in words
+                    elif ymd[0] is not None and (ymd[1] is not None or ymd[2] is None):
+                        # Single year, month or day given: match as range
+                        date_words = [word] * 2
+                    else:
+                        # Partial date like *-12-24 given: use strftime matching
                         format, value = "", ""
                         for j, (frm, val) in enumerate(zip("Ymd", ymd)):
                             if val is None: continue # continue for j, (forma..
@@ -264,9 +509,6 @@ class SearchQueryParser(object):
                         temp = "STRFTIME('%s', m.timestamp, 'unixepoch') = :%s"
                         sql = temp % (format, param)
                         sql_params[param] = value
-                    else:
-                        # Date range given: use timestamp matching
-                        date_words = word.split("..", 1)
                     for i, d in ((i, d) for i, d in enumerate(date_words) if d):
                         parts = list(filter(bool, d.split("-")[:3]))
                         ymd = list(map(util.to_int, parts))
@@ -287,11 +529,13 @@ class SearchQueryParser(object):
                             ymd[2] = max(min(ymd[2], day_max), 1)
                         dates[i] = datetime.date(*ymd)
                     for i, d in ((i, d) for i, d in enumerate(dates) if d):
+                        # Half-open range: from start of first day
+                        # until before start of day following last day
                         timestamp = int(util.timedelta_seconds(d - UNIX_EPOCH))
                         param = "timestamp_%s" % len(sql_params)
                         sql += (" AND " if sql else "")
-                        sql += "m.timestamp %s :%s" % ([">=", "<="][i], param)
-                        sql_params[param] = timestamp
+                        sql += "m.timestamp %s :%s" % ([">=", "<"][i], param)
+                        sql_params[param] = timestamp + i * 24 * 3600
                 kw_sql += (" OR " if kw_sql else "") + sql
             if kw_sql:
                 negation = keyword.startswith("-")
@@ -339,6 +583,7 @@ class SearchQueryParser(object):
 
 if "__main__" == __name__:
     DO_TRACE = True
+    DO_BENCHMARK = True
     TEST_QUERIES = [
         'WORDTEST word "quoted words"',
         'ORTEST OR singleword OR (grouped words) OR lastword',
@@ -351,6 +596,7 @@ if "__main__" == __name__:
         'KEYWORDTEST --from:notkeyword chats:notkeyword from: singleword '
                     'chat:"quoted title" date:t date:20022-x-20..2003-x-y',
         'WORDFAILTEST chat:parens in(anyword',
+        'REGEXTEST regex:\\d{3}-\\d{4} -regex:"(spam|ham)" fuzzy:recieve',
         'BIGTEST OR word OR (grouped words) OR -(excluded grouped words) '
                 'OR -excludedword OR (word2 OR (nested grouped words)) '
                 'date:2011-11..2013-02 -date:2012-06..2012-08 '
@@ -404,3 +650,48 @@ if "__main__" == __name__:
         print("PARAMS: %s" % "\n".join(wrapper.wrap(repr(params))))
         print("WORDS: %s" % repr(words))
         print("QUERY: %s" % item)
+
+    if DO_BENCHMARK:
+        import timeit
+        TABLES = [{"name": "table%s" % i, "columns": [{"name": "column%s" % j}
+                   for j in range(10)]} for i in range(30)]
+        def parse_uncached():
+            """Grammar built anew and query parsed again for each table."""
+            SearchQueryParser._grammar = None
+            myparser = SearchQueryParser()
+            for query in TEST_QUERIES:
+                for table in [None] + TABLES:
+                    SearchQueryParser._cache.clear()
+                    myparser.Parse(query, table)
+        def parse_cached():
+            """Grammar built once, query parsed once for all tables."""
+            SearchQueryParser._cache.clear()
+            myparser = SearchQueryParser()
+            for query in TEST_QUERIES:
+                for table in [None] + TABLES:
+                    myparser.Parse(query, table)
+        print("\n%s\n" % ("-" * 60))
+        print("BENCHMARK: %s queries over %s tables." %
+              (len(TEST_QUERIES), len(TABLES)))
+        for func in (parse_uncached, parse_cached):
+            print("%s: %.3f seconds." % (func.__name__, timeit.timeit(func, number=1)))
+
+        import random, sqlite3
+        ROWS, DATES = 2000000, ["2002", "2012-02", "2012-02-29"]
+        db = sqlite3.connect(":memory:")
+        db.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, timestamp INTEGER)")
+        db.executemany("INSERT INTO messages (timestamp) VALUES (?)",
+                       ((random.randint(0, 2**31 - 1), ) for _ in range(ROWS)))
+        db.execute("CREATE INDEX idx_timestamp ON messages (timestamp)")
+        print("\nBENCHMARK: date keywords over %s messages." % ROWS)
+        for date in DATES:
+            sql, params, _ = parser.Parse("date:%s" % date)
+            fmt = "-".join(["%Y", "%m", "%d"][:len(date.split("-"))])
+            for name, sql, params in [
+                ("strftime", "STRFTIME('%s', m.timestamp, 'unixepoch') = :v" % fmt,
+                 {"v": date}),
+                ("range", sql, params),
+            ]:
+                sql = "SELECT COUNT(*) FROM messages m WHERE %s" % sql
+                timer = timeit.Timer(lambda: db.execute(sql, params).fetchone())
+                print("date:%s %s: %.3f seconds." % (date, name, timer.timeit(number=1)))
@@ -8,9 +8,11 @@ Released under the MIT License.
 
 @author      Erki Suurjaak
 @created     26.11.2011
-@modified    02.06.2024
+@modified    18.10.2026
 ------------------------------------------------------------------------------
 """
+import array
+import bisect
 import collections
 import copy
 import datetime
@@ -22,6 +24,7 @@ import os
 import re
 import sqlite3
 import shutil
+import struct
 import sys
 import textwrap
 import time
@@ -135,6 +138,12 @@ ID_PREFIX_GROUP   = "19:" # Conversations.identity prefix for group chats
 ID_PREFIX_BOT     = "28:" # Conversations.identity and Contacts.skypename for bots
 ID_PREFIX_SPECIAL = "48:" # Conversations.identity prefix for special chats like calllogs
 AUTHORS_SPECIAL = ["sys"] # Used by Skype for system messages
+FULLTEXT_SUPPORTED = None # Whether SQLite has FTS5, populated on first check
+REGEX_CACHE = {} # Compiled patterns for SQLite REGEXP function, {pattern: re}
+REGEX_CACHE_SIZE = 100 # Maximum number of patterns to keep in REGEX_CACHE
+FUZZY_CACHE = {} # Checked words for FUZZY_MATCH, {(word, distance): {word: bool}}
+FUZZY_CACHE_SIZE = 100000 # Maximum number of checked words to keep per word
+WORD_RGX = re.compile(r"\w+", re.U) # For splitting text into words in FUZZY_MATCH
 
 logger = logging.getLogger(__name__)
 
@@ -174,6 +183,26 @@ class SkypeDatabase(object):
     }
 
 
+    """Schema name of attached full-text index database."""
+    FULLTEXT_SCHEMA = "fts"
+
+    """FTS5 table of message plain text in full-text index, rowid as Messages.id."""
+    FULLTEXT_TABLE = "fts.message_text"
+
+    """Table of Messages count and last ID at last full-text index update."""
+    FULLTEXT_STATE_TABLE = "fts.message_state"
+
+    """Number of messages to insert into full-text index in one go."""
+    FULLTEXT_CHUNK = 1000
+
+    """SQL CREATE statement for journal of chats merged from other databases."""
+    MERGE_JOURNAL_CREATE = ("CREATE TABLE MergeJournal (source TEXT NOT NULL, "
+                            "identity TEXT NOT NULL, version TEXT, convo_id INTEGER, "
+                            "ranges TEXT, targets TEXT, complete INTEGER, "
+                            "max_id INTEGER, max_timestamp INTEGER, "
+                            "timestamp INTEGER, PRIMARY KEY (source, identity))")
+
+
     def __init__(self, filename, log_error=True, truncate=False):
         """
         Initializes a new Skype database object from the file.
@@ -196,6 +225,7 @@ class SkypeDatabase(object):
         self.tables_list = None # Ordered list of table items
         self.table_rows = {}    # {"tablename1": [..], }
         self.table_objects = {} # {"tablename1": {id1: {rowdata1}, }, }
+        self.fulltext = None    # Path of attached full-text index database
         try:
             if truncate and os.path.exists(self.filename):
                 logger.info("Overwriting existing file %s.", self.filename)
@@ -205,10 +235,12 @@ class SkypeDatabase(object):
                                               check_same_thread=False)
             self.connection.row_factory = self.row_factory
             self.connection.text_factory = six.binary_type
+            self.register_functions(self.connection)
             rows = self.execute("SELECT name, sql FROM sqlite_master "
                                 "WHERE type = 'table'").fetchall()
             for row in rows:
                 self.tables[row["name"].lower()] = row
+            self.attach_fulltext_index()
         except Exception:
             _, e, tb = sys.exc_info()
             if log_error: logger.exception("Error opening database %s.", self.filename)
@@ -362,6 +394,7 @@ class SkypeDatabase(object):
             util.try_ignore(self.connection and self.connection.close)
             del self.connection
             self.connection = None
+        self.fulltext = None
         for attr in ["tables", "tables_list", "table_rows", "table_objects"]:
             if hasattr(self, attr):
                 delattr(self, attr)
@@ -372,6 +405,32 @@ class SkypeDatabase(object):
             util.try_ignore(lambda: os.unlink(self.live.tokenpath))
 
 
+    def make_connection(self, readonly=True):
+        """
+        Returns a new separate connection to the database file, returning rows
+        as dicts like the main connection, for use in a background thread.
+
+        @param   readonly  whether connection is not allowed to make changes
+        """
+        connection = sqlite3.connect(self.filename)
+        connection.row_factory = self.row_factory
+        connection.text_factory = six.binary_type
+        self.register_functions(connection)
+        if readonly: connection.execute("PRAGMA query_only = ON")
+        return connection
+
+
+    def register_functions(self, connection):
+        """
+        Registers custom SQL functions on the connection: LOWER_UNICODE(text),
+        REGEXP for "text REGEXP pattern", and FUZZY_MATCH(word, text, distance).
+        """
+        connection.create_function("LOWER_UNICODE", 1, lambda x:
+            x.lower() if isinstance(x, six.string_types) else x)
+        connection.create_function("REGEXP", 2, sqlite_regexp)
+        connection.create_function("FUZZY_MATCH", 3, sqlite_fuzzy_match)
+
+
     def execute(self, sql, params=(), log=None):
         """
         Shorthand for self.connection.execute().
@@ -594,6 +653,147 @@ class SkypeDatabase(object):
                     yield message
 
 
+    def has_fulltext_index(self):
+        """Returns whether the database has a full-text index for messages."""
+        return bool(self.fulltext)
+
+
+    def attach_fulltext_index(self, create=False):
+        """
+        Attaches the full-text index database from next to database file,
+        if it exists and SQLite supports FTS5. Returns whether index is attached.
+
+        @param   create  whether to create the index database if not existing
+        """
+        if self.fulltext or not self.is_open() or not is_fulltext_supported():
+            return bool(self.fulltext)
+        filename = "%s.fts" % self.filename
+        if not create and not os.path.exists(filename):
+            return False
+        try:
+            self.execute("ATTACH DATABASE ? AS %s" % self.FULLTEXT_SCHEMA,
+                         (filename, ))
+            self.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(body, "
+                         "tokenize='unicode61 remove_diacritics 0')"
+                         % self.FULLTEXT_TABLE)
+            self.execute("CREATE TABLE IF NOT EXISTS %s (count INTEGER, max_id INTEGER)"
+                         % self.FULLTEXT_STATE_TABLE)
+            self.fulltext = filename
+        except Exception:
+            logger.exception("Error attaching full-text index %s.", filename)
+            util.try_ignore(lambda: self.execute("DETACH DATABASE %s"
+                                                 % self.FULLTEXT_SCHEMA))
+        return bool(self.fulltext)
+
+
+    def create_fulltext_index(self, progress=None):
+        """
+        Creates a full-text index for message search into a database file
+        next to this database, or brings an existing index up to date.
+
+        @param   progress  callback(count, total) returning whether to continue
+        @return            number of messages indexed
+        """
+        if not self.attach_fulltext_index(create=True):
+            return 0
+        return self.update_fulltext_index(progress)
+
+
+    def get_fulltext_source_state(self):
+        """Returns Messages table state as {"count": row count, "max_id": last ID}."""
+        return self.execute("SELECT COUNT(*) AS count, COALESCE(MAX(id), 0) AS max_id "
+                            "FROM messages").fetchone()
+
+
+    def is_fulltext_index_current(self):
+        """
+        Returns whether the database has a full-text index, and no messages
+        have been added or deleted since its last update. Edits by other
+        programs are only picked up by a full update.
+        """
+        if not self.fulltext or "messages" not in self.tables:
+            return False
+        state = self.execute("SELECT count, max_id FROM %s"
+                             % self.FULLTEXT_STATE_TABLE).fetchone()
+        return state == self.get_fulltext_source_state()
+
+
+    def update_fulltext_index(self, progress=None, edited=True):
+        """
+        Adds messages missing from full-text index, if database has an index.
+        Message IDs are assumed to grow, edited messages are re-indexed
+        by edited_timestamp.
+
+        @param   progress  callback(count, total) returning whether to continue
+        @param   edited    whether to check for edited messages, requiring
+                           a full pass over messages, or only for new ones
+        @return            number of messages indexed
+        """
+        result = 0
+        if not self.fulltext or "messages" not in self.tables:
+            return result
+
+        schema, table = self.FULLTEXT_SCHEMA, self.FULLTEXT_TABLE
+        state = self.get_fulltext_source_state()
+        def save_state():
+            self.execute("DELETE FROM %s" % self.FULLTEXT_STATE_TABLE)
+            self.execute("INSERT INTO %s (count, max_id) VALUES (:count, :max_id)"
+                         % self.FULLTEXT_STATE_TABLE, state)
+        row = self.execute("SELECT rowid AS id FROM %s ORDER BY rowid DESC "
+                           "LIMIT 1" % table).fetchone()
+        last_id = row["id"] if row else 0
+        last_edited = self.execute("PRAGMA %s.user_version"
+                                   % schema).fetchone()["user_version"]
+        sql, params = "m.id > :id", {"id": last_id, "edited": last_edited}
+        if edited and any("edited_timestamp" == c["name"].lower()
+                          for c in self.get_table_columns("messages")):
+            sql += " OR m.edited_timestamp > :edited"
+        total = self.execute("SELECT COUNT(*) AS count FROM messages m WHERE %s"
+                             % sql, params).fetchone()["count"]
+        if not total:
+            save_state()
+            self.connection.commit()
+            return result
+
+        logger.info("Adding %s to full-text index of %s.",
+                    util.plural("message", total), self.filename)
+        parser, inserts, deletes, complete = MessageParser(self), [], [], True
+        def flush():
+            if deletes:
+                self.connection.executemany("DELETE FROM %s WHERE rowid = ?"
+                                            % table, deletes)
+            self.connection.executemany("INSERT INTO %s (rowid, body) VALUES "
+                                        "(?, ?)" % table, inserts)
+            del inserts[:], deletes[:]
+
+        for m in self.get_messages(additional_sql=sql, additional_params=params,
+                                   use_cache=False):
+            if m["id"] <= last_id: deletes.append((m["id"], ))
+            inserts.append((m["id"], parser.parse(m, output={"format": "text"})))
+            last_edited = max(last_edited, m.get("edited_timestamp") or 0)
+            result += 1
+            if len(inserts) >= self.FULLTEXT_CHUNK:
+                flush()
+                if progress and not progress(count=result, total=total):
+                    complete = False
+                    break # for m
+        if inserts: flush()
+        if complete: # Edits are in no particular order, can only mark when done
+            self.execute("PRAGMA %s.user_version = %d" % (schema, last_edited))
+            save_state()
+        self.connection.commit()
+        return result
+
+
+    def delete_fulltext_index(self):
+        """Detaches and deletes the full-text index database, if any."""
+        if not self.fulltext:
+            return
+        filename, self.fulltext = self.fulltext, None
+        self.execute("DETACH DATABASE %s" % self.FULLTEXT_SCHEMA)
+        util.try_ignore(lambda: os.unlink(filename))
+
+
     def row_factory(self, cursor, row):
         """
         Creates dicts from resultset rows, with BLOB fields converted to
@@ -1001,6 +1201,94 @@ class SkypeDatabase(object):
         return result
 
 
+    def search_conversations(self, words):
+        """
+        Returns IDs of chats with title or any participant name containing
+        all the given words, as matched by SQL LIKE, case-insensitive for ASCII.
+        Participant names are contact name, full name, display name
+        and identity.
+
+        @return  set of Conversations.id, including IDs of linked older chats
+        """
+        result = set()
+        if not self.is_open() or "conversations" not in self.tables or not words:
+            return result
+
+        params = {}
+        sql = "SELECT id FROM conversations WHERE %s" % \
+              self.make_match_sql([self.make_title_col()], words, params)
+        if "participants" in self.tables:
+            pwhere = self.make_match_sql(["identity"], words, params)
+            if "contacts" in self.tables:
+                cols = [self.make_title_col("contacts"), "fullname", "displayname",
+                        "COALESCE(skypename, pstnnumber, '')"]
+                pwhere += " OR identity IN (SELECT COALESCE(skypename, pstnnumber, '') " \
+                          "FROM contacts WHERE %s)" % \
+                          self.make_match_sql(cols, words, params)
+            account = self.account or {}
+            if any(all(w in (account.get(k) or "").lower() for w in words)
+                   for k in ("name", "fullname", "displayname", "identity")):
+                pwhere += " OR identity = :account_id"
+                params["account_id"] = account["identity"]
+            sql += " UNION SELECT convo_id FROM participants WHERE %s" % pwhere
+        result.update(x["id"] for x in self.execute(sql, params).fetchall())
+        return result
+
+
+    def search_contacts(self, words):
+        """
+        Returns identities of contacts with any field in CONTACT_FIELD_TITLES
+        containing all the given words, as matched by SQL LIKE,
+        case-insensitive for ASCII. Fields are matched in their displayed form.
+
+        @return  set of contact identities, as COALESCE(skypename, pstnnumber, '')
+        """
+        result = set()
+        if not self.is_open() or "contacts" not in self.tables or not words:
+            return result
+
+        # SQL equivalents of format_contact_field() for non-text fields
+        EXPRS = {
+            "type":     "CASE type WHEN %s THEN 'phone number' WHEN %s THEN 'bot' END"
+                        % (CONTACT_TYPE_PHONE, CONTACT_TYPE_BOT),
+            "emails":   "REPLACE(emails, ' ', ', ')",
+            "gender":   "CASE gender WHEN 1 THEN 'male' WHEN 2 THEN 'female' END",
+            "birthday": "SUBSTR(birthday, 1, 4) || '-' || SUBSTR(birthday, 5, 2) "
+                        "|| '-' || SUBSTR(birthday, 7)",
+        }
+        colnames = set(c["name"].lower() for c in self.get_table_columns("contacts"))
+        cols = [EXPRS.get(k, k) for k in CONTACT_FIELD_TITLES if k in colnames]
+        params = {}
+        sql = "SELECT COALESCE(skypename, pstnnumber, '') AS identity " \
+              "FROM contacts WHERE %s" % self.make_match_sql(cols, words, params)
+        result.update(x["identity"] for x in self.execute(sql, params).fetchall())
+        return result
+
+
+    def make_match_sql(self, exprs, words, params):
+        """
+        Returns SQL condition for any of the expressions containing all words,
+        populating params with LIKE values. LIKE is case-insensitive for ASCII
+        only, expressions are lowercased in Python if words contain non-ASCII.
+
+        @param   exprs   list of SQL expressions to match
+        @param   words   list of words that must all be contained
+        @param   params  dictionary to add SQL parameters to
+        """
+        names = []
+        if any(ord(c) > 127 for w in words for c in w):
+            words = [w.lower() for w in words]
+            exprs = ["LOWER_UNICODE(%s)" % x for x in exprs]
+        for word in words:
+            name = "word%s" % len(params)
+            safe = word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params[name] = "%" + safe + "%"
+            names.append(name)
+        items = ["(%s)" % " AND ".join("%s LIKE :%s ESCAPE '\\'" % (x, n)
+                                       for n in names) for x in exprs]
+        return "(%s)" % " OR ".join(items)
+
+
     def get_contact_name(self, identity, contact=None):
         """
         Returns the full name for the specified contact, or given identity if not set.
@@ -1205,6 +1493,59 @@ class SkypeDatabase(object):
                              os.path.getmtime(self.filename))
 
 
+    def get_data_version(self):
+        """
+        Returns a tag identifying current database content, changing on any
+        write by any connection: from file change counter in SQLite header,
+        and file size and modification time of database and its WAL file,
+        and the same for full-text index database next to it, if any.
+        """
+        parts = []
+        for filename in (self.filename, "%s.fts" % self.filename):
+            if not os.path.exists(filename):
+                parts.append("-")
+                continue # for filename
+            try:
+                with open(filename, "rb") as f:
+                    f.seek(24)
+                    parts.append(struct.unpack(">I", f.read(4))[0])
+            except Exception: pass
+            for path in (filename, "%s-wal" % filename):
+                if os.path.exists(path):
+                    parts.extend([os.path.getsize(path), os.path.getmtime(path)])
+        return ":".join(map(str, parts))
+
+
+    def get_chat_merge_mark(self, chat):
+        """
+        Returns the highest message ID and timestamp in chat,
+        as {"max_id": .., "max_timestamp": ..}.
+        """
+        cc = [x for x in (chat, chat.get("__link")) if x]
+        return self.execute("SELECT MAX(id) AS max_id, "
+                            "MAX(timestamp) AS max_timestamp FROM messages "
+                            "WHERE convo_id IN (%s)" % ", ".join("?" * len(cc)),
+                            [x["id"] for x in cc]).fetchone()
+
+
+    def get_chat_data_version(self, chat):
+        """
+        Returns a tag identifying current message content in chat, including
+        any linked chat, changing on added, deleted, re-timed, resized
+        or edited messages.
+        """
+        cc = [x for x in (chat, chat.get("__link")) if x]
+        edits = "TOTAL(edited_timestamp)" if any("edited_timestamp" == c["name"].lower()
+                for c in self.get_table_columns("messages")) else "0"
+        res = self.execute("SELECT COUNT(*) AS count, MAX(id) AS max_id, "
+                           "TOTAL(timestamp) AS stamps, "
+                           "TOTAL(LENGTH(body_xml)) AS size, %s AS edits "
+                           "FROM messages WHERE convo_id IN (%s)" %
+                           (edits, ", ".join("?" * len(cc))),
+                           [x["id"] for x in cc]).fetchone()
+        return ":".join(str(res[k]) for k in ("count", "max_id", "stamps", "size", "edits"))
+
+
     def ensure_backup(self):
         """Creates a backup file if configured so, and not already created."""
         if conf.DBDoBackup:
@@ -1307,18 +1648,21 @@ class SkypeDatabase(object):
 
 
     def insert_messages(self, chat, messages, source_db, source_chat,
-                        heartbeat=None, beatcount=None):
+                        heartbeat=None, beatcount=None, checkpoint=None):
         """
         Inserts the specified messages under the specified chat in this
         database, includes related rows in Calls, Videos, Transfers and
         SMSes.
 
-        @param    messages   list of messages, or message IDs from source_db
-        @param    heartbeat  function called after every @beatcount message
-        @param    beatcount  number of messages after which to call heartbeat
-        @return              a list of inserted message IDs
+        @param    messages    list of messages, or message IDs from source_db
+        @param    heartbeat   function called after every @beatcount message
+        @param    beatcount   number of messages after which to call heartbeat
+        @param    checkpoint  {"identity": .., "version": .., "complete": ..}
+                              to record inserted messages in merge journal,
+                              in the same transaction
+        @return               a list of inserted message IDs
         """
-        result = []
+        result, source_ids = [], []
         if self.is_open() and not self.account and source_db.account:
             self.insert_account(source_db.account)
         if self.is_open() and "messages" not in self.tables:
@@ -1329,6 +1673,9 @@ class SkypeDatabase(object):
             self.create_table("smses")
         if self.is_open() and "chats" not in self.tables:
             self.create_table("chats")
+        if self.is_open() and checkpoint and "mergejournal" not in self.tables:
+            # Create before inserting, as creating commits
+            self.create_table("mergejournal", self.MERGE_JOURNAL_CREATE)
         if self.is_open() and "messages" in self.tables:
             logger.info("Merging %s (%s) into %s.",
                         util.plural("chat message", messages),
@@ -1420,6 +1767,7 @@ class SkypeDatabase(object):
                             self.execute(sql, t)
                 timestamp_earliest = min(timestamp_earliest, m["timestamp"])
                 result.append(m_id)
+                source_ids.append(m["id"])
                 if heartbeat and beatcount and i and not i % beatcount:
                     heartbeat()
             if (timestamp_earliest and chat["creation_timestamp"]
@@ -1430,8 +1778,12 @@ class SkypeDatabase(object):
                 chat["created_datetime"] = self.stamp_to_date(timestamp_earliest)
                 self.execute("UPDATE conversations SET creation_timestamp = "
                              ":creation_timestamp WHERE id = :id", chat)
+            if checkpoint:
+                self.save_merge_checkpoint(source_db, chat, source_ids, result,
+                                           commit=False, **checkpoint)
             self.connection.commit()
             self.last_modified = datetime.datetime.now()
+            if result: self.update_fulltext_index(edited=False)
         return result
 
 
@@ -1473,6 +1825,77 @@ class SkypeDatabase(object):
             self.last_modified = datetime.datetime.now()
 
 
+    def get_merge_checkpoints(self, source_db):
+        """
+        Returns chats merged from the source database, as recorded in merge
+        journal, as {chat identity: {"version": source chat data version,
+                                     "convo_id": chat ID in this database,
+                                     "ranges": [[first ID, last ID], ],
+                                     "targets": [[first ID, last ID], ],
+                                     "complete": whether chat fully merged,
+                                     "max_id": highest source message ID,
+                                     "max_timestamp": highest source timestamp}},
+        where ranges are source message IDs, any message in range inserted,
+        targets are IDs of the inserted messages in this database, both
+        cleared on completion, and highest ID and timestamp are from the
+        last completed merge, all source messages up to them merged.
+        """
+        result = {}
+        if self.is_open() and "mergejournal" in self.tables:
+            for row in self.execute("SELECT * FROM mergejournal WHERE source = ?",
+                                    [source_db.filename]):
+                row["ranges"] = json.loads(row["ranges"] or "[]")
+                row["targets"] = json.loads(row["targets"] or "[]")
+                row["complete"] = bool(row["complete"])
+                result[row["identity"]] = row
+        return result
+
+
+    def save_merge_checkpoint(self, source_db, chat, message_ids=(),
+                              target_ids=(), identity=None, version=None,
+                              complete=False, max_id=None, max_timestamp=None,
+                              commit=True):
+        """
+        Records chat merge progress from the source database in merge journal,
+        adding the range of given message IDs to inserted ranges.
+
+        @param   chat         chat in this database, if any
+        @param   message_ids  source message IDs inserted, recorded as a single
+                              range from lowest to highest
+        @param   target_ids   IDs of inserted messages in this database,
+                              recorded as a single range
+        @param   identity     source chat identity
+        @param   version      source chat data version
+        @param   complete       whether the chat has been fully merged
+        @param   max_id         highest source message ID, stored if complete
+        @param   max_timestamp  highest source timestamp, stored if complete
+        @param   commit         whether to commit transaction
+        """
+        if not self.is_open(): return
+        if "mergejournal" not in self.tables:
+            self.create_table("mergejournal", self.MERGE_JOURNAL_CREATE)
+        row = self.execute("SELECT * FROM mergejournal "
+                           "WHERE source = ? AND identity = ?",
+                           [source_db.filename, identity]).fetchone() or {}
+        ranges, targets = [], []
+        if not complete:
+            ranges, targets = (json.loads(row.get(k) or "[]")
+                               for k in ("ranges", "targets"))
+            max_id, max_timestamp = row.get("max_id"), row.get("max_timestamp")
+            if message_ids:
+                ranges = sorted(ranges + [[min(message_ids), max(message_ids)]])
+            if target_ids:
+                targets = sorted(targets + [[min(target_ids), max(target_ids)]])
+        self.execute("INSERT OR REPLACE INTO mergejournal (source, identity, "
+                     "version, convo_id, ranges, targets, complete, max_id, "
+                     "max_timestamp, timestamp) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     [source_db.filename, identity, version, chat and chat["id"],
+                      json.dumps(ranges), json.dumps(targets), complete,
+                      max_id, max_timestamp, int(time.time())])
+        if commit: self.connection.commit()
+
+
     def insert_account(self, account):
         """
         Inserts the specified account into this database and sets it as the
@@ -1733,6 +2156,7 @@ class SkypeDatabase(object):
             if delcount:
                 logger.info("Deleted from %s: %s.", table, util.plural("row", delcount))
                 result[table] = delcount
+        if "Messages" in result: self.trim_fulltext_index()
         self.connection.commit()
 
         identities = [c["identity"] for c in contacts]
@@ -1750,6 +2174,17 @@ class SkypeDatabase(object):
         return result
 
 
+    def trim_fulltext_index(self):
+        """
+        Drops entries for message IDs beyond current last message from full-text
+        index, if any, as SQLite can reuse the IDs of deleted last messages.
+        """
+        if not self.fulltext:
+            return
+        self.execute("DELETE FROM %s WHERE rowid > (SELECT COALESCE(MAX(id), 0) "
+                     "FROM messages)" % self.FULLTEXT_TABLE)
+
+
     def update_row(self, table, row, original_row, rowid=None, log=None):
         """
         Updates the table row in the database, identified by its primary key
@@ -1842,6 +2277,7 @@ class SkypeDatabase(object):
         if not where:
             return False # Sanity check: no primary key and no rowid
         self.execute("DELETE FROM %s WHERE %s" % (table, where), values, log=log)
+        if "messages" == table: self.trim_fulltext_index()
         self.connection.commit()
         self.last_modified = datetime.datetime.now()
         return True
@@ -1940,7 +2376,7 @@ class MessageParser(object):
                 "wordcloud": [],  # [(word, count, size), ]
                 "wordcounts": {}, # {word: {author: count, }, }
                 "links": {},      # {author: [link, ], }
-                "last_cloudtext": "",
+                "last_cloudtext": "", "last_links": [], "last_emoticons": [],
                 "last_message": "", "chars": 0, "smschars": 0, "files": 0,
                 "bytes": 0, "calldurations": 0, "info_items": [],
                 "shares": 0, "sharebytes": 0,
@@ -1948,7 +2384,8 @@ class MessageParser(object):
                 "cloudcounter": wordcloud.GroupCounter(conf.WordCloudLengthMin),
                 "totalhist": {}, # Histogram data {"hours", "hours-firsts", "days", ..}}
                 "hists": {},     # Author histogram data {author: {"hours", ..} }
-                "workhist": {},  # {"hours": {0: {author: count}}, "days": .., "stamps": [..]}
+                "accumulator": StatsAccumulator(), # Per-day data of parsed messages
+                "collected": None, # (accumulator version, daterange, authors) of last result
                 "emoticons": collections.defaultdict(lambda: collections.defaultdict(int)),
                 "shared_media": {}} # {message_id: {url, datetime, author, author_name, category, ?filename}, }
 
@@ -1997,11 +2434,8 @@ class MessageParser(object):
             result = self.dom_to_html(dom, output, message)
         elif dom is not None and "text" == output.get("format"):
             result = self.dom_to_text(dom)
-            if output.get("wrap"):
-                linelists = [self.textwrapfunc(x) for x in result.splitlines()]
-                ll = "\n".join(j if j else "" for i in linelists for j in i)
-                # Force DOS linefeeds
-                result = re.sub("([^\r])\n", lambda m: m.group(1) + "\r\n", ll)
+            if output.get("wrap"): # Force DOS linefeeds
+                result = "\r\n".join(self.wrap_text(result))
         else:
             result = dom
 
@@ -2344,44 +2778,45 @@ class MessageParser(object):
 
 
     def highlight_text(self, dom, rgx_highlight):
-        """Wraps text matching regex in any dom element in <b> nodes."""
-        parent_map = dict((c, p) for p in dom.iter() for c in p)
-        rgx_highlight_split = re.compile("<b>")
-        repl_highlight = lambda x: "<b>%s<b>" % x.group(0)
-        # Highlight substrings in <b>-tags
-        for i in dom.iter():
-            if "b" == i.tag:
-                continue # for i
-            for j, t in enumerate([i.text, i.tail]):
-                if not t:
-                    continue # for j, t
-                highlighted = rgx_highlight.sub(repl_highlight, t)
-                parts = rgx_highlight_split.split(highlighted)
-                if len(parts) < 2:
-                    continue # for j, t
-                index_insert = (list(parent_map[i]).index(i) + 1) if j else 0
-                setattr(i, "tail" if j else "text", "")
-                b = None
-                for k, part in enumerate(parts):
-                    if k % 2: # Text to highlight, wrap in <b>
-                        b = ElementTree.Element("b")
-                        b.text = part
-                        if j: # Processing i.tail
-                            parent_map[i].insert(index_insert, b)
-                        else: # Processing i.text
-                            i.insert(index_insert, b)
-                        index_insert += 1
-                    else: # Other text, append to tail/text
-                        if j: # Processing i.tail
-                            if b is not None: #
-                                b.tail = part
-                            else:
-                                i.tail = (i.tail or "") + part
-                        else: # Processing i.text
-                            if b is not None:
-                                b.tail = part
-                            else:
-                                i.text = part
+        """
+        Wraps text matching regex in any dom element in <b> nodes,
+        splicing each element's children once. Existing <b> nodes are skipped.
+
+        @param   rgx_highlight  compiled regex, or a list of words to highlight
+        """
+        if not hasattr(rgx_highlight, "finditer"):
+            rgx_highlight = make_highlight_regex(rgx_highlight)
+
+        def split(text):
+            """Returns (text before first match, [<b> nodes with tails])."""
+            head, bs, pos = text, [], 0
+            for match in rgx_highlight.finditer(text):
+                if match.start() == match.end(): continue # for match
+                part = text[pos:match.start()]
+                if bs: bs[-1].tail = part
+                else: head = part
+                b = ElementTree.Element("b")
+                b.text, pos = match.group(0), match.end()
+                bs.append(b)
+            if bs: bs[-1].tail = text[pos:]
+            return head, bs
+
+        def process(elem):
+            """Highlights element text and children tails, recursively."""
+            children, bs = list(elem), []
+            if "b" != elem.tag and elem.text:
+                elem.text, bs = split(elem.text)
+            result, changed = bs, bool(bs)
+            for child in children:
+                process(child)
+                result.append(child)
+                if "b" != child.tag and child.tail:
+                    child.tail, bs = split(child.tail)
+                    result.extend(bs)
+                    changed = changed or bool(bs)
+            if changed: elem[:] = result
+
+        process(dom)
 
 
     def dom_to_html(self, dom, output, message):
@@ -2528,8 +2963,13 @@ class MessageParser(object):
         return result
 
 
-    def dom_to_text(self, dom):
-        """Returns a plaintext representation of the message DOM."""
+    def dom_to_text(self, dom, parts=None):
+        """
+        Returns a plaintext representation of the message DOM.
+
+        @param   parts  list to append text parts to instead of returning text
+        """
+        result, parts = (parts is None), [] if parts is None else parts
         text, tail = dom.text or "", dom.tail or ""
         if "quote" == dom.tag:
             text = "\"" + text
@@ -2544,7 +2984,23 @@ class MessageParser(object):
             if dom.get("raw_pre"): pre = dom.get("raw_pre")
             if dom.get("raw_post"): post = dom.get("raw_post")
             text, tail = pre + text, post + tail
-        return text + "".join(self.dom_to_text(x) for x in dom) + tail
+        parts.append(text)
+        for x in dom: self.dom_to_text(x, parts)
+        parts.append(tail)
+        return "".join(parts) if result else None
+
+
+    def wrap_text(self, text):
+        """
+        Returns text wrapped to TEXT_MAXWIDTH, as a list of non-empty lines.
+        Lines already fitting are passed as is, without going through textwrap.
+        """
+        result = []
+        for line in text.splitlines():
+            if line and len(line) <= self.TEXT_MAXWIDTH and not line[-1].isspace():
+                result.append(line)
+            else: result.extend(self.textwrapfunc(line))
+        return result
 
 
     def sanitize(self, dom, known_tags):
@@ -2579,55 +3035,32 @@ class MessageParser(object):
 
     def collect_message_stats(self, message, dom):
         """Adds message statistics to accumulating data."""
-        self.stats["startdate"] = self.stats["startdate"] or message["datetime"]
-        self.stats["enddate"] = message["datetime"]
-        author = message["author"]
+        accumulator = self.stats["accumulator"]
+        if message["id"] in accumulator:
+            return # Already collected, e.g. message parsed again on refresh
+        author, data = message["author"], {}
+        self.stats["last_message"] = ""
         if author in AUTHORS_SPECIAL:
+            accumulator.add(message, data)
             return
-        self.stats["authors"].add(author)
-        self.stats["total"] += 1
-        self.stats["last_message"] = ""
         if message["type"] in [MESSAGE_TYPE_SMS, MESSAGE_TYPE_MESSAGE]:
             self.collect_dom_stats(dom, message)
-            self.stats["cloudcounter"].add_text(self.stats["last_cloudtext"],
-                                                author)
-            self.stats["last_cloudtext"] = ""
+            cloudtext = self.stats["last_cloudtext"]
+            data["words"] = self.stats["cloudcounter"].split_text(cloudtext)
+            data["links"] = self.stats["last_links"]
+            data["emoticons"] = self.stats["last_emoticons"]
+            self.stats.update(last_cloudtext="", last_links=[], last_emoticons=[])
             message["body_txt"] = self.stats["last_message"] # Export kludge
-        if author not in self.stats["counts"]:
-            self.stats["counts"][author] = collections.defaultdict(lambda: 0)
-        hourkey, daykey = message["datetime"].hour, message["datetime"].date()
-        if not self.stats["workhist"]:
-            MAXSTAMP = MessageParser.MessageStamp(datetime.datetime.max, sys.maxsize)
-            intdict   = lambda: collections.defaultdict(int)
-            stampdict = lambda: collections.defaultdict(lambda: MAXSTAMP)
-            self.stats["workhist"] = {
-                "hours":        collections.defaultdict(intdict),
-                "days":         collections.defaultdict(intdict),
-                "hours-firsts": collections.defaultdict(stampdict),
-                "days-firsts":  collections.defaultdict(stampdict), }
-        stamp = MessageParser.MessageStamp(message["datetime"], message["id"])
-        for name, key in [("hours", hourkey), ("days", daykey)]:
-            self.stats["workhist"][name][key][author] += 1
-            histobin = self.stats["workhist"][name + "-firsts"][author]
-            if histobin[key] > stamp: histobin[key] = stamp
-        self.stats["workhist"].setdefault("stamps", []).append(stamp)
 
+        counts = data["counts"] = collections.defaultdict(int)
         len_msg = len(self.stats["last_message"])
         if MESSAGE_TYPE_SMS == message["type"]:
-            self.stats["smses"] += 1
-            self.stats["counts"][author]["smses"] += 1
-            self.stats["counts"][author]["smschars"] += len_msg
+            counts["smses"] += 1
+            counts["smschars"] += len_msg
         elif message["type"] in (MESSAGE_TYPE_CALL, MESSAGE_TYPE_CALL_END):
             if MESSAGE_TYPE_CALL == message["type"]:
-                self.stats["calls"] += 1
-                self.stats["counts"][author]["calls"] += 1
-            calldurations = message.get("__calldurations", {})
-            for identity, duration in calldurations.items():
-                if identity not in self.stats["counts"]:
-                    self.stats["counts"][identity] = collections.defaultdict(lambda: 0)
-                self.stats["counts"][identity]["calldurations"] += duration
-            if calldurations:
-                self.stats["calldurations"] += max(calldurations.values())
+                counts["calls"] += 1
+            data["calldurations"] = message.get("__calldurations", {})
         elif MESSAGE_TYPE_FILE == message["type"]:
             files = message.get("__files")
             if files is None:
@@ -2637,21 +3070,20 @@ class MessageParser(object):
                 files = [f for i, f in sorted(filedict.items())]
                 message["__files"] = files
             for f in files: f["__message_id"] = message["id"]
-            self.stats["transfers"].extend(files)
-            self.stats["counts"][author]["files"] += len(files)
+            data["transfers"] = files
+            counts["files"] += len(files)
             size_files = sum([util.try_ignore(lambda: int(i["filesize"]))[0] or 0
                               for i in files])
-            self.stats["counts"][author]["bytes"] += size_files
+            counts["bytes"] += size_files
         elif MESSAGE_TYPE_TOPIC != message["type"] \
         and message["id"] in self.stats["shared_media"]:
             share = self.stats["shared_media"][message["id"]]
-            self.stats["shares"] += 1
-            self.stats["counts"][author]["shares"]     += 1
-            self.stats["counts"][author]["sharebytes"] += share.get("filesize", 0)
+            counts["shares"]     += 1
+            counts["sharebytes"] += share.get("filesize", 0)
         elif MESSAGE_TYPE_MESSAGE == message["type"]:
-            self.stats["messages"] += 1
-            self.stats["counts"][author]["messages"] += 1
-            self.stats["counts"][author]["chars"]    += len_msg
+            counts["messages"] += 1
+            counts["chars"]    += len_msg
+        accumulator.add(message, data)
 
 
     def collect_dom_stats(self, dom, message, tails_new=None):
@@ -2673,10 +3105,10 @@ class MessageParser(object):
                 self.add_dict_text(self.stats, "last_message", text)
                 subitems = list(elem)
             elif "a" == elem.tag:
-                self.stats["links"].setdefault(message["author"], []).append(text)
+                self.stats["last_links"].append(text)
                 self.add_dict_text(self.stats, "last_message", text)
             elif "ss" == elem.tag:
-                self.stats["emoticons"][elem.get("type")][message["author"]] += 1
+                self.stats["last_emoticons"].append(elem.get("type"))
             elif "quotefrom" == elem.tag:
                 self.add_dict_text(self.stats, "last_message", text)
             elif elem.tag in ["xml", "i", "b", "s"]:
@@ -2690,17 +3122,33 @@ class MessageParser(object):
                 self.add_dict_text(self.stats, "last_message", tail)
 
 
-    def get_collected_stats(self):
+    def get_collected_stats(self, daterange=None, authors=None):
         """
-        Returns the statistics collected during message parsing.
+        Returns the statistics collected during message parsing. Result is
+        assembled from per-day accumulated data, and cached until more
+        messages are parsed or another selection is given.
 
+        @param   daterange  (date1, date2) to limit statistics to, inclusive
+        @param   authors    list of authors to limit statistics to, if any
         @return  dict with statistics entries, or empty dict if not collecting
         """
-        if not self.stats or self.stats["wordclouds"]:
+        if not self.stats:
+            return self.stats
+        accumulator = self.stats["accumulator"]
+        key = (accumulator.version, tuple(daterange or ()),
+               frozenset(authors or ()))
+        if key == self.stats["collected"]:
             return self.stats
         stats = self.stats
+        collected = accumulator.collect(daterange, authors)
+        for k in ["startdate", "enddate", "authors", "total", "counts",
+                  "calldurations", "transfers", "links", "emoticons"]:
+            stats[k] = collected[k]
         for k in ["chars", "smschars", "files", "bytes", "calls", "sharebytes"]:
             stats[k] = sum(i[k] for i in stats["counts"].values())
+        for k in ["smses", "shares", "messages"]:
+            stats[k] = sum(i.get(k, 0) for i in stats["counts"].values())
+        stats["collected"] = key
 
         del stats["info_items"][:]
         delta_date = None
@@ -2735,6 +3183,7 @@ class MessageParser(object):
                            util.format_bytes(stats["sharebytes"]))
             stats["info_items"].append(("Shared media", shares_value))
 
+        stats["totalhist"], stats["hists"] = {}, {}
         if delta_date is not None:
             per_day = util.safedivf(stats["messages"], delta_date.days + 1)
             if stats["messages"] and not round(per_day, 1):
@@ -2743,82 +3192,68 @@ class MessageParser(object):
                 per_day = util.round_float(per_day)
             stats["info_items"].append(("Messages per day", per_day))
 
-            # Fill author and chat hourly histogram
-            histbase = {"hours": dict((x, 0) for x in range(24)), "days": {},
-                        "hours-firsts": {}, "days-firsts": {}}
-            stats["totalhist"] = copy.deepcopy(histbase)
-            stats["hists"] = {}
-            # Fill total histogram hours and initialize author hour structures
-            for hour, counts in stats["workhist"]["hours"].items():
-                for author in stats["authors"]:
-                    if author not in stats["hists"]:
-                        stats["hists"][author] = copy.deepcopy(histbase)
-                    if author in counts:
-                        stats["hists"][author]["hours"][hour] += counts[author]
-                        stats["totalhist"]["hours"][hour] += counts[author]
-            # Assemble total hourly histogram earliest messages
-            hourstamps = stats["workhist"]["hours-firsts"]
-            for hour in range(24):
-                stamps = [x[hour] for x in hourstamps.values() if hour in x]
-                if stamps:
-                    stats["totalhist"]["hours-firsts"][hour] = min(stamps).id
-            # Assemble author hourly histograms earliest messages
-            for author, stamps in hourstamps.items():
-                authorstamps = dict((k, v.id) for k, v in stamps.items())
-                stats["hists"][author]["hours-firsts"] = authorstamps
-
             days_per_bin = float(delta_date.days) / self.HISTOGRAM_DAY_BINS
-            step = datetime.timedelta(max(1, int(math.ceil(days_per_bin))))
-            # Initialize total histogram day and author day structures
-            for i in range(self.HISTOGRAM_DAY_BINS):
-                bindate = (stats["startdate"] + step * i).date()
-                stats["totalhist"]["days"][bindate] = 0
-                for author in stats["hists"]:
-                    stats["hists"][author]["days"][bindate] = 0
-            max_bindate = max(stats["totalhist"]["days"])
-            # Fill total histogram and author days
-            MAXSTAMP = MessageParser.MessageStamp(datetime.datetime.max, sys.maxsize)
-            stampfactory = lambda: collections.defaultdict(lambda: MAXSTAMP)
-            daystamps = collections.defaultdict(stampfactory)
-            for date, counts in sorted(stats["workhist"]["days"].items()):
-                bindate = stats["startdate"].date()
-                while bindate + step <= date: bindate += step
-                bindate = min(bindate, max_bindate)
+            stepdays = max(1, int(math.ceil(days_per_bin)))
+            startdate = stats["startdate"].date()
+            bindates = [startdate + datetime.timedelta(stepdays * i)
+                        for i in range(self.HISTOGRAM_DAY_BINS)]
+            makehist = lambda: {"hours": dict((x, 0) for x in range(24)),
+                                "days":  dict((x, 0) for x in bindates),
+                                "hours-firsts": {}, "days-firsts": {}}
+
+            # Fill author and chat hourly histograms
+            stats["totalhist"] = makehist()
+            hourstamps, totalhours = {}, stats["totalhist"]["hours"]
+            for author in stats["authors"]:
+                hist = stats["hists"][author] = makehist()
+                for hour, count in enumerate(collected["hours"][author]):
+                    hist["hours"][hour] += count
+                    totalhours[hour]    += count
+                for hour, stamp in collected["hours-firsts"][author].items():
+                    hist["hours-firsts"][hour] = stamp.id
+                    if hour not in hourstamps or stamp < hourstamps[hour]:
+                        hourstamps[hour] = stamp
+            for hour, stamp in hourstamps.items():
+                stats["totalhist"]["hours-firsts"][hour] = stamp.id
+
+            # Fill author and chat day bin histograms
+            daystamps, authorstamps = {}, collections.defaultdict(dict)
+            for date, counts in collected["days"].items():
+                index = (date - startdate).days // stepdays
+                bindate = bindates[min(index, self.HISTOGRAM_DAY_BINS - 1)]
                 for author, count in counts.items():
-                    if author not in stats["hists"]:
-                        stats["hists"][author] = copy.deepcopy(histbase)
-                    if bindate not in stats["hists"][author]["days"]:
-                        stats["hists"][author]["days"][bindate] = 0
                     stats["hists"][author]["days"][bindate] += count
-                    stats["totalhist"]["days"][bindate] += count
-                    stamp = stats["workhist"]["days-firsts"][author].get(date)
-                    if stamp:
-                        daystamps[author][bindate] = \
-                            min(stamp, daystamps[author][bindate])
-            # Assemble total hourly histogram earliest messages
-            for i in range(self.HISTOGRAM_DAY_BINS):
-                date = (stats["startdate"] + step * i).date()
-                stamps = [x[date] for x in daystamps.values() if date in x]
-                if stamps:
-                    stats["totalhist"]["days-firsts"][date] = min(stamps).id
-            # Assemble author hourly histograms earliest messages
-            for author, stamps in daystamps.items():
-                authorstamps = dict((k, v.id) for k, v in stamps.items())
-                stats["hists"][author]["days-firsts"] = authorstamps
+                    stats["totalhist"]["days"][bindate]     += count
+                    stamp = collected["days-firsts"][author][date]
+                    stamps = authorstamps[author]
+                    if bindate not in stamps or stamp < stamps[bindate]:
+                        stamps[bindate] = stamp
+                    if bindate not in daystamps or stamp < daystamps[bindate]:
+                        daystamps[bindate] = stamp
+            for bindate, stamp in daystamps.items():
+                stats["totalhist"]["days-firsts"][bindate] = stamp.id
+            for author, stamps in authorstamps.items():
+                stats["hists"][author]["days-firsts"] = dict(
+                    (k, v.id) for k, v in stamps.items())
 
         # Create main cloudtext
         options = {"COUNT_MIN": conf.WordCloudCountMin,
                    "WORDS_MAX": conf.WordCloudWordsMax}
+        cloudcounter = wordcloud.GroupCounter(conf.WordCloudLengthMin)
+        for author, words in collected["words"].items():
+            cloudcounter.add_counts(words, author)
         for author, links in stats["links"].items():
-            stats["cloudcounter"].add_words(links, author)
-        stats["wordcloud"] = stats["cloudcounter"].cloud(options=options)
+            cloudcounter.add_words(links, author)
+        stats["cloudcounter"] = cloudcounter
+        stats["wordcloud"] = cloudcounter.cloud(options=options)
 
         # Create author cloudtexts, scaled to max word count in main cloud
         options.update(SCALE=max([x[1] for x in stats["wordcloud"]] or [0]),
                        WORDS_MAX=conf.WordCloudWordsAuthorMax,
                        FONTSIZE_MAX=wordcloud.FONTSIZE_MAX - 1) # 1 step smaller
+        stats["wordclouds"] = {}
         for author in stats["authors"]:
-            cloud = stats["cloudcounter"].cloud(author, options)
+            cloud = cloudcounter.cloud(author, options)
             stats["wordclouds"][author] = cloud
 
         # Accumulate word counts for main cloud hovertexts
@@ -2826,23 +3261,29 @@ class MessageParser(object):
         words = set(x[0] for x in stats["wordcloud"])
         [words.update(y[0] for y in x) for x in stats["wordclouds"].values()]
         for author in stats["authors"]:
-            for w, c in stats["cloudcounter"].counts(author, words).items():
+            for w, c in cloudcounter.counts(author, words).items():
                 stats["wordcounts"][w][author] = c
 
         return stats
 
 
-    def get_timeline_stats(self):
+    def get_timeline_stats(self, daterange=None, authors=None):
         """
         Returns timeline structure from parsed messages, as (timeline, units),
         where timeline is [{dt, label, count, messages, ?label2}, ]
         and units is (top unit, ?subunit).
+
+        @param   daterange  (date1, date2) to limit timeline to, inclusive
+        @param   authors    list of authors to limit timeline to, if any
         """
         timeline, units = [], ()
-        if not self.stats or not self.stats["workhist"].get("stamps"):
+        accumulator = self.stats["accumulator"] if self.stats else None
+        days = accumulator.daystamps(daterange, authors) if accumulator else []
+        if not days:
             return timeline, units
 
-        d1, d2 = (self.stats["workhist"]["stamps"][i].date for i in (0, -1))
+        d1 = accumulator.get_datetime(days[ 0][0], days[ 0][1][ 0])
+        d2 = accumulator.get_datetime(days[-1][0], days[-1][1][-1])
         unit, span = "hour", d2 - d1
         if   span > datetime.timedelta(days=365*2):  unit = "year"
         elif span > datetime.timedelta(days= 30*3):  unit = "month"
@@ -2866,29 +3307,250 @@ class MessageParser(object):
                     "date":  ATTRS - set(["month", "day"]),
                     "hour":  ATTRS - set(["month", "day", "hour"])}
         REPLACE_VALUES = collections.defaultdict(int, {"month": 1, "day": 1})
+        HOUR = StatsAccumulator.HOUR
         uniques = {} # {(date, unit): {date data}}
-        for m in self.stats["workhist"]["stamps"]:
+        for date, times, ids in days:
+            daydt = datetime.datetime.combine(date, datetime.time())
+            ids = [int(x) for x in ids]
             for unit in units:
-                dt = m.date
-                dt = dt.replace(**{k: REPLACE_VALUES[k] for k in REPLACES[unit]})
-                if "week" == unit: dt -= datetime.timedelta(days=dt.weekday())
-                if (dt, unit) in uniques:
-                    uniques[(dt, unit)]["messages"].append(m.id)
-                    continue # for unit
-
-                ddict = self.TIMELINE_FORMATTERS[unit](dt)
-                ddict.update(dt=dt, messages=[m.id], unit=unit,
-                             datestr=dt.strftime(STRFMTS[unit]))
-                if "week" == unit: ddict["datestr"] += ddict["label"]
-                timeline.append(ddict)
-                uniques[(dt, unit)] = ddict
+                groups = [(daydt, ids)] # [(datetime, [message ID, ])]
+                if "hour" == unit: # Bin sorted day times by hour boundaries
+                    groups, lo = [], 0
+                    while lo < len(times):
+                        hour = int(times[lo] // HOUR)
+                        hi = bisect.bisect_left(times, (hour + 1) * HOUR, lo)
+                        groups.append((daydt.replace(hour=hour), ids[lo:hi]))
+                        lo = hi
+                for dt, group in groups:
+                    dt = dt.replace(**{k: REPLACE_VALUES[k] for k in REPLACES[unit]})
+                    if "week" == unit: dt -= datetime.timedelta(days=dt.weekday())
+                    if (dt, unit) in uniques:
+                        uniques[(dt, unit)]["messages"].extend(group)
+                        continue # for dt, group
+
+                    ddict = self.TIMELINE_FORMATTERS[unit](dt)
+                    ddict.update(dt=dt, messages=list(group), unit=unit,
+                                 datestr=dt.strftime(STRFMTS[unit]))
+                    if "week" == unit: ddict["datestr"] += ddict["label"]
+                    timeline.append(ddict)
+                    uniques[(dt, unit)] = ddict
         for ddict in timeline:
             ddict["count"] = util.format_count(len(ddict["messages"]))
-        self.stats["workhist"].pop("stamps") # Clear memory
         return timeline, units
 
 
 
+class StatsAccumulator(object):
+    """
+    Accumulates message statistics in per-day buckets, as messages are added.
+    Totals for any date range and author selection are assembled from day
+    buckets, in time proportional to the number of days and authors instead
+    of the number of messages.
+
+    Message timestamps and IDs are kept in compact typed arrays per bucket,
+    as microseconds since midnight and message ID.
+    """
+
+    """Microseconds in an hour, for binning bucket times."""
+    HOUR = 3600 * 10**6
+
+    def __init__(self):
+        self.days = {}   # {date: {author: {counts, times, ids, hours, ..}}}
+        self.ids = set() # IDs of accumulated messages
+        self.version = 0 # Incremented on every change, for result caching
+
+
+    def __contains__(self, message_id):
+        return message_id in self.ids
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def add(self, message, data):
+        """
+        Adds message statistics to accumulated data, ignoring already added.
+
+        @param   message  message data dict, with "id", "author", "datetime"
+        @param   data     {?counts: {messages, chars, ..},
+                           ?calldurations: {identity: seconds},
+                           ?transfers: [], ?words: [], ?links: [],
+                           ?emoticons: [type, ]}
+        @return           whether message was added
+        """
+        if message["id"] in self.ids:
+            return False
+        self.ids.add(message["id"])
+        self.version += 1
+
+        dt, author = message["datetime"], message["author"]
+        authors = self.days.setdefault(dt.date(), {})
+        bucket = authors.get(author)
+        if bucket is None:
+            bucket = authors[author] = {
+                "first": dt, "last": dt, "times": array.array("d"),
+                "ids": array.array("d"), "sorted": True, "hours": [0] * 24,
+                "hours-firsts": {}, "counts": collections.defaultdict(int),
+                "durations": collections.defaultdict(int), "calldurations": 0,
+                "transfers": [], "words": collections.defaultdict(int),
+                "links": [], "emoticons": collections.defaultdict(int),
+            }
+        bucket["first"], bucket["last"] = min(bucket["first"], dt), max(bucket["last"], dt)
+        micros = (dt.hour * 3600 + dt.minute * 60 + dt.second) * 10**6 \
+                 + dt.microsecond
+        times, ids = bucket["times"], bucket["ids"]
+        if ids and (micros, message["id"]) < (times[-1], ids[-1]):
+            bucket["sorted"] = False
+        times.append(micros), ids.append(message["id"])
+        if author in AUTHORS_SPECIAL:
+            return True
+
+        stamp = MessageParser.MessageStamp(dt, message["id"])
+        bucket["hours"][dt.hour] += 1
+        firsts = bucket["hours-firsts"]
+        if dt.hour not in firsts or stamp < firsts[dt.hour]:
+            firsts[dt.hour] = stamp
+        for k, v in data.get("counts", {}).items(): bucket["counts"][k] += v
+        for w in data.get("words", ()): bucket["words"][w] += 1
+        for e in data.get("emoticons", ()): bucket["emoticons"][e] += 1
+        bucket["links"].extend(data.get("links", ()))
+        bucket["transfers"].extend(data.get("transfers", ()))
+        calldurations = data.get("calldurations") or {}
+        for identity, duration in calldurations.items():
+            bucket["durations"][identity] += duration
+        if calldurations:
+            bucket["calldurations"] += max(calldurations.values())
+        return True
+
+
+    def iterate(self, daterange=None, authors=None):
+        """
+        Yields (date, author, bucket) for accumulated data in ascending date
+        order, including special authors like "sys".
+
+        @param   daterange  (date1, date2) to limit data to, inclusive
+        @param   authors    list of authors to limit data to, if any
+        """
+        date1, date2 = [x.date() if isinstance(x, datetime.datetime) else x
+                        for x in (list(daterange or ()) + [None, None])[:2]]
+        authors = set(authors) if authors else None
+        for date in sorted(self.days):
+            if date1 and date < date1 or date2 and date > date2:
+                continue # for date
+            for author, bucket in self.days[date].items():
+                if authors is None or author in authors:
+                    yield date, author, bucket
+
+
+    def daystamps(self, daterange=None, authors=None):
+        """
+        Returns accumulated message times in the selection, in ascending
+        order, excluding special authors like "sys", as
+        [(date, array(microseconds since midnight), array(message ID)), ].
+        """
+        result, day, pairs = [], None, []
+        def flush():
+            if not pairs: return
+            if len(pairs) == 1: times, ids = pairs[0]
+            else:
+                merged = sorted(x for tt, ii in pairs for x in zip(tt, ii))
+                times = array.array("d", (x[0] for x in merged))
+                ids   = array.array("d", (x[1] for x in merged))
+            result.append((day, times, ids))
+        for date, author, bucket in self.iterate(daterange, authors):
+            if author in AUTHORS_SPECIAL: continue # for date, author, bucket
+            if date != day:
+                flush()
+                day, pairs = date, []
+            pairs.append(self._sort(bucket))
+        flush()
+        return result
+
+
+    def get_datetime(self, date, micros):
+        """Returns datetime from date and microseconds since midnight."""
+        return datetime.datetime.combine(date, datetime.time()) + \
+               datetime.timedelta(microseconds=micros)
+
+
+    def get_stamp(self, date, bucket, index=0):
+        """Returns MessageStamp for bucket time and ID at index."""
+        times, ids = self._sort(bucket)
+        return MessageParser.MessageStamp(self.get_datetime(date, times[index]),
+                                          int(ids[index]))
+
+
+    def _sort(self, bucket):
+        """Returns (times, ids) of bucket, sorting them first if needed."""
+        if not bucket["sorted"]:
+            pairs = sorted(zip(bucket["times"], bucket["ids"]))
+            bucket["times"] = array.array("d", (x[0] for x in pairs))
+            bucket["ids"]   = array.array("d", (x[1] for x in pairs))
+            bucket["sorted"] = True
+        return bucket["times"], bucket["ids"]
+
+
+    def collect(self, daterange=None, authors=None):
+        """
+        Returns totals for accumulated messages in the selection, as
+        {startdate, enddate, authors: set(), total, calldurations,
+         counts: {author: {messages, chars, .., calldurations}},
+         transfers: [], links: {author: []}, emoticons: {type: {author: count}},
+         words: {author: {word: count}}, hours: {author: [count, ]},
+         hours-firsts: {author: {hour: MessageStamp}},
+         days: {date: {author: count}},
+         days-firsts: {author: {date: MessageStamp}}}.
+
+        @param   daterange  (date1, date2) to limit data to, inclusive
+        @param   authors    list of authors to limit data to, if any
+        """
+        intdict = lambda: collections.defaultdict(int)
+        result = {"startdate": None, "enddate": None, "authors": set(),
+                  "total": 0, "calldurations": 0, "counts": {},
+                  "transfers": [], "links": {},
+                  "emoticons": collections.defaultdict(intdict),
+                  "words": collections.defaultdict(intdict),
+                  "hours": collections.defaultdict(lambda: [0] * 24),
+                  "hours-firsts": collections.defaultdict(dict),
+                  "days": collections.defaultdict(dict),
+                  "days-firsts": collections.defaultdict(dict)}
+        for date, author, bucket in self.iterate(daterange, authors):
+            if not result["startdate"] or bucket["first"] < result["startdate"]:
+                result["startdate"] = bucket["first"]
+            if not result["enddate"] or bucket["last"] > result["enddate"]:
+                result["enddate"] = bucket["last"]
+            if author in AUTHORS_SPECIAL: continue # for date, author, bucket
+
+            result["authors"].add(author)
+            result["total"] += len(bucket["ids"])
+            result["calldurations"] += bucket["calldurations"]
+            result["transfers"].extend(bucket["transfers"])
+            if bucket["links"]:
+                result["links"].setdefault(author, []).extend(bucket["links"])
+            for identity in [author] + list(bucket["durations"]):
+                if identity not in result["counts"]:
+                    result["counts"][identity] = intdict()
+            counts = result["counts"][author]
+            for k, v in bucket["counts"].items(): counts[k] += v
+            for identity, duration in bucket["durations"].items():
+                result["counts"][identity]["calldurations"] += duration
+            for k, v in bucket["emoticons"].items():
+                result["emoticons"][k][author] += v
+            words = result["words"][author]
+            for k, v in bucket["words"].items(): words[k] += v
+
+            hours, firsts = result["hours"][author], result["hours-firsts"][author]
+            for hour, count in enumerate(bucket["hours"]): hours[hour] += count
+            for hour, stamp in bucket["hours-firsts"].items():
+                if hour not in firsts or stamp < firsts[hour]:
+                    firsts[hour] = stamp
+            result["days"][date][author] = len(bucket["ids"])
+            result["days-firsts"][author][date] = self.get_stamp(date, bucket)
+        return result
+
+
+
 def is_skype_database(filename, path=None, log_error=True):
     """Returns whether the file looks to be a Skype database file."""
     result, conn = False, None
@@ -2906,6 +3568,18 @@ def is_skype_database(filename, path=None, log_error=True):
     return result
 
 
+def is_fulltext_supported():
+    """Returns whether SQLite has the FTS5 extension, checked once."""
+    global FULLTEXT_SUPPORTED
+    if FULLTEXT_SUPPORTED is None:
+        try:
+            sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+            FULLTEXT_SUPPORTED = True
+        except Exception:
+            FULLTEXT_SUPPORTED = False
+    return FULLTEXT_SUPPORTED
+
+
 def is_sqlite_file(filename, path=None):
     """Returns whether the file looks to be an SQLite database file."""
     result = ".db" == filename[-3:].lower()
@@ -3076,6 +3750,84 @@ def format_contact_field(datadict, name):
     return None if value in (b"", "", None) else value.strip()
 
 
+def make_highlight_regex(words, flags=re.IGNORECASE | re.UNICODE):
+    """
+    Returns a compiled regex matching any of the words, for highlighting
+    several terms in one pass. Longer words are tried first, * in words
+    matches any characters.
+
+    @param   words  list of words, or a single word
+    """
+    words = [words] if isinstance(words, six.string_types) else words
+    words = sorted(set(filter(bool, words)), key=lambda x: (-len(x), x))
+    patterns = [".*".join(map(re.escape, w.split("*"))) for w in words]
+    return re.compile("(%s)" % "|".join(patterns or ["(?!)"]), flags)
+
+
+def sqlite_regexp(pattern, value):
+    """
+    SQLite REGEXP function, returns whether value contains a match for
+    the regular expression pattern, case-insensitively. Compiled patterns
+    are cached, as the function gets called for every row in query.
+    """
+    if pattern is None or value is None:
+        return False
+    rgx = REGEX_CACHE.get(pattern)
+    if rgx is None:
+        if len(REGEX_CACHE) >= REGEX_CACHE_SIZE: REGEX_CACHE.clear()
+        rgx = REGEX_CACHE[pattern] = re.compile(pattern, re.I | re.U)
+    if isinstance(value, six.binary_type):
+        value = value.decode("utf-8", "replace")
+    elif not isinstance(value, six.string_types):
+        value = six.text_type(value)
+    return rgx.search(value) is not None
+
+
+def sqlite_fuzzy_match(word, value, distance):
+    """
+    SQLite FUZZY_MATCH function, returns whether value contains a word
+    within specified edit distance of the given word, case-insensitively.
+    Results are cached per checked word, as texts repeat the same words.
+    """
+    if not word or not isinstance(value, six.string_types):
+        return False
+    word = word.lower()
+    checked = FUZZY_CACHE.get((word, distance))
+    if checked is None:
+        if len(FUZZY_CACHE) >= REGEX_CACHE_SIZE: FUZZY_CACHE.clear()
+        checked = FUZZY_CACHE[(word, distance)] = {}
+    for candidate in WORD_RGX.findall(value.lower()):
+        result = checked.get(candidate)
+        if result is None:
+            result = abs(len(candidate) - len(word)) <= distance and \
+                     get_edit_distance(word, candidate, distance) <= distance
+            if len(checked) >= FUZZY_CACHE_SIZE: checked.clear()
+            checked[candidate] = result
+        if result:
+            return True
+    return False
+
+
+def get_edit_distance(a, b, limit=None):
+    """
+    Returns the Levenshtein edit distance between the two strings.
+
+    @param   limit  if set, stops early and returns limit + 1 when the
+                    distance is certain to exceed the limit
+    """
+    if len(a) < len(b): a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (x != y)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
 
 """
 Information on Skype database tables (unreliable, mostly empirical):
@@ -3510,6 +3510,39 @@ except ImportError:
       <br />
     </td>
   </tr>
+  <tr>
+    <td bgcolor="{{ conf.BgColour }}" width="150">
+      <b>Search by pattern</b><br /><br />
+      <font color="{{ conf.HelpCodeColour }}"><code>regex:\\d{3}-\\d{4}<br />
+      regex:"(ticket|issue) #\\d+"</code></font>
+      <br />
+    </td>
+    <td bgcolor="{{ conf.BgColour }}">
+      <br /><br />
+      To find messages matching a regular expression, like phone numbers or
+      ticket IDs, use the keyword
+      <font color="{{ conf.HelpCodeColour }}"><code>regex:pattern</code></font>.
+      Matching is case-insensitive.<br /><br />
+      Patterns containing spaces or brackets need to be in quotes.
+      <br />
+    </td>
+  </tr>
+  <tr>
+    <td bgcolor="{{ conf.BgColour }}" width="150">
+      <b>Search for similar words</b><br /><br />
+      <font color="{{ conf.HelpCodeColour }}"><code>fuzzy:recieve</code></font>
+      <br />
+    </td>
+    <td bgcolor="{{ conf.BgColour }}">
+      <br /><br />
+      To find messages containing words spelled approximately like the given
+      word, use the keyword
+      <font color="{{ conf.HelpCodeColour }}"><code>fuzzy:word</code></font>:
+      words can differ by one letter, or by two letters for words longer
+      than 7 characters.
+      <br />
+    </td>
+  </tr>
   <tr>
     <td bgcolor="{{ conf.BgColour }}" width="150">
       <b>Search within specific chats</b><br /><br />
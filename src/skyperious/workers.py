@@ -9,15 +9,27 @@ Released under the MIT License.
 
 @author      Erki Suurjaak
 @created     10.01.2012
-@modified    02.06.2024
+@modified    18.10.2026
 ------------------------------------------------------------------------------
 """
+import bisect
+import collections
 import datetime
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
+import os
 import re
+import sqlite3
+import struct
 import threading
+import time
 import traceback
 
+import six
 from six.moves import queue
 import step
 try:
@@ -35,6 +47,8 @@ from . import templates
 
 logger = logging.getLogger(__name__)
 
+DIFF_PROCESS_STATE = {"dbs": {}, "chats": {}, "worker": None} # Kept open in diff pool process
+
 
 class WorkerThread(threading.Thread):
     """Base class for worker threads."""
@@ -99,12 +113,461 @@ class WorkerThread(threading.Thread):
 
 
 
+class SearchResultStore(object):
+    """
+    Sidecar store of message search result sets, as ordered message IDs
+    per database and query, tagged with database data version. Kept in an
+    SQLite file in cache directory, up to conf.MaxSearchResultSets newest.
+    """
+
+    """Name of store file in cache directory."""
+    FILENAME = "searches.db"
+
+    """SQL for creating store table."""
+    CREATE_SQL = ("CREATE TABLE IF NOT EXISTS results (db TEXT, key TEXT, "
+                  "version TEXT, complete INTEGER, ids BLOB, updated REAL, "
+                  "PRIMARY KEY (db, key))")
+
+    # Guards concurrent access to store file from search threads
+    _lock = threading.RLock()
+
+
+    def __init__(self, path=None):
+        """
+        @param   path  store file path, defaults to FILENAME in cache directory
+        """
+        self.path = path or os.path.join(conf.CacheDirectory, self.FILENAME)
+
+
+    def get(self, filename, key, version):
+        """
+        Returns saved result set as ([message ID, ], whether set is complete),
+        or None if not saved or saved for a different database version.
+
+        @param   filename  database file path
+        @param   key       search identifier like [text, table, reverse]
+        @param   version   current database data version
+        """
+        if not os.path.exists(self.path): return None
+        with self._lock:
+            try:
+                connection = sqlite3.connect(self.path)
+                try:
+                    row = connection.execute(
+                        "SELECT version, complete, ids FROM results "
+                        "WHERE db = ? AND key = ?",
+                        [filename, json.dumps(key)]).fetchone()
+                finally: connection.close()
+            except Exception:
+                logger.exception("Error reading saved search results from %s.",
+                                 self.path)
+                return None
+        if not row or row[0] != version:
+            return None
+        ids = bytes(row[2] or b"")
+        return list(struct.unpack("<%dq" % (len(ids) // 8), ids)), bool(row[1])
+
+
+    def put(self, filename, key, version, ids, complete):
+        """
+        Saves result set, dropping oldest sets over conf.MaxSearchResultSets.
+
+        @param   filename  database file path
+        @param   key       search identifier like [text, table, reverse]
+        @param   version   current database data version
+        @param   ids       [message ID, ] in result order
+        @param   complete  whether ids contain all matches
+        """
+        with self._lock:
+            try:
+                if not os.path.exists(os.path.dirname(self.path)):
+                    util.try_ignore(os.makedirs, os.path.dirname(self.path))
+                connection = sqlite3.connect(self.path)
+                try:
+                    connection.execute(self.CREATE_SQL)
+                    connection.execute(
+                        "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                        [filename, json.dumps(key), version, complete,
+                         sqlite3.Binary(struct.pack("<%dq" % len(ids), *ids)),
+                         time.time()])
+                    connection.execute(
+                        "DELETE FROM results WHERE rowid NOT IN (SELECT rowid "
+                        "FROM results ORDER BY updated DESC LIMIT ?)",
+                        [conf.MaxSearchResultSets])
+                    connection.commit()
+                finally: connection.close()
+            except Exception:
+                logger.exception("Error saving search results to %s.", self.path)
+
+
+
+class FingerprintStore(object):
+    """
+    Sidecar store of message fingerprints for diffing chats, as message ID,
+    timestamp, author and hash of message text parsed for merge comparison,
+    per database and chat, tagged with chat data version. Kept in an SQLite
+    file in cache directory.
+    """
+
+    """Name of store file in cache directory."""
+    FILENAME = "fingerprints.db"
+
+    """Number of fingerprints to unpack at a time from saved columns."""
+    CHUNK = 10000
+
+    """SQL for creating store table."""
+    CREATE_SQL = ("CREATE TABLE IF NOT EXISTS fingerprints (db TEXT, "
+                  "chat INTEGER, version TEXT, authors TEXT, ids BLOB, "
+                  "stamps BLOB, author_codes BLOB, hashes BLOB, "
+                  "PRIMARY KEY (db, chat))")
+
+    # Guards concurrent access to store file from worker threads
+    _lock = threading.RLock()
+
+
+    def __init__(self, path=None):
+        """
+        @param   path  store file path, defaults to FILENAME in cache directory
+        """
+        self.path = path or os.path.join(conf.CacheDirectory, self.FILENAME)
+
+
+    @staticmethod
+    def make_hash(text):
+        """Returns 64-bit integer hash of message text."""
+        digest = hashlib.md5(text.encode("utf-8")).digest()
+        return struct.unpack("<q", digest[:8])[0]
+
+
+    def get(self, filename, chat_id, version):
+        """
+        Returns saved chat fingerprints as an iterator yielding
+        (id, timestamp, author, hash) in timestamp order, unpacked from
+        compact columns in chunks, or None if not saved or saved for
+        a different chat version.
+
+        @param   filename  database file path
+        @param   chat_id   chat ID in database
+        @param   version   current chat data version
+        """
+        if not os.path.exists(self.path): return None
+        with self._lock:
+            try:
+                connection = sqlite3.connect(self.path)
+                try:
+                    row = connection.execute(
+                        "SELECT version, authors, ids, stamps, author_codes, "
+                        "hashes FROM fingerprints WHERE db = ? AND chat = ?",
+                        [filename, chat_id]).fetchone()
+                finally: connection.close()
+            except Exception:
+                logger.exception("Error reading message fingerprints from %s.",
+                                 self.path)
+                return None
+        if not row or row[0] != version:
+            return None
+        return self._unpack(json.loads(row[1]), [bytes(x) for x in row[2:]])
+
+
+    def _unpack(self, authors, columns):
+        """Yields (id, timestamp, author, hash) from packed columns."""
+        for offset in range(0, len(columns[0]), self.CHUNK * 8):
+            size = min(self.CHUNK, len(columns[0]) // 8 - offset // 8)
+            ids, stamps, codes, hashes = (struct.unpack_from("<%dq" % size, x, offset)
+                                          for x in columns)
+            for fingerprint in zip(ids, stamps, codes, hashes):
+                yield fingerprint[:2] + (authors[fingerprint[2]], fingerprint[3])
+
+
+    @staticmethod
+    def pack(fingerprint, authors, columns):
+        """
+        Appends fingerprint to compact columns for saving.
+
+        @param   fingerprint  (id, timestamp, author, hash)
+        @param   authors      {author: code}, updated with new authors
+        @param   columns      [bytearray(ids), bytearray(timestamps),
+                               bytearray(author codes), bytearray(hashes)]
+        """
+        code = authors.setdefault(fingerprint[2], len(authors))
+        for column, value in zip(columns, fingerprint[:2] + (code, fingerprint[3])):
+            column.extend(struct.pack("<q", value))
+
+
+    def put(self, filename, chat_id, version, authors, columns):
+        """
+        Saves chat fingerprints, replacing any previous for chat.
+
+        @param   filename  database file path
+        @param   chat_id   chat ID in database
+        @param   version   current chat data version
+        @param   authors   {author: code} as populated by pack()
+        @param   columns   compact columns as populated by pack()
+        """
+        authors = [a for a, _ in sorted(authors.items(), key=lambda x: x[1])]
+        blobs = [sqlite3.Binary(bytes(x)) for x in columns]
+        with self._lock:
+            try:
+                if not os.path.exists(os.path.dirname(self.path)):
+                    util.try_ignore(os.makedirs, os.path.dirname(self.path))
+                connection = sqlite3.connect(self.path)
+                try:
+                    connection.execute(self.CREATE_SQL)
+                    connection.execute(
+                        "INSERT OR REPLACE INTO fingerprints "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [filename, chat_id, version, json.dumps(authors)] + blobs)
+                    connection.commit()
+                finally: connection.close()
+            except Exception:
+                logger.exception("Error saving message fingerprints to %s.",
+                                 self.path)
+
+
+
+class SearchResultSink(object):
+    """
+    Collects search result output fragments and link data into a buffer,
+    yielding them from search thread in chunks, when enough results, output
+    or time has gathered. Templates are expanded with a pre-bound namespace.
+    Writes output directly to a stream instead of yielding, if given.
+    """
+
+    """Maximum number of characters to buffer before yielding."""
+    MAX_SIZE = 65536
+
+
+    def __init__(self, search, postback, namespace=None, chunk=1, interval=0,
+                 stream=None, drop=None):
+        """
+        @param   search     search data dictionary
+        @param   postback   function(result) to yield results with
+        @param   namespace  template namespace, shared by all expansions
+        @param   chunk      number of results to yield together
+        @param   interval   seconds after which to yield gathered results
+        @param   stream     file-like object to write output to, if any
+        @param   drop       function() returning whether to discard results
+        """
+        self._search    = search
+        self._postback  = postback
+        self._namespace = dict(namespace or {})
+        self._chunk     = chunk
+        self._interval  = interval
+        self._stream    = stream
+        self._drop      = drop or (lambda: False)
+        self._fragments = [] # [output text, ]
+        self._size      = 0  # Number of buffered characters
+        self._map       = {} # {link key: {link data}, }
+        self._pending   = 0  # Number of results buffered
+        self._count     = 0  # Total number of results so far
+        self._flushed   = time.time()
+
+
+    def expand(self, template, **kwargs):
+        """Adds template expanded with namespace and keyword arguments."""
+        self.write(template.expand(self._namespace, **kwargs))
+
+
+    def write(self, text):
+        """Adds text to output."""
+        self._fragments.append(text)
+        self._size += len(text)
+
+
+    def add_result(self, count, key=None, data=None):
+        """
+        Registers one more result, with optional link data, flushes if due.
+
+        @param   count  total number of results so far
+        """
+        if key: self._map[key] = data
+        self._count = count
+        self._pending += 1
+        if self._pending >= self._chunk or self._size >= self.MAX_SIZE \
+        or self._interval and time.time() - self._flushed >= self._interval:
+            self.flush()
+
+
+    def flush(self):
+        """Yields buffered output and link data, if any."""
+        if self._fragments or self._map:
+            if not self._drop():
+                output = "".join(self._fragments)
+                if self._stream: self._stream.write(output)
+                else: self._postback({"output": output, "map": self._map,
+                                      "search": self._search, "count": self._count})
+            self._fragments, self._size, self._map = [], 0, {}
+        self._pending, self._flushed = 0, time.time()
+
+
+    def finish(self, count, text=""):
+        """
+        Yields final result with remaining output and done-flag.
+
+        @param   count  total number of results
+        @param   text   final text to add to output
+        """
+        output = ("" if self._drop() else "".join(self._fragments)) + text
+        if self._stream:
+            if output: self._stream.write(output)
+            output = ""
+        result = {"output": output, "map": self._map, "done": True,
+                  "search": self._search, "count": count}
+        self._fragments, self._size, self._map = [], 0, {}
+        self._postback(result)
+
+
+
 class SearchThread(WorkerThread):
     """
     Search background thread, searches the database on demand, yielding
     results back to main thread in chunks.
+
+    Remembers the matching messages of the last completed message search,
+    and filters those instead of scanning all messages if the next query
+    is a strict refinement of the last one, like "meet" to "meeting".
     """
 
+    def __init__(self, callback):
+        """
+        @param   callback  function to call with result chunks
+        """
+        super(SearchThread, self).__init__(callback)
+        # {"db", "text", "reverse", "fulltext", "version", "ids", "complete"}
+        self._last_search = None
+        self._store = SearchResultStore()
+
+
+    @staticmethod
+    def make_store_key(search, fulltext=False):
+        """
+        Returns identifier for search in SearchResultStore.
+
+        @param   fulltext  whether search matches words with full-text index
+        """
+        return [search["text"], search["table"], bool(search.get("reverse")),
+                bool(fulltext)]
+
+
+    def get_saved_ids(self, search, fulltext, data_version, is_html):
+        """
+        Returns message IDs to show for search from saved result set, sliced
+        by search offset and limit, or None if no usable result set saved.
+        """
+        key = self.make_store_key(search, fulltext)
+        saved = self._store.get(search["db"].filename, key, data_version)
+        if not saved:
+            return None
+        ids, complete = saved
+        offset, limit = search.get("offset") or 0, search.get("limit") or 0
+        end = offset + limit if limit else \
+              offset + conf.MaxSearchMessages if is_html else None
+        if not complete and (end is None or len(ids) < end):
+            return None
+        return ids[offset:end]
+
+
+    def check_interrupt(self):
+        """
+        Progress handler for SQLite, returns whether to interrupt the ongoing
+        query: if running in a search thread whose work has been stopped.
+        """
+        thread = threading.current_thread()
+        return isinstance(thread, SearchThread) and not thread._is_working
+
+
+    def get_refined_ids(self, search, reverse, fulltext, version):
+        """
+        Returns message IDs matched by last search, if the search
+        is a strict refinement of last completed search, else None.
+        """
+        last = self._last_search
+        if not last or not last["complete"] \
+        or "messages" != search["table"] or search.get("limit") \
+        or search.get("offset") or last["db"] is not search["db"] \
+        or (last["reverse"], last["fulltext"], last["version"]) != \
+           (reverse, fulltext, version):
+            return None
+        query_parser = searchparser.SearchQueryParser()
+        if not query_parser.IsRefinement(search["text"], last["text"],
+                                         bool(fulltext)):
+            return None
+        return last["ids"]
+
+
+    def scan_tables(self, db, tasks, max_rows=0, ordered=False):
+        """
+        Runs table queries concurrently on separate read-only connections,
+        conf.SearchTableParallelCount at a time. Yields (task index, [row, ],
+        elapsed seconds) as each query finishes, or in task order if ordered.
+        Stops ongoing queries when search gets stopped or the generator
+        is closed.
+
+        @param   db        SkypeDatabase instance
+        @param   tasks     [(SQL, SQL parameters), ]
+        @param   max_rows  maximum number of rows to fetch per query, 0 for all
+        @param   ordered   whether to hold finished results until all earlier
+                           tasks have been yielded
+        """
+        results = queue.Queue() # (index, rows, elapsed, error) or None if done
+        held, next_index = {}, 0 # {index: (rows, elapsed)} if ordered
+        pending = collections.deque(enumerate(tasks))
+        connections, lock = [], threading.Lock()
+
+        def scan():
+            connection = None
+            try:
+                connection = db.make_connection(readonly=True)
+                with lock: connections.append(connection)
+                while self._is_working:
+                    with lock:
+                        if not pending: break # while self._is_working
+                        i, (sql, params) = pending.popleft()
+                    start = time.time()
+                    try:
+                        cursor = connection.execute(sql, params)
+                        rows = cursor.fetchmany(max_rows) if max_rows \
+                               else cursor.fetchall()
+                        results.put((i, rows, time.time() - start, None))
+                    except Exception as e:
+                        results.put((i, None, time.time() - start, e))
+            except Exception as e:
+                results.put((None, None, 0, e))
+            finally:
+                if connection:
+                    with lock: connections.remove(connection)
+                    connection.close()
+                results.put(None)
+
+        count = min(max(1, conf.SearchTableParallelCount), len(tasks))
+        for _ in range(count):
+            thread = threading.Thread(target=scan)
+            thread.daemon = True
+            thread.start()
+        try:
+            while count and self._is_working:
+                try: item = results.get(timeout=0.5)
+                except queue.Empty: continue # while count
+                if item is None:
+                    count -= 1
+                    continue # while count
+                i, rows, elapsed, error = item
+                if error and self._is_working:
+                    raise error
+                if error:
+                    continue # while count
+                if not ordered:
+                    yield i, rows, elapsed
+                    continue # while count
+                held[i] = (rows, elapsed)
+                while next_index in held:
+                    yield (next_index, ) + held.pop(next_index)
+                    next_index += 1
+        finally:
+            with lock:
+                pending.clear()
+                for connection in connections: connection.interrupt()
+
 
     def match_all(self, text, words):
         """Returns whether the text contains all the specified words."""
@@ -117,7 +580,7 @@ class SearchThread(WorkerThread):
         self._is_running = True
         # For identifying "chat:xxx" and "from:xxx" keywords
         query_parser = searchparser.SearchQueryParser()
-        result = None
+        search = None
         while self._is_running:
             try:
                 search = self._queue.get()
@@ -160,31 +623,46 @@ class SearchThread(WorkerThread):
                 parser = skypedata.MessageParser(search["db"],
                                                  wrapper=wrap_html)
                 result_type, result_count, match_count, count = None, 0, 0, 0
-                # {"output": text with results, "map": link data map}
-                # map data: {"contact:666": {"contact": {contact data}}, }
-                result = {"output": "", "map": {},
-                          "search": search, "count": 0}
-                sql, params, match_words = query_parser.Parse(search["text"])
+                fulltext = conf.SearchUseFullTextIndex \
+                           and search["db"].has_fulltext_index() \
+                           and search["db"].FULLTEXT_TABLE
+                if fulltext and not search["db"].is_fulltext_index_current():
+                    logger.info("Adding new messages to full-text index of %s.",
+                                search["db"])
+                    search["db"].update_fulltext_index(edited=False)
+                    if not search["db"].is_fulltext_index_current():
+                        logger.info("Full-text index of %s not up to date, "
+                                    "searching without it.", search["db"])
+                        fulltext = None
+                sql, params, match_words = query_parser.Parse(search["text"],
+                                                              fulltext=fulltext)
                 match_words = [x.lower() for x in match_words]
 
-                # Turn wildcard characters * into regex-compatible .*
-                match_words_re = [".*".join(map(re.escape, w.split("*")))
-                                  for w in match_words]
-                patt = "(%s)" % "|".join(match_words_re)
                 # For replacing matching words with <b>words</b>
-                pattern_replace = re.compile(patt, re.IGNORECASE)
+                pattern_replace = skypedata.make_highlight_regex(match_words)
+                # Yields {"output": text with results, "map": link data map}
+                # map data: {"contact:666": {"contact": {contact data}}, }
+                sink = SearchResultSink(search, self.postback, namespace={
+                    "search": search, "pattern_replace": pattern_replace,
+                    "wrap_b": wrap_b,
+                }, chunk=conf.SearchResultsChunk if is_html else 1,
+                   interval=conf.SearchResultsInterval if is_html else 0,
+                   stream=search.get("stream"), drop=lambda: self._drop_results)
 
                 # Find chats with a matching title or matching participants
-                chats = []
+                chats, chat_ids = [], set() # chat_ids: candidates matched in SQL
                 if search["table"] in ["conversations", "messages"]:
                     chats = search["db"].get_conversations()
                     chats.sort(key=lambda x: x["title"], reverse=reverse)
                     chat_map = {} # {chat id: {chat data}}
                     template_chat = FACTORY("chat", is_html)
+                if "conversations" == search["table"] and match_words:
+                    chat_ids = search["db"].search_conversations(match_words)
                 for chat in chats:
                     chat_map[chat["id"]] = chat
                     if chat.get("__link"): chat_map[chat["__link"]["id"]] = chat
-                    if "conversations" == search["table"] and match_words:
+                    if chat_ids and (chat["id"] in chat_ids or chat.get("__link")
+                                     and chat["__link"]["id"] in chat_ids):
                         title_matches = False
                         matching_authors = []
                         if self.match_all(chat["title"], match_words):
@@ -199,11 +677,15 @@ class SearchThread(WorkerThread):
                                         matching_authors.append(contact)
                         if title_matches or matching_authors:
                             match_count += 1
-                            if offset and match_count < offset:
+                            if offset and match_count <= offset:
                                 continue # for chat
                             count += 1
                             result_count += 1
-                            try: result["output"] += template_chat.expand(locals())
+                            try:
+                                sink.expand(template_chat, chat=chat,
+                                            result_count=result_count,
+                                            title_matches=title_matches,
+                                            matching_authors=matching_authors)
                             except Exception:
                                 logger.exception("Error formatting search result for chat %s in %s.",
                                                  chat, search["db"])
@@ -211,31 +693,24 @@ class SearchThread(WorkerThread):
                                 count -= 1
                                 result_count -= 1
                                 continue # for chat
-                            key = "chat:%s" % chat["id"]
-                            result["map"][key] = {"chat": chat["id"]}
-                            if not count % conf.SearchResultsChunk \
-                            and not self._drop_results:
-                                result["count"] = result_count
-                                self.postback(result)
-                                result = {"output": "", "map": {},
-                                          "search": search, "count": 0}
+                            sink.add_result(result_count, "chat:%s" % chat["id"],
+                                            {"chat": chat["id"]})
                     if limit and result_count >= limit:
                         break # for chat
                     if not self._is_working:
                         break # for chat
-                if result["output"] and not self._drop_results:
-                    result["count"] = result_count
-                    self.postback(result)
-                    result = {"output": "", "map": {}, "search": search,
-                              "count": 0}
+                sink.flush()
 
                 # Find contacts with a matching name
                 if self._is_working and "contacts" == search["table"] \
                 and match_words:
                     count = 0
                     contacts = search["db"].get_contacts()[::-1 if reverse else 1]
+                    contact_ids = search["db"].search_contacts(match_words)
                     template_contact = FACTORY("contact", is_html)
                     for contact in contacts:
+                        if contact["identity"] not in contact_ids:
+                            continue # for contact
                         match = False
                         fields_filled = {}
                         for field, _ in skypedata.CONTACT_FIELD_TITLES.items():
@@ -247,11 +722,14 @@ class SearchThread(WorkerThread):
                                 fields_filled[field] = val
                         if match:
                             match_count += 1
-                            if offset and match_count < offset:
+                            if offset and match_count <= offset:
                                 continue # for contact
                             count += 1
                             result_count += 1
-                            try: result["output"] += template_contact.expand(locals())
+                            try:
+                                sink.expand(template_contact, contact=contact,
+                                            count=count, result_count=result_count,
+                                            fields_filled=fields_filled)
                             except Exception:
                                 logger.exception("Error formatting search result for contact %s in %s.",
                                                  contact, search["db"])
@@ -259,21 +737,12 @@ class SearchThread(WorkerThread):
                                 count -= 1
                                 result_count -= 1
                                 continue # for contact
-                            if not (self._drop_results
-                            or count % conf.SearchResultsChunk):
-                                result["count"] = result_count
-                                self.postback(result)
-                                result = {"output": "", "map": {},
-                                          "search": search, "count": 0}
+                            sink.add_result(result_count)
                         if limit and result_count >= limit:
                             break # for contact
                         if not self._is_working:
                             break # for contact
-                if result["output"] and not self._drop_results:
-                    result["count"] = result_count
-                    self.postback(result)
-                    result = {"output": "", "map": {},
-                              "search": search, "count": 0}
+                sink.flush()
 
                 # Find messages with a matching body
                 if self._is_working and "messages" == search["table"]:
@@ -281,115 +750,170 @@ class SearchThread(WorkerThread):
                     count, result_type = 0, "messages"
                     chat_messages = {} # {chat id: [message, ]}
                     chat_order = []    # [chat id, ]
+                    message_ids = []   # [matching message ID, ]
+                    # Changes by other connections, and by this connection
+                    version = (search["db"].execute("PRAGMA data_version").fetchone(),
+                               search["db"].connection.total_changes)
+                    data_version = search["db"].get_data_version()
+                    saved_ids = self.get_saved_ids(search, fulltext, data_version,
+                                                   is_html)
+                    refined_ids = None if saved_ids is not None else \
+                                  self.get_refined_ids(search, reverse,
+                                                       fulltext, version)
+                    if saved_ids is not None:
+                        logger.info("Showing %s matches from saved results.",
+                                    len(saved_ids))
+                        sql = "m.id IN (%s)" % ", ".join(map(str, saved_ids))
+                        params = {}
+                    elif refined_ids is not None:
+                        logger.info("Filtering %s matches of previous search.",
+                                    len(refined_ids))
+                        sql = "m.id IN (%s)%s" % (", ".join(map(str, refined_ids)),
+                                                  " AND (%s)" % sql if sql else "")
+                    # Abort ongoing query as soon as search gets stopped
+                    search["db"].connection.set_progress_handler(
+                        self.check_interrupt, 1000)
+                    # Scan from first match to save the full result set,
+                    # rendering only matches after offset
+                    skip = offset if saved_ids is None else 0
                     messages = search["db"].get_messages(
                         additional_sql=sql, additional_params=params,
-                        limit=(limit, offset) if limit or offset else (),
+                        limit=(offset + limit) if saved_ids is None
+                              and limit else (),
                         ascending=reverse, use_cache=False)
-                    for m in messages:
+                    for m in self.iter_uninterrupted(messages):
+                        message_ids.append(m["id"])
+                        if len(message_ids) <= skip:
+                            continue # for m
                         chat = chat_map.get(m["convo_id"])
                         body = parser.parse(m, pattern_replace if match_words
                                             else None, output)
                         count += 1
                         result_count += 1
-                        try: result["output"] += template_message.expand(locals())
+                        try:
+                            sink.expand(template_message, chat=chat, m=m,
+                                        body=body, count=count,
+                                        result_count=result_count)
                         except Exception:
                             logger.exception("Error formatting search result for message %s in %s.",
                                              m, search["db"])
                             count -= 1
                             result_count -= 1
                             continue # for m
-                        key = "message:%s" % m["id"]
-                        result["map"][key] = {"chat": chat["id"],
-                                              "message": m["id"]}
-                        if not is_html or (not self._drop_results
-                        and not count % conf.SearchResultsChunk):
-                            result["count"] = result_count
-                            self.postback(result)
-                            result = {"output": "", "map": {},
-                                      "search": search, "count": 0}
+                        sink.add_result(result_count, "message:%s" % m["id"],
+                                        {"chat": chat["id"], "message": m["id"],
+                                         "timestamp": m["timestamp"]})
                         if not self._is_working or (is_html
                         and count >= conf.MaxSearchMessages):
                             break # for m
+                    self._last_search = {
+                        "db": search["db"], "text": search["text"],
+                        "reverse": reverse, "fulltext": fulltext,
+                        "version": version, "ids": message_ids,
+                        "complete": self._is_working and not limit
+                                    and not offset and not (is_html
+                                    and count >= conf.MaxSearchMessages)}
+                    if saved_ids is None and self._is_working:
+                        complete = not (limit and len(message_ids) >= offset + limit) \
+                                   and not (is_html and count >= conf.MaxSearchMessages)
+                        self._store.put(search["db"].filename,
+                                        self.make_store_key(search, fulltext),
+                                        data_version, message_ids, complete)
 
                 infotext = search["table"]
                 if self._is_working and "all tables" == search["table"]:
                     infotext, result_type = "", "table row"
-                    # Search over all fields of all tables.
+                    # Search over all fields of all tables, several at a time,
+                    # BLOB fields only in tables named in query keywords.
                     template_table = FACTORY("table", is_html)
                     template_row = FACTORY("row", is_html)
+                    named_tables = query_parser.GetKeywords(search["text"]).get("table", [])
+                    tables, tasks = [], [] # [table data, ], [(sql, params), ]
                     for table in search["db"].get_tables()[::-1 if reverse else 1]:
                         table["columns"] = search["db"].get_table_columns(
                             table["name"])
+                        searchable = table
+                        if table["name"].lower() not in named_tables:
+                            columns = [c for c in table["columns"]
+                                       if "BLOB" != (c.get("type") or "").upper()]
+                            if not columns:
+                                continue # continue for table in search["db"]..
+                            searchable = dict(table, columns=columns)
                         sql, params, words = query_parser.Parse(search["text"],
-                                                                table)
+                                                                searchable)
                         if not sql:
                             continue # continue for table in search["db"]..
                         if reverse and re.search(r" ORDER BY \S+$", sql):
                             sql += " DESC"
-                        rows = search["db"].execute(sql, params)
-                        row = rows.fetchone()
-                        namepre, namesuf = ("<b>", "</b>") if row else ("", "")
-                        countpre, countsuf = (("<a href='#%s'>" %
-                            step.step.escape_html(table["name"]), "</a>") if row
-                            else ("", ""))
-                        infotext += (", " if infotext else "") \
-                                    + namepre + table["name"] + namesuf
-                        if not row:
-                            continue # continue for table in search["db"]..
-                        result["output"] = template_table.expand(locals())
+                        tables.append(table)
+                        tasks.append((sql, params))
+
+                    max_rows = offset + limit if limit \
+                               else conf.MaxSearchTableRows if is_html else 0
+                    stats = {} # {table name: (result count, seconds)}
+                    # Offset and limit apply in table order, not finishing order
+                    scans = self.scan_tables(search["db"], tasks, max_rows,
+                                             ordered=bool(offset or limit))
+                    for i, rows, elapsed in scans:
+                        table = tables[i]
+                        stats[table["name"]] = (0, elapsed)
+                        if not rows:
+                            continue # for i, rows, elapsed
+                        sink.expand(template_table, table=table)
                         count = 0
-                        while row:
+                        for row in rows:
                             match_count += 1
-                            if offset and match_count < offset:
-                                continue # while row
+                            if offset and match_count <= offset:
+                                continue # for row
                             count += 1
                             result_count += 1
-                            try: result["output"] += template_row.expand(locals())
+                            try:
+                                sink.expand(template_row, table=table, row=row,
+                                            count=count)
                             except Exception:
                                 logger.exception("Error formatting search result for row %s in %s.",
                                                  row, search["db"])
                                 match_count -= 1
                                 count -= 1
                                 result_count -= 1
-                                continue # while row
-                            key = "table:%s:%s" % (table["name"], count)
-                            result["map"][key] = {"table": table["name"],
-                                                  "row": row}
-                            if not count % conf.SearchResultsChunk \
-                            and not self._drop_results:
-                                result["count"] = result_count
-                                self.postback(result)
-                                result = {"output": "", "map": {},
-                                          "search": search, "count": 0}
+                                continue # for row
+                            sink.add_result(result_count,
+                                            "table:%s:%s" % (table["name"], count),
+                                            {"table": table["name"], "row": row})
                             if limit and result_count >= limit:
-                                break # while row
+                                break # for row
                             if not self._is_working or (is_html
                             and result_count >= conf.MaxSearchTableRows):
-                                break # while row
-                            row = rows.fetchone()
-                        if not self._drop_results:
-                            if is_html:
-                                result["output"] += "</table>"
-                            result["count"] = result_count
-                            self.postback(result)
-                            result = {"output": "", "map": {},
-                                      "search": search, "count": 0}
-                        infotext += " (%s%s%s)" % (countpre,
-                                    util.plural("result", count), countsuf)
+                                break # for row
+                        if is_html: sink.write("</table>")
+                        sink.flush()
+                        stats[table["name"]] = (count, elapsed)
                         if limit and result_count >= limit:
-                            break # for table
+                            break # for i, rows, elapsed
                         if not self._is_working or (is_html
                         and result_count >= conf.MaxSearchTableRows):
-                            break # for table
-                    single_table = ("," not in infotext)
+                            break # for i, rows, elapsed
+                    scans.close()
+
+                    for table in (x for x in tables if x["name"] in stats):
+                        table_count, elapsed = stats[table["name"]]
+                        namepre, namesuf = ("<b>", "</b>") if table_count \
+                                           else ("", "")
+                        countpre, countsuf = (("<a href='#%s'>" %
+                            step.step.escape_html(table["name"]), "</a>")
+                            if table_count else ("", ""))
+                        infotext += (", " if infotext else "") \
+                                    + namepre + table["name"] + namesuf
+                        infotext += " (%s%.2fs)" % ("%s%s%s, " % (countpre,
+                                    util.plural("result", table_count), countsuf)
+                                    if table_count else "", elapsed)
+                    single_table = (len(stats) < 2)
                     infotext = "table%s: %s" % \
                                ("" if single_table else "s", infotext)
                     if not single_table:
                         infotext += "; %s in total" % \
                                     util.plural("result", result_count)
                 final_text = "No matches found."
-                if self._drop_results:
-                    result["output"] = ""
                 if result_count:
                     final_text = "Finished searching %s." % infotext
 
@@ -404,22 +928,36 @@ class SearchThread(WorkerThread):
                     final_text += " Stopped at %s limit %s." % \
                                   (result_type, conf.MaxSearchTableRows)
 
-                result["output"] += "</table><br /><br />%s</font>" % final_text
-                if not is_html: result["output"] = ""
-                result["done"] = True
-                result["count"] = result_count
-                self.postback(result)
-                logger.info("Search found %s results.", result["count"])
+                sink.finish(result_count, "</table><br /><br />%s</font>" %
+                            final_text if is_html else "")
+                logger.info("Search found %s results.", result_count)
             except Exception as e:
-                if not result:
-                    result = {}
-                result["done"], result["error"] = True, traceback.format_exc()
-                result["error_short"] = repr(e)
+                result = {"done": True, "search": search or {}}
+                if self._is_working or not isinstance(e, sqlite3.OperationalError):
+                    result["error"] = traceback.format_exc()
+                    result["error_short"] = repr(e)
                 self.postback(result)
             finally:
                 self._is_working = False
 
 
+    def iter_uninterrupted(self, iterable):
+        """
+        Yields items from iterable, stopping quietly if the iteration raises
+        an SQLite error from query being interrupted by stopped search.
+        """
+        iterator = iter(iterable)
+        while True:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break # while True
+            except sqlite3.OperationalError:
+                if self._is_working: raise
+                break # while True
+            yield item
+
+
 class MergeThread(WorkerThread):
     """
     Merge background thread, compares conversations in two databases, yielding
@@ -436,6 +974,31 @@ class MergeThread(WorkerThread):
     REFRESH_COUNT = 20000
     # Number of iterations between performing an intermediary postback
     POSTBACK_COUNT = 5000
+    # Number of messages to insert between merge journal checkpoints
+    CHECKPOINT_COUNT = 10000
+    # Maximum number of chats to sample per database in estimating
+    ESTIMATE_CHATS = 20
+    # Maximum number of messages to sample per chat in estimating
+    ESTIMATE_MESSAGES = 2000
+    # Timezone offset remainders from whole hours, in seconds: zones differ
+    # by whole, half or quarter hours, like +05:45 against +05:30 or +01:00
+    TIMEZONE_OFFSETS = [0, 900, 1800, 2700]
+    # Number of window candidates from which matching bisects to timezone
+    # shifts around message timestamp, instead of checking every candidate
+    MATCH_BISECT_MIN = 256
+
+
+    def __init__(self, callback):
+        """
+        @param   callback  function to call with result chunks
+        """
+        super(MergeThread, self).__init__(callback)
+        self._fingerprints = FingerprintStore()
+        # Whole-hour and timezone offsets within a day either side, ascending
+        self._time_shifts = sorted(set(sign * (hour * 3600 + offset)
+                                       for hour in range(25)
+                                       for offset in self.TIMEZONE_OFFSETS
+                                       for sign in (-1, 1)))
 
 
     def run(self):
@@ -450,8 +1013,14 @@ class MergeThread(WorkerThread):
                     self.work_diff_left(params)
                 elif "diff_merge_left" == params.get("type"):
                     self.work_diff_merge_left(params)
+                elif "diff_merge_multi" == params.get("type"):
+                    self.work_diff_merge_multi(params)
                 elif "merge_left" == params.get("type"):
                     self.work_merge_left(params)
+                elif "diff_contacts" == params.get("type"):
+                    self.work_diff_contacts(params)
+                elif "estimate" == params.get("type"):
+                    self.work_estimate(params)
             finally:
                 self._is_working = False
 
@@ -488,13 +1057,12 @@ class MergeThread(WorkerThread):
         compared.sort(key=lambda x: x["title"].lower())
         info_template = step.Template(templates.DIFF_RESULT_ITEM, escape=True)
 
-        for index, chat in enumerate(compared):
+        postback = dict((k, v) for k, v in result.items()
+                        if k not in ["output", "chats", "params"])
+        for index, chat, diff in self.iter_chat_diffs(compared, db1, db2, postback):
             result["chatindex"] = index
-            postback = dict((k, v) for k, v in result.items()
-                            if k not in ["output", "chats", "params"])
-            diff = self.get_chat_diff_left(chat, db1, db2, postback, runcheck=True)
             if not self._is_working:
-                break # for index, chat
+                break # for index, chat, diff
             if diff["messages"] \
             or (chat["message_count"] and diff["participants"]):
                 new_chat = not chat["c2"]
@@ -530,14 +1098,20 @@ class MergeThread(WorkerThread):
         """
         Worker branch that compares all chats on the left side for differences,
         copies them over to the right, posting progress back to application.
+        Records merged chats in merge journal of the right side; if resuming,
+        skips chats completely merged before and messages inserted before;
+        if incremental, diffs only messages after those merged before.
         """
         result = {"output": "", "index": 0, "count": 0, "chatindex": 0,
                   "chatcount": 0, "params": params, "chats": [],
                   "type": "diff_merge_left"}
         error, exc = None, None
-        compared = []
+        compared, skipped = [], []
         db1, db2 = params["db1"], params["db2"]
         try:
+            checkpoints = {}
+            if params.get("resume") or params.get("incremental"):
+                checkpoints = db2.get_merge_checkpoints(db1)
             chats1 = params.get("chats") or db1.get_conversations()
             chats2 = db2.get_conversations()
             c2map = dict((c["identity"], c) for c in chats2)
@@ -551,24 +1125,39 @@ class MergeThread(WorkerThread):
                 c["messages1"] = c1["message_count"] or 0
                 c["messages2"] = c2["message_count"] or 0 if c2 else 0
                 c["c1"], c["c2"] = c1, c2
+                c["checkpoint"] = dict(db1.get_chat_merge_mark(c1),
+                                       identity=c1["identity"],
+                                       version=db1.get_chat_data_version(c1))
+                if self.is_merged(c1, c["checkpoint"]["version"], checkpoints):
+                    skipped.append(c)
+                    continue # for c1
+                if c1["identity"] in checkpoints: # Diff as before own inserts
+                    c["ignore2"] = checkpoints[c1["identity"]]["targets"]
+                if params.get("incremental"):
+                    c["since"] = self.get_merge_since(c1, checkpoints)
                 compared.append(c)
                 result["count"] += c["messages1"] + c["messages2"]
-            result["chatcount"] = len(chats1)
+            result["chatcount"] = len(compared)
             compared.sort(key=lambda x: x["title"].lower())
+            if skipped:
+                logger.info("Skipping %s merged before from %s.",
+                            util.plural("chat", skipped), db1)
             count_messages = 0
             count_participants = 0
 
-            for index, chat in enumerate(compared):
+            postback = dict((k, v) for k, v in result.items()
+                            if k not in ["output", "chats", "params"])
+            for index, chat, diff in self.iter_chat_diffs(compared, db1, db2,
+                                                          postback, collect=True):
                 result["chatindex"] = index
-                postback = dict((k, v) for k, v in result.items()
-                                if k not in ["output", "chats", "params"])
-                diff = self.get_chat_diff_left(chat, db1, db2, postback, runcheck=True)
                 if not self._is_working:
-                    break # for index, chat
+                    break # for index, chat, diff
+                chat1, chat2, checkpoint = chat["c1"], chat["c2"], chat["checkpoint"]
+                if chat1["identity"] in checkpoints:
+                    diff["messages"] = list(self.exclude_ranges(diff["messages"],
+                        checkpoints[chat1["identity"]]["ranges"]))
                 if diff["messages"] \
                 or (chat["message_count"] and diff["participants"]):
-                    chat1 = chat["c1"]
-                    chat2 = chat["c2"]
                     new_chat = not chat2
                     if new_chat:
                         chat2 = chat1.copy()
@@ -578,9 +1167,8 @@ class MergeThread(WorkerThread):
                         db2.insert_participants(chat2, diff["participants"], db1)
                         count_participants += len(diff["participants"])
                     if diff["messages"]:
-                        db2.insert_messages(chat2, diff["messages"], db1, chat1,
-                                            self.yield_ui, self.REFRESH_COUNT)
-                        count_messages += len(diff["messages"])
+                        count_messages += self.insert_chat_messages(
+                            db1, db2, chat1, chat2, diff["messages"], checkpoint)
 
                     newstr = "" if new_chat else "new "
                     info = "Merged %s" % chat["title_long_lc"]
@@ -593,6 +1181,9 @@ class MergeThread(WorkerThread):
                         info += ", no messages"
                     result["output"] = info + "."
                     result["diff"] = diff
+                if not diff["messages"]:
+                    db2.save_merge_checkpoint(db1, chat2, complete=True,
+                                              commit=False, **checkpoint)
                 result["index"] = postback["index"]
                 result["chats"].append(chat)
                 if not self._drop_results:
@@ -601,6 +1192,7 @@ class MergeThread(WorkerThread):
                                             compared[index+1]["title_long_lc"])
                     self.postback(result)
                     result = dict(result, output="", chats=[])
+            db2.connection.commit()
         except Exception as e:
             error = traceback.format_exc()
             exc = e
@@ -615,8 +1207,164 @@ class MergeThread(WorkerThread):
                     info += " \n\nto %s." % db2
                 else:
                     info = "Nothing new to merge from %s to %s." % (db1, db2)
+                if skipped:
+                    info += "\n\nSkipped %s merged before." % \
+                            util.plural("chat", skipped)
                 result = {"type": "diff_merge_left", "done": True,
-                          "output": info, "params": params, "chats": [] }
+                          "output": info, "params": params, "chats": [],
+                          "skipped": len(skipped)}
+                if error:
+                    result["error"] = error
+                    if exc: result["error_short"] = repr(exc)
+                self.postback(result)
+
+
+    def work_diff_merge_multi(self, params):
+        """
+        Worker branch that compares all chats in several databases on the left
+        against the database on the right and against each other in one pass,
+        copies the union of differences over to the right, posting progress
+        back to application. Final result includes per-database counts as
+        "counts": [{"chats": .., "messages": .., "participants": ..}, ].
+        Records merged chats in merge journal of the right side; if resuming,
+        skips chats completely merged before and messages inserted before;
+        if incremental, diffs only messages after those merged before.
+        """
+        result = {"output": "", "index": 0, "count": 0, "chatindex": 0,
+                  "chatcount": 0, "params": params, "chats": [],
+                  "type": "diff_merge_multi"}
+        error, exc = None, None
+        groups = [] # [{"c2": chat in db2 or None, "c1s": [(db index, chat), ]}]
+        dbs, db2 = params["dbs"], params["db2"]
+        counts = [collections.defaultdict(int) for _ in dbs]
+        skipped = 0
+        try:
+            checkpoints = [db2.get_merge_checkpoints(db) if params.get("resume")
+                           or params.get("incremental") else {} for db in dbs]
+            # {(db index, chat ID): {"identity", "version", "max_id", "max_timestamp"}}
+            states = {}
+            chats2 = db2.get_conversations(reload=True)
+            db2.get_conversations_stats(chats2)
+            c2map = dict((c["identity"], c) for c in chats2)
+            for c in (c for c in chats2 if c.get("__link")):
+                c2map[c["__link"]["identity"]] = c
+            groupmap = {} # {("c2", chat2 ID) or ("c1", identity): group}
+            for i, db1 in enumerate(dbs):
+                chats1 = db1.get_conversations()
+                db1.get_conversations_stats(chats1)
+                for c1 in chats1:
+                    c2 = c2map.get(c1["identity"])
+                    if not c2 and c1.get("__link"):
+                        c2 = c2map.get(c1["__link"]["identity"])
+                    key = ("c2", c2["id"]) if c2 else ("c1", c1["identity"])
+                    if key not in groupmap:
+                        groupmap[key] = {"c2": c2, "c1s": []}
+                        groups.append(groupmap[key])
+                    groupmap[key]["c1s"].append((i, c1))
+                    states[(i, c1["id"])] = dict(db1.get_chat_merge_mark(c1),
+                                                 identity=c1["identity"],
+                                                 version=db1.get_chat_data_version(c1))
+            if any(checkpoints):
+                count = len(groups)
+                groups = [g for g in groups if not all(
+                    self.is_merged(c1, states[(i, c1["id"])]["version"], checkpoints[i])
+                    for i, c1 in g["c1s"]
+                )]
+                skipped = count - len(groups)
+                if skipped:
+                    logger.info("Skipping %s merged before.",
+                                util.plural("chat", skipped))
+                for group in groups: # Diff as before own inserts
+                    group["ignore2"] = sorted(x for i, c1 in group["c1s"]
+                        if c1["identity"] in checkpoints[i]
+                        for x in checkpoints[i][c1["identity"]]["targets"])
+                    if params.get("incremental"):
+                        group["since"] = [self.get_merge_since(c1, checkpoints[i])
+                                          for i, c1 in group["c1s"]]
+            for group in groups:
+                result["count"] += sum(c1["message_count"] or 0
+                                       for _, c1 in group["c1s"])
+                if group["c2"]: result["count"] += group["c2"]["message_count"] or 0
+            result["chatcount"] = len(groups)
+            groups.sort(key=lambda x: x["c1s"][0][1]["title"].lower())
+
+            postback = dict((k, v) for k, v in result.items()
+                            if k not in ["output", "chats", "params"])
+            for index, group in enumerate(groups):
+                postback["chatindex"] = result["chatindex"] = index
+                diffs = self.get_chat_diff_multi(group, dbs, db2, postback,
+                                                 runcheck=True)
+                if not self._is_working:
+                    break # for index, group
+                chat2, new_chat, count_messages = group["c2"], not group["c2"], 0
+                for i, chat1, diff in diffs:
+                    if not self._is_working:
+                        break # for i, chat1, diff
+                    checkpoint = states[(i, chat1["id"])]
+                    if chat1["identity"] in checkpoints[i]:
+                        diff["messages"] = list(self.exclude_ranges(diff["messages"],
+                            checkpoints[i][chat1["identity"]]["ranges"]))
+                    if not diff["messages"] \
+                    and not (chat1["message_count"] and diff["participants"]):
+                        db2.save_merge_checkpoint(dbs[i], chat2, complete=True,
+                                                  commit=False, **checkpoint)
+                        continue # for i, chat1, diff
+                    if not chat2:
+                        chat2 = chat1.copy()
+                        chat2["id"] = db2.insert_conversation(chat2, dbs[i])
+                    if diff["participants"]:
+                        db2.insert_participants(chat2, diff["participants"], dbs[i])
+                        counts[i]["participants"] += len(diff["participants"])
+                    if diff["messages"]:
+                        count = self.insert_chat_messages(dbs[i], db2, chat1, chat2,
+                                                          diff["messages"], checkpoint)
+                        counts[i]["messages"] += count
+                        count_messages += count
+                    else:
+                        db2.save_merge_checkpoint(dbs[i], chat2, complete=True,
+                                                  commit=False, **checkpoint)
+                    counts[i]["chats"] += 1
+                if chat2:
+                    newstr = "" if new_chat else "new "
+                    info = "Merged %s" % group["c1s"][0][1]["title_long_lc"]
+                    if new_chat:
+                        info += " - new chat"
+                    if count_messages:
+                        info += ", %s" % util.plural("%smessage" % newstr,
+                                                     count_messages)
+                    else:
+                        info += ", no messages"
+                    result["output"] = info + "."
+                result["index"] = postback["index"]
+                if not self._drop_results:
+                    if index < len(groups) - 1:
+                        result["status"] = ("Scanning %s." %
+                            groups[index + 1]["c1s"][0][1]["title_long_lc"])
+                    self.postback(result)
+                    result = dict(result, output="", chats=[])
+            db2.connection.commit()
+        except Exception as e:
+            error = traceback.format_exc()
+            exc = e
+        finally:
+            if not self._drop_results:
+                count_messages = sum(x["messages"] for x in counts)
+                count_participants = sum(x["participants"] for x in counts)
+                if count_messages or count_participants:
+                    info = "Merged %s" % util.plural("new message",
+                                                     count_messages)
+                    if count_participants:
+                        info += " and %s" % util.plural("new participant",
+                                                        count_participants)
+                    info += " \n\nto %s." % db2
+                else:
+                    info = "Nothing new to merge to %s." % db2
+                if skipped:
+                    info += "\n\nSkipped %s merged before." % \
+                            util.plural("chat", skipped)
+                result = {"type": "diff_merge_multi", "done": True,
+                          "output": info, "params": params, "chats": [],
+                          "counts": [dict(x) for x in counts], "skipped": skipped}
                 if error:
                     result["error"] = error
                     if exc: result["error_short"] = repr(exc)
@@ -694,6 +1442,401 @@ class MergeThread(WorkerThread):
                 self.postback(result)
 
 
+    def work_diff_contacts(self, params):
+        """
+        Worker branch that loads chat statistics and compares chat
+        participants, contacts and contact groups in two databases,
+        posting results back as soon as available: first
+        {"chats": [{"messages1": .., "messages2": .., "people": ..,
+                    "last_message_datetime1": .., "last_message_datetime2": ..}
+                   for each chat in params["compared"]]},
+        then contacts missing on the other side in chunks of
+        {"contacts1": [..], "contacts2": [..]}, and lastly
+        {"contactgroups1": [..], "contactgroups2": [..], "done": True}.
+        """
+        result = {"type": "diff_contacts", "params": params}
+        error, exc = None, None
+        db1, db2 = params["db1"], params["db2"]
+        try:
+            chats1, chats2 = params["chats1"], params["chats2"]
+            db1.get_conversations_stats(chats1)
+            db2.get_conversations_stats(chats2)
+            cmaps = [dict((c["identity"], c) for c in cc) for cc in (chats1, chats2)]
+            chats = []
+            for c in params["compared"]:
+                data = {}
+                for i, cmap in enumerate(cmaps, 1):
+                    if c["c%s" % i] and c["identity"] in cmap:
+                        data["messages%s" % i] = cmap[c["identity"]]["message_count"]
+                        data["last_message_datetime%s" % i] = \
+                            cmap[c["identity"]]["last_message_datetime"]
+                people = sorted(p["identity"] for p in c["participants"])
+                if skypedata.CHATS_TYPE_SINGLE != c["type"]:
+                    data["people"] = "%s (%s)" % (len(people), ", ".join(people))
+                else:
+                    data["people"] = ", ".join(x for x in people if x != db1.id)
+                chats.append(data)
+            if not self._drop_results:
+                self.postback(dict(result, chats=chats))
+
+            # Contacts and groups not present on the other side, by identity index
+            contacts = [db1.get_contacts(), db2.get_contacts()]
+            identities = [set(c["identity"] for c in cc) for cc in contacts]
+            for i, j in ((0, 1), (1, 0)):
+                key, seen, chunk = "contacts%s" % (i + 1), set(), []
+                for c in contacts[i]:
+                    if not self._is_working:
+                        break # for c
+                    if c["identity"] in identities[j] or c["identity"] in seen:
+                        continue # for c
+                    seen.add(c["identity"])
+                    item = c.copy()
+                    item["c%s" % (i + 1)], item["c%s" % (j + 1)] = c, None
+                    chunk.append(item)
+                    if len(chunk) >= self.POSTBACK_COUNT and not self._drop_results:
+                        self.postback(dict(result, **{key: chunk}))
+                        chunk = []
+                if chunk and not self._drop_results:
+                    self.postback(dict(result, **{key: chunk}))
+            groups = [db1.get_contactgroups(), db2.get_contactgroups()]
+            gmaps = [dict((g["name"], g) for g in gg) for gg in groups]
+            for i, j in ((0, 1), (1, 0)):
+                diff = result["contactgroups%s" % (i + 1)] = []
+                for g in groups[i]:
+                    g2 = gmaps[j].get(g["name"])
+                    if not g2 or g2["members"] != g["members"]:
+                        item = g.copy()
+                        item["g%s" % (i + 1)], item["g%s" % (j + 1)] = g, g2
+                        diff.append(item)
+        except Exception as e:
+            error = traceback.format_exc()
+            exc = e
+        finally:
+            if not self._drop_results:
+                result["done"] = True
+                if error:
+                    result["error"] = error
+                    if exc: result["error_short"] = repr(exc)
+                self.postback(result)
+
+
+    def work_estimate(self, params):
+        """
+        Worker branch that estimates comparing and merging all chats in several
+        databases on the left against the database on the right, without
+        writing anything: samples chats across the range of chat sizes,
+        measures parse and diff throughput on messages from the sampled chats,
+        and extrapolates to all chats. Honours merge journal like merging,
+        if resume or incremental. Final result has estimates per database as
+        "estimates": [{"chats": chats to process, "new_chats": chats missing
+                       on the right, "skipped": chats merged before,
+                       "messages": messages to process on the left,
+                       "parsed": messages to parse on both sides,
+                       "inserts": messages not on the right,
+                       "bytes": size of messages not on the right,
+                       "seconds": duration, "sampled": chats sampled}, ].
+        """
+        result = {"output": "", "index": 0, "count": 0, "params": params,
+                  "type": "estimate"}
+        error, exc, estimates = None, None, []
+        dbs, db2 = params["dbs"], params["db2"]
+        try:
+            chats2 = db2.get_conversations()
+            db2.get_conversations_stats(chats2)
+            c2map = dict((c["identity"], c) for c in chats2)
+            for c in (c for c in chats2 if c.get("__link")):
+                c2map[c["__link"]["identity"]] = c
+            result["count"] = len(dbs) * self.ESTIMATE_CHATS
+            parallel = conf.DiffParallelCount or multiprocessing.cpu_count() \
+                       if params.get("parallel") else 1
+
+            for i, db1 in enumerate(dbs):
+                if not self._is_working:
+                    break # for i, db1
+                checkpoints = db2.get_merge_checkpoints(db1) if params.get("resume") \
+                              or params.get("incremental") else {}
+                compared, skipped = [], 0
+                chats1 = db1.get_conversations()
+                db1.get_conversations_stats(chats1)
+                for c1 in chats1:
+                    if not c1["message_count"]: continue # for c1
+                    if checkpoints and self.is_merged(c1, db1.get_chat_data_version(c1),
+                                                      checkpoints):
+                        skipped += 1
+                        continue # for c1
+                    c2 = c2map.get(c1["identity"])
+                    if not c2 and c1.get("__link"):
+                        c2 = c2map.get(c1["__link"]["identity"])
+                    c = dict(c1, c1=c1, c2=c2, messages1=c1["message_count"],
+                             messages2=c2["message_count"] or 0 if c2 else 0)
+                    if params.get("incremental"):
+                        c["since"] = self.get_merge_since(c1, checkpoints)
+                    c["pending"] = self.count_chat_messages(db1, c1, c.get("since"))
+                    if c["pending"]: compared.append(c)
+
+                # Spread sample evenly over chats ordered by size
+                compared.sort(key=lambda x: x["pending"])
+                step = len(compared) / float(min(len(compared), self.ESTIMATE_CHATS) or 1)
+                sample = [compared[int(j * step)] for j in range(
+                          min(len(compared), self.ESTIMATE_CHATS))]
+                totals = collections.defaultdict(float)
+                for j, chat in enumerate(sample):
+                    if not self._is_working:
+                        break # for j, chat
+                    for k, v in self.estimate_chat_diff(chat, db1, db2).items():
+                        totals[k] += v
+                    result["index"] = i * self.ESTIMATE_CHATS + \
+                                      (j + 1) * self.ESTIMATE_CHATS // len(sample)
+                    if not self._drop_results: self.postback(result)
+
+                # Extrapolate from sampled ratios and rates to all chats
+                ratio_new = util.safedivf(totals["new"], totals["count1"])
+                ratio2 = util.safedivf(totals["count2"], totals["count1"])
+                estimate = {"chats": len(compared), "skipped": skipped,
+                            "sampled": len(sample), "new_chats": 0,
+                            "messages": 0, "parsed": 0, "inserts": 0}
+                diffed = 0 # Messages on the left needing diff
+                for c in compared:
+                    estimate["messages"] += c["pending"]
+                    if c["c2"] and c["messages2"]:
+                        diffed += c["pending"]
+                        estimate["parsed"] += c["pending"] + int(
+                            c["pending"] * ratio2 if c.get("since") else c["messages2"])
+                        estimate["inserts"] += int(round(c["pending"] * ratio_new))
+                    else:
+                        estimate["new_chats"] += not c["c2"]
+                        estimate["inserts"] += c["pending"]
+                seconds = estimate["parsed"] * util.safedivf(totals["parse"],
+                                                              totals["parsed"])
+                seconds += diffed * util.safedivf(totals["diff"], totals["count1"])
+                seconds /= max(1, min(parallel, len(compared)))
+                seconds += estimate["inserts"] * util.safedivf(totals["read"],
+                                                                totals["read_count"])
+                estimate["seconds"] = seconds
+                estimate["bytes"] = int(estimate["inserts"] *
+                    util.safedivf(totals["bytes"], totals["read_count"]))
+                estimates.append(estimate)
+                result["output"] = "Estimated %s vs %s from %s." % (
+                    db1, db2, util.plural("sampled chat", sample))
+                if not self._drop_results: self.postback(result)
+                result = dict(result, output="")
+        except Exception as e:
+            error = traceback.format_exc()
+            exc = e
+        finally:
+            if not self._drop_results:
+                result = {"type": "estimate", "done": True, "output": "",
+                          "params": params, "estimates": estimates}
+                if error:
+                    result["error"] = error
+                    if exc: result["error_short"] = repr(exc)
+                self.postback(result)
+
+
+    def estimate_chat_diff(self, chat, db1, db2):
+        """
+        Returns measurements from comparing a sample of chat messages in db1
+        against db2, without saving fingerprints: parses up to ESTIMATE_MESSAGES
+        from the middle of the chat on the left, and messages from the same
+        timespan on the right, diffs them, and reads the differing messages, as
+        {"count1": messages sampled on the left, "count2": .. on the right,
+         "parsed": messages parsed, "parse": seconds, "diff": seconds,
+         "new": messages differing, "read_count": messages read,
+         "read": seconds, "bytes": size of messages read}.
+        """
+        c, DAY = chat, 24 * 3600
+        result = collections.defaultdict(float)
+        query1 = self.make_since_query(c.get("since"))
+        query1["limit"] = (self.ESTIMATE_MESSAGES,
+                           max(0, (c["pending"] - self.ESTIMATE_MESSAGES) // 2))
+
+        if c["c2"] and c["messages2"]:
+            t1 = time.time()
+            fingerprints1 = list(self.make_chat_fingerprints(db1, c["c1"], query=query1))
+            if not fingerprints1: return result
+            query2 = {"timestamp_from": fingerprints1[0][1] - DAY - 1,
+                      "timestamp_to":   fingerprints1[-1][1] + DAY + 1}
+            fingerprints2 = list(self.make_chat_fingerprints(db2, c["c2"], query=query2))
+            t2 = time.time()
+            account_ids = set(filter(bool, [db1.id, db1.username, db2.id, db2.username]))
+            message_ids = list(self.match_fingerprints(fingerprints1,
+                                                       iter(fingerprints2), account_ids))
+            t3 = time.time()
+            result.update(count1=len(fingerprints1), count2=len(fingerprints2),
+                          parsed=len(fingerprints1) + len(fingerprints2),
+                          parse=t2 - t1, diff=t3 - t2, new=len(message_ids))
+        else: # Chat missing or empty on the right: all messages go as is
+            message_ids = [m["id"] for m in db1.get_messages(c["c1"], use_cache=False,
+                                                             **query1)]
+
+        t1 = time.time()
+        for m in db1.message_iterator(message_ids):
+            result["read_count"] += 1
+            # Approximate SQLite record size: header byte per column, plus value
+            for k, v in ((k, v) for k, v in m.items() if k != "datetime"):
+                if isinstance(v, six.text_type): v = v.encode("utf-8")
+                result["bytes"] += 1 + (len(v) if isinstance(v, six.binary_type)
+                                        else 0 if v is None else 4)
+        result["read"] = time.time() - t1
+        return result
+
+
+    def count_chat_messages(self, db, chat, since=None):
+        """
+        Returns number of chat messages, after highest message ID or timestamp
+        merged before if since given.
+
+        @param   since  {"max_id": .., "max_timestamp": ..} or None
+        """
+        if not since: return chat["message_count"] or 0
+        query = self.make_since_query(since)
+        ids = [x["id"] for x in (chat, chat.get("__link")) if x]
+        sql = "SELECT COUNT(*) AS count FROM messages m WHERE m.convo_id IN (%s) " \
+              "AND (%s)" % (", ".join(map(str, ids)), query["additional_sql"])
+        return db.execute(sql, query["additional_params"]).fetchone()["count"]
+
+
+    def insert_chat_messages(self, db1, db2, chat1, chat2, message_ids, checkpoint):
+        """
+        Inserts messages from chat in db1 into chat in db2, in batches of
+        CHECKPOINT_COUNT in message ID order, recording each batch in merge
+        journal of db2 in the same transaction, last batch marking chat merged.
+        Returns number of messages inserted, fewer if work was stopped.
+
+        @param   checkpoint  {"identity": chat1 identity,
+                              "version": chat1 data version}
+        """
+        message_ids, count = sorted(message_ids), 0
+        for i in range(0, len(message_ids), self.CHECKPOINT_COUNT):
+            if not self._is_working:
+                break # for i
+            ids = message_ids[i:i + self.CHECKPOINT_COUNT]
+            complete = (i + len(ids) >= len(message_ids))
+            db2.insert_messages(chat2, ids, db1, chat1, self.yield_ui,
+                                self.REFRESH_COUNT, dict(checkpoint, complete=complete))
+            count += len(ids)
+        return count
+
+
+    def is_merged(self, chat, version, checkpoints):
+        """
+        Returns whether chat has been completely merged before at given data
+        version, according to merge journal checkpoints.
+
+        @param   checkpoints  {chat identity: {"version": .., "complete": ..}}
+        """
+        checkpoint = checkpoints.get(chat["identity"])
+        return bool(checkpoint and checkpoint["complete"]
+                    and checkpoint["version"] == version)
+
+
+    def get_merge_since(self, chat, checkpoints):
+        """
+        Returns highest message ID and timestamp of chat merged before,
+        as {"max_id": .., "max_timestamp": ..}, or None if not merged before.
+
+        @param   checkpoints  {chat identity: {"max_id": .., "max_timestamp": ..}}
+        """
+        checkpoint = checkpoints.get(chat["identity"])
+        if checkpoint and checkpoint["max_id"] is not None:
+            return {"max_id": checkpoint["max_id"],
+                    "max_timestamp": checkpoint["max_timestamp"] or 0}
+
+
+    def make_since_query(self, since):
+        """
+        Returns get_messages() keyword arguments for messages after
+        highest message ID or timestamp merged before, if any.
+
+        @param   since  {"max_id": .., "max_timestamp": ..} or None
+        """
+        if not since: return {}
+        return {"additional_sql": "m.id > :max_id OR m.timestamp > :max_timestamp",
+                "additional_params": since}
+
+
+    def exclude_ranges(self, values, ranges, key=None):
+        """
+        Yields values not within any of the ranges.
+
+        @param   ranges  [[first, last], ] ordered by first
+        @param   key     function returning value to compare, if not value itself
+        """
+        starts = [a for a, _ in ranges]
+        for value in values:
+            x = key(value) if key else value
+            i = bisect.bisect_right(starts, x) - 1
+            if i < 0 or x > ranges[i][1]:
+                yield value
+
+
+    def iter_chat_diffs(self, compared, db1, db2, postback, collect=False):
+        """
+        Yields (index, chat, diff) for compared chats in order. Diffs of chats
+        having messages on both sides are computed in a process pool if
+        conf.DiffParallelCount allows, other diffs in this thread.
+
+        @param   postback  {"count": .., "index": .., "chatindex": ..}, updated
+                           and posted at intervals
+        @param   collect   whether to complete all pooled diffs and close pool
+                           before yielding the first, for callers writing into
+                           db2 while iterating, as pool reads block commits
+        """
+        count = conf.DiffParallelCount or multiprocessing.cpu_count()
+        # Chats sharing a chat on the right need diffing after earlier merges
+        c2_ids = collections.Counter(c["c2"]["id"] for c in compared if c["c2"])
+        pooled = [c for c in compared if c["messages1"] and c["messages2"]
+                  and 1 == c2_ids[c["c2"]["id"]]
+                  and not c.get("ignore2") and not c.get("since")]
+        pool, results = None, None
+        if min(count, len(pooled)) > 1:
+            logger.info("Diffing %s in %s processes.",
+                        util.plural("chat", pooled), min(count, len(pooled)))
+            pool = multiprocessing.Pool(min(count, len(pooled)), init_diff_process,
+                                        [{"CacheDirectory": conf.CacheDirectory}])
+            results = pool.imap(diff_chat_process, [
+                (db1.filename, db2.filename, c["c1"]["id"], c["c2"]["id"],
+                 c["messages1"], c["messages2"]) for c in pooled])
+
+        def next_pooled(chat):
+            """Returns next diff from pool, or None if work was stopped."""
+            while self._is_working:
+                try: diff = results.next(timeout=0.5)
+                except multiprocessing.TimeoutError: continue # while
+                identities = set(diff["participants"])
+                diff["participants"] = [p for p in chat["c1"]["participants"]
+                                        if p["identity"] in identities]
+                postback["index"] += chat["messages1"] + chat["messages2"]
+                return diff
+
+        collected = {} # {id(chat): diff} if collecting before yielding
+        try:
+            if pool and collect:
+                for chat in pooled:
+                    diff = next_pooled(chat)
+                    if diff is None:
+                        return
+                    collected[id(chat)] = diff
+                    if not self._drop_results: self.postback(postback)
+                pool.terminate(), pool.join()
+                pool = None
+            pooled = set(id(c) for c in pooled)
+            for index, chat in enumerate(compared):
+                postback["chatindex"] = index
+                if id(chat) in collected:
+                    diff = collected.pop(id(chat))
+                elif pool and id(chat) in pooled:
+                    diff = next_pooled(chat)
+                    if diff is None:
+                        break # for index, chat
+                else:
+                    diff = self.get_chat_diff_left(chat, db1, db2, postback,
+                                                   runcheck=True)
+                yield index, chat, diff
+        finally:
+            if pool: pool.terminate(), pool.join()
+
+
     def get_chat_diff_left(self, chat, db1, db2, postback=None, runcheck=False):
         """
         Compares the chat in the two databases and returns the differences from
@@ -707,94 +1850,397 @@ class MergeThread(WorkerThread):
         c = chat
         participants1 = c["c1"]["participants"] if c["c1"] else []
         participants2 = c["c2"]["participants"] if c["c2"] else []
-        c2p_map = dict((p["identity"], p) for p in participants2
-                       if p["contact"].get("id"))
-        c1p_diff = [p for p in participants1 if p["identity"] not in c2p_map]
-        c1m_diff = [] # [(id, datetime), ] messages different in chat 1
+        identities2 = set(p["identity"] for p in participants2
+                          if p["contact"].get("id"))
+        c1p_diff = [p for p in participants1 if p["identity"] not in identities2]
+        message_ids1 = list(self.iter_chat_diff_left(chat, db1, db2, postback,
+                                                     runcheck))
+        result = {"messages": message_ids1, "participants": c1p_diff}
+
+        return result
+
+
+    def iter_chat_diff_left(self, chat, db1, db2, postback=None, runcheck=False):
+        """
+        Yields IDs of chat messages in db1 not found in db2, in timestamp order.
+        Walks both sides ordered by timestamp, matching each message in db1
+        against messages in db2 in a sliding window of one day either side,
+        so memory use is proportional to one day of messages. Skips db2
+        messages within chat["ignore2"] ID ranges, if any. If chat["since"],
+        diffs only db1 messages after it, against db2 from a day before those.
+
+        @param   postback  if {"count": .., "index": ..}, updates index
+                           and posts the result at POSTBACK_COUNT intervals
+        @param   runcheck  if true, breaks when thread is no longer marked working
+        """
+        c, DAY = chat, 24 * 3600
         db_account_ids = set(filter(bool, [db1.id, db1.username, db2.id, db2.username]))
+        query1, query2 = self.make_since_query(c.get("since")), None
 
         if not c["messages1"]:   # Left side empty, skip all messages
             if postback: postback["index"] += c["messages2"]
-        elif not c["messages2"]: # Right side empty, take entire left
-            messages1 = db1.get_messages(c["c1"], use_cache=False)
-            c1m_diff = [(m["id"], m["datetime"]) for m in messages1]
-            if postback: postback["index"] += len(c1m_diff)
-        else:
-            messages1 = db1.get_messages(c["c1"], use_cache=False)
-            messages2 = db2.get_messages(c["c2"], use_cache=False)
-            parser1 = skypedata.MessageParser(db1)
-            parser2 = skypedata.MessageParser(db2)
-            parse_options = {"format": "text", "merge": True}
-
-            m2buckets = {} # {datetime.date: {(author, body): [(id, datetime), ]}}
-
-            # Assemble all chat message contents from db2
-            for i, m in enumerate(messages2):
-                if not m.get("datetime"): continue # for i, m
-
-                mkey, akey = (m["id"], m["datetime"]), None
-                t = util.to_unicode(parser2.parse(m, output=parse_options), "utf-8")
-                if m["author"] not in db_account_ids:
-                    akey = util.to_unicode(m["author"] or "", "utf-8")
-                bucket = m2buckets.setdefault(m["datetime"].date(), {})
-                bucket.setdefault((akey, t), []).append(mkey)
-
-                if runcheck and not self._is_working:
-                    break # for i, m
-                if i and not i % self.REFRESH_COUNT:
-                    self.yield_ui()
-                if postback: postback["index"] += 1
-                if postback and i and not i % self.POSTBACK_COUNT:
-                    self.postback(postback)
-
-            # For every chat message in db1, see if there is a match in db2
-            DELTAS = [datetime.timedelta(days=x) for x in range(-1, 2)]
-            for i, m in enumerate(messages1):
-                if not m.get("datetime"): continue # for i, m
-
-                t = util.to_unicode(parser1.parse(m, output=parse_options), "utf-8")
-                if m["author"] in db_account_ids: ckey = (None, t)
-                else: ckey = (util.to_unicode(m["author"] or "", "utf-8"), t)
-
-                potentials, mdate = [], m["datetime"].date()
-                for delta in DELTAS:
-                    # Look for matching messages within -1/+1 day interval
-                    potentials += m2buckets.get(mdate+delta, {}).get(ckey, [])
-                if not any(self.match_time(m["datetime"], x[1], 180) for x in potentials):
-                    c1m_diff.append((m["id"], m["datetime"]))
-                if runcheck and not self._is_working:
-                    break # for i, m
-                if i and not i % self.REFRESH_COUNT:
-                    self.yield_ui()
+            return
+        if not c["messages2"]:   # Right side empty, take entire left
+            for m in db1.get_messages(c["c1"], use_cache=False, **query1):
                 if postback: postback["index"] += 1
-                if postback and i and not i % self.POSTBACK_COUNT:
-                    self.postback(postback)
+                yield m["id"]
+            return
+
+        fingerprints1 = self.iter_chat_fingerprints(db1, c["c1"], postback,
+                                                    runcheck, query1)
+        if query1: # Fetch db2 from one day before earliest new in db1
+            fingerprints1 = list(fingerprints1)
+            if not fingerprints1: return
+            query2 = {"timestamp_from": fingerprints1[0][1] - DAY - 1}
+        fingerprints2 = self.iter_chat_fingerprints(db2, c["c2"], postback,
+                                                    runcheck, query2)
+        if c.get("ignore2"):
+            fingerprints2 = self.exclude_ranges(fingerprints2, c["ignore2"],
+                                                key=lambda x: x[0])
+        for mid in self.match_fingerprints(fingerprints1, fingerprints2,
+                                           db_account_ids):
+            yield mid
+        if not query2:
+            for _ in fingerprints2: pass # Complete for saving fingerprints
+
+
+    def match_fingerprints(self, fingerprints1, fingerprints2, account_ids):
+        """
+        Yields message IDs from fingerprints1 not matched in fingerprints2,
+        both in timestamp order, matching in a sliding window of one day
+        either side. Consumes fingerprints2 iterator up to a day after
+        the last in fingerprints1.
 
-        message_ids1 = [x[0] for x in sorted(c1m_diff, key=lambda x: x[1])]
-        result = {"messages": message_ids1, "participants": c1p_diff}
+        @param   account_ids  database account identities, matched as one author
+        """
+        DAY, SLACK = 24 * 3600, 180
+        # {(author, text hash): [[timestamp, ], index of first in window,
+        # set([(index, None) matched])]} of db2 messages in window,
+        # author None for database account
+        window = {}
+        queue2 = collections.deque() # [(timestamp, window key), ] in window
+        # Same for db1 messages read ahead but not matched yet,
+        # reserving candidates they match closer
+        ahead, queue1 = {}, collections.deque()
+        next2 = next(fingerprints2, None)
+
+        # For every chat message in db1, see if there is a match in db2,
+        # reading db1 two days ahead for any closer match to same candidates
+        for fingerprint in itertools.chain(fingerprints1, [None]):
+            if fingerprint:
+                mid, stamp, author, texthash = fingerprint
+                key = (None if author in account_ids else author, texthash)
+                self.window_append(ahead, key, stamp)
+                queue1.append((mid, stamp, key))
+            while queue1 and (not fingerprint
+            or queue1[0][1] < fingerprint[1] - 2 * DAY):
+                mid, stamp, key = queue1.popleft()
+                self.window_popleft(ahead, key)
+                while next2 and next2[1] <= stamp + DAY:
+                    akey = None if next2[2] in account_ids else next2[2]
+                    self.window_append(window, (akey, next2[3]), next2[1])
+                    queue2.append((next2[1], (akey, next2[3])))
+                    next2 = next(fingerprints2, None)
+                while queue2 and queue2[0][0] < stamp - DAY:
+                    self.window_popleft(window, queue2.popleft()[1])
+
+                if not self.match_window(stamp, window.get(key), SLACK,
+                                         reserved=ahead.get(key)):
+                    yield mid
+
+
+    def window_append(self, window, key, stamp):
+        """Adds timestamp to the end of key candidates in sliding window."""
+        window.setdefault(key, [[], 0, set()])[0].append(stamp)
+
+
+    def window_popleft(self, window, key):
+        """Drops first timestamp of key candidates in sliding window."""
+        entry = window[key]
+        entry[1] += 1
+        if entry[1] >= len(entry[0]):
+            del window[key]
+        elif entry[1] > 64 and entry[1] * 2 > len(entry[0]):
+            start = entry[1] # Compact list if mostly dropped
+            del entry[0][:start]
+            entry[1:] = 0, set((j - start, x) for j, x in entry[2] if j >= start)
+
+
+    def window_closer(self, entry, stamp, closeness, slack=0):
+        """
+        Returns whether sliding window entry has a timestamp matching given
+        timestamp closer than specified.
 
+        @param   closeness  (time_distance(), whether farther than slack)
+        """
+        if not entry: return False
+        stamps, DAY = entry[0], 24 * 3600
+        lo = bisect.bisect_left(stamps, stamp - DAY, entry[1])
+        hi = bisect.bisect_right(stamps, stamp + DAY, lo)
+        if hi - lo < self.MATCH_BISECT_MIN:
+            indexes = range(lo, hi)
+        else:
+            indexes = (j for shift in self._time_shifts for j in range(
+                bisect.bisect_left (stamps, stamp + shift - closeness[0], lo, hi),
+                bisect.bisect_right(stamps, stamp + shift + closeness[0], lo, hi)
+            ))
+        return any((self.time_distance(stamps[j], stamp),
+                    abs(stamps[j] - stamp) >= slack) < closeness for j in indexes)
+
+
+    def match_window(self, stamp, entry, slack=0, consumer=None, reserved=None):
+        """
+        Returns whether any timestamp in sliding window entry matches timestamp,
+        not matched by the same consumer before, and marks the candidate
+        matched, so that every candidate matches at most one message
+        per consumer. Prefers the earliest candidate within slack, else
+        the earliest matching by match_time() and not matching closer
+        to any reserved timestamp. Checks each candidate if few, else bisects
+        ordered candidates to slack intervals around whole-hour and timezone shifts.
+
+        @param   entry     [[timestamp, ], index of first in window,
+                            set([(index, consumer) matched before])] or None
+        @param   consumer  identifier of message source, if several
+        @param   reserved  sliding window entry of timestamps still to match,
+                           whose closer candidates are left to them
+        """
+        if not entry: return False
+        stamps, lo, consumed = entry
+        j = bisect.bisect_right(stamps, stamp - slack, lo)
+        while j < len(stamps) and stamps[j] < stamp + slack:
+            if (j, consumer) not in consumed:
+                consumed.add((j, consumer))
+                return True
+            j += 1
+
+        def match(j):
+            if (j, consumer) in consumed \
+            or not self.match_time(stamp, stamps[j], slack) \
+            or self.window_closer(reserved, stamps[j],
+                                  (self.time_distance(stamp, stamps[j]), True),
+                                  slack): return False
+            consumed.add((j, consumer))
+            return True
+
+        if len(stamps) - lo < self.MATCH_BISECT_MIN:
+            return any(match(j) for j in range(lo, len(stamps)))
+        for shift in self._time_shifts:
+            lo = bisect.bisect_right(stamps, stamp + shift - slack, lo)
+            if lo >= len(stamps):
+                break # for shift
+            j = lo
+            while j < len(stamps) and stamps[j] < stamp + shift + slack:
+                if match(j):
+                    return True
+                j += 1
+        return False
+
+
+    def get_chat_diff_multi(self, group, dbs, db2, postback=None, runcheck=False):
+        """
+        Compares the chat in several databases on the left against the chat
+        in the database on the right and against each other, walking all
+        sides together in timestamp order. A message is taken from the first
+        database in timestamp order having it; messages from the same
+        database are not deduplicated against each other.
+
+        @param   group     {"c2": chat in db2 or None, "c1s": [(db index, chat), ],
+                            ?"ignore2": [[first ID, last ID], ] of db2 messages to skip,
+                            ?"since": [{"max_id", "max_timestamp"} or None
+                                       to diff only messages after, per chat]}
+        @param   postback  if {"count": .., "index": ..}, updates index
+                           and posts the result at POSTBACK_COUNT intervals
+        @param   runcheck  if true, breaks when thread is no longer marked working
+        @return            [(db index, chat, {"messages": [message IDs to take],
+                                              "participants": [participants to take]})]
+        """
+        DAY, SLACK = 24 * 3600, 180
+        c2, result = group["c2"], []
+        sinces = group.get("since") or [None] * len(group["c1s"])
+        identities2 = set(p["identity"] for p in c2["participants"]
+                          if p["contact"].get("id")) if c2 else set()
+        for i, c1 in group["c1s"]:
+            participants = [p for p in c1["participants"]
+                            if p["identity"] not in identities2]
+            identities2.update(p["identity"] for p in participants)
+            result.append((i, c1, {"messages": [], "participants": participants}))
+        if 1 == len(group["c1s"]): # Plain diff against right side
+            i, c1, diff = result[0]
+            chat = dict(c1, c1=c1, c2=c2, messages1=c1["message_count"] or 0,
+                        messages2=c2 and c2["message_count"] or 0,
+                        ignore2=group.get("ignore2"), since=sinces[0])
+            diff["messages"] = list(self.iter_chat_diff_left(chat, dbs[i], db2,
+                                                             postback, runcheck))
+            return result
+
+        db_account_ids = set(filter(bool, [db2.id, db2.username] +
+                                    [x for db in dbs for x in (db.id, db.username)]))
+        def tag(fingerprints, n):
+            """Yields (timestamp, chat index in group, fingerprint)."""
+            for fingerprint in fingerprints:
+                yield fingerprint[1], n, fingerprint
+
+        streams, query2 = [], None
+        for n, (i, c1) in enumerate(group["c1s"]):
+            if not c1["message_count"]: continue # for n, (i, c1)
+            query = self.make_since_query(sinces[n])
+            stream = self.iter_chat_fingerprints(dbs[i], c1, postback, runcheck, query)
+            streams.append(tag(list(stream) if query else stream, n))
+        if all(sinces): # Fetch db2 from one day before earliest new on left
+            streams = [list(x) for x in streams]
+            stamps = [x[0][0] for x in streams if x]
+            if not stamps: return result
+            query2 = {"timestamp_from": min(stamps) - DAY - 1}
+        fingerprints1 = heapq.merge(*streams)
+        fingerprints2 = iter(())
+        if c2 and c2["message_count"]:
+            fingerprints2 = self.iter_chat_fingerprints(db2, c2, postback,
+                                                        runcheck, query2)
+        if group.get("ignore2"):
+            fingerprints2 = self.exclude_ranges(fingerprints2, group["ignore2"],
+                                                key=lambda x: x[0])
+        # {(author, text hash): [[timestamp, ], index of first in window,
+        # set([(index, chat index) matched])]} of db2 messages in window,
+        # {((author, text hash), chat index): [[timestamp, ], ..]} of messages
+        # on the left read ahead but not matched yet,
+        # and {(author, text hash): deque([[timestamp, chat index,
+        # set([chat index matched])], ])} of messages taken from the left
+        window2, queue2 = {}, collections.deque()
+        window1, queue1 = {}, collections.deque()
+        ahead, queue0 = {}, collections.deque()
+        next2 = next(fingerprints2, None)
+
+        # Read left two days ahead, reserving candidates matched closer later
+        for item in itertools.chain(fingerprints1, [None]):
+            if item:
+                stamp, n, (mid, _, author, texthash) = item
+                key = (None if author in db_account_ids else author, texthash)
+                self.window_append(ahead, (key, n), stamp)
+                queue0.append((stamp, n, mid, key))
+            while queue0 and (not item or queue0[0][0] < item[0] - 2 * DAY):
+                stamp, n, mid, key = queue0.popleft()
+                self.window_popleft(ahead, (key, n))
+                while next2 and next2[1] <= stamp + DAY:
+                    akey = None if next2[2] in db_account_ids else next2[2]
+                    self.window_append(window2, (akey, next2[3]), next2[1])
+                    queue2.append((next2[1], (akey, next2[3])))
+                    next2 = next(fingerprints2, None)
+                while queue2 and queue2[0][0] < stamp - DAY:
+                    self.window_popleft(window2, queue2.popleft()[1])
+                while queue1 and queue1[0][0] < stamp - DAY:
+                    key1 = queue1.popleft()[1]
+                    window1[key1].popleft()
+                    if not window1[key1]: del window1[key1]
+
+                reserved = ahead.get((key, n))
+                if self.match_window(stamp, window2.get(key), SLACK, n, reserved):
+                    continue # while queue0
+                candidates = [x for x in window1.get(key, ())
+                              if n != x[1] and n not in x[2]]
+                taken = next((x for x in candidates
+                               if abs(stamp - x[0]) < SLACK), None) \
+                        or next((x for x in candidates
+                                 if self.match_time(stamp, x[0], SLACK)
+                                 and not self.window_closer(reserved, x[0],
+                                     (self.time_distance(stamp, x[0]), True),
+                                     SLACK)), None)
+                if taken:
+                    taken[2].add(n) # Match each taken once per source
+                else:
+                    result[n][2]["messages"].append(mid)
+                    window1.setdefault(key, collections.deque()).append([stamp, n, set()])
+                    queue1.append((stamp, key))
+        if not query2:
+            for _ in fingerprints2: pass # Complete for saving fingerprints
         return result
 
 
+    def iter_chat_fingerprints(self, db, chat, postback=None, runcheck=False,
+                               query=None):
+        """
+        Yields fingerprints of chat messages with timestamps, in timestamp
+        order, from saved store if chat unchanged since, else parsing all
+        messages and saving result if completed.
+
+        @param   postback  if {"count": .., "index": ..}, updates index
+                           and posts the result at POSTBACK_COUNT intervals
+        @param   runcheck  if true, breaks when thread is no longer marked working
+        @param   query     get_messages() keyword arguments to parse only
+                           some messages, bypassing store
+        @return            (message ID, timestamp, author, text hash)
+        """
+        if query:
+            fingerprints = self.make_chat_fingerprints(db, chat, query=query)
+        else:
+            version = db.get_chat_data_version(chat)
+            fingerprints = self._fingerprints.get(db.filename, chat["id"], version)
+        if not query and fingerprints is None:
+            fingerprints = self.make_chat_fingerprints(db, chat, version)
+        for i, fingerprint in enumerate(fingerprints):
+            yield fingerprint
+
+            if runcheck and not self._is_working:
+                break # for i, fingerprint
+            if i and not i % self.REFRESH_COUNT:
+                self.yield_ui()
+            if postback: postback["index"] += 1
+            if postback and i and not i % self.POSTBACK_COUNT:
+                self.postback(postback)
+
+
+    def make_chat_fingerprints(self, db, chat, version=None, query=None):
+        """
+        Yields fingerprints of chat messages with timestamps, parsing messages
+        in timestamp order, and saves all fingerprints in store once iterated
+        to the end, unless query given.
+
+        @param   query  get_messages() keyword arguments to parse only some messages
+        @return         (message ID, timestamp, author, text hash)
+        """
+        parser = skypedata.MessageParser(db)
+        parse_options = {"format": "text", "merge": True}
+        authors, columns = {}, [bytearray() for _ in range(4)]
+        for m in db.get_messages(chat, use_cache=False, **query or {}):
+            if not m["timestamp"]: continue # for m
+
+            t = util.to_unicode(parser.parse(m, output=parse_options), "utf-8")
+            author = util.to_unicode(m["author"] or "", "utf-8")
+            fingerprint = (m["id"], m["timestamp"], author,
+                           FingerprintStore.make_hash(t))
+            if not query: FingerprintStore.pack(fingerprint, authors, columns)
+            yield fingerprint
+        if not query:
+            self._fingerprints.put(db.filename, chat["id"], version, authors, columns)
+
+
     def match_time(self, d1, d2, slack=0):
         """
-        Returns whether datetimes might be same but from different timezones:
-        comparison ignores hours within a single-day interval.
+        Returns whether datetimes or UNIX timestamps might be same but from
+        different timezones: comparison ignores whole hours within a single-day
+        interval, and quarter-hour, half-hour and 45-minute timezone offsets.
 
-        @param   slack  seconds of slack between timestamp minutes
+        @param   slack  seconds of slack between timestamp minutes,
+                        either side of the timezone offset
         """
         if not d1 or not d2: return False
-        d1, d2 = (d1, d2) if d1 < d2 else (d2, d1)
-        delta = d2 - d1
-        if util.timedelta_seconds(delta) > 24 * 3600:
-            return False # Skip if not even within same day
-
-        result = False
-        for hour in range(int(util.timedelta_seconds(delta) / 3600) + 1):
-            d1plus = d1 + datetime.timedelta(hours=hour)
-            result = util.timedelta_seconds(d2 - d1plus) < slack
-            if result: break # for hour
-        return result
+        distance = self.time_distance(d1, d2)
+        return distance is not None and distance < slack
+
+
+    def time_distance(self, d1, d2):
+        """
+        Returns seconds between datetimes or UNIX timestamps from the nearest
+        whole-hour and timezone shift, or None if more than a day apart.
+        """
+        delta = abs(d2 - d1)
+        if isinstance(delta, datetime.timedelta):
+            delta = util.timedelta_seconds(delta)
+        if delta > 24 * 3600:
+            return None # Skip if not even within same day
+
+        remainder = delta % 3600
+        return min(min(abs(remainder - x), 3600 - abs(remainder - x))
+                   for x in self.TIMEZONE_OFFSETS) # Wraps around hour
 
 
 
@@ -909,3 +2355,43 @@ class SkypeArchiveThread(WorkerThread):
 
             if not self._drop_results: self.postback(result)
             self._is_working = False
+
+
+
+def init_diff_process(settings):
+    """
+    Initializes a diff process in pool, applying configuration from parent.
+
+    @param   settings  {name: value} to set in conf
+    """
+    for k, v in settings.items(): setattr(conf, k, v)
+    DIFF_PROCESS_STATE.update(dbs={}, chats={}, worker=None)
+
+
+def diff_chat_process(args):
+    """
+    Compares chat in two databases in a pool process, keeping databases open
+    for subsequent chats.
+
+    @param   args  (db1 filename, db2 filename, chat ID in db1, chat ID in db2,
+                    message count in db1, message count in db2)
+    @return        {"messages": [message IDs different in db1],
+                    "participants": [identities different in db1]}
+    """
+    state = DIFF_PROCESS_STATE
+    filename1, filename2, chat_id1, chat_id2, messages1, messages2 = args
+    dbs, chats = [], []
+    for filename, chat_id in [(filename1, chat_id1), (filename2, chat_id2)]:
+        if filename not in state["dbs"]:
+            db = state["dbs"][filename] = skypedata.SkypeDatabase(filename)
+            state["chats"][filename] = dict((c["id"], c) for c in
+                                            db.get_conversations())
+        dbs.append(state["dbs"][filename])
+        chats.append(state["chats"][filename][chat_id])
+    if not state["worker"]:
+        state["worker"] = MergeThread(None)
+    chat = dict(chats[0], c1=chats[0], c2=chats[1],
+                messages1=messages1, messages2=messages2)
+    diff = state["worker"].get_chat_diff_left(chat, dbs[0], dbs[1])
+    return {"messages": diff["messages"],
+            "participants": [p["identity"] for p in diff["participants"]]}